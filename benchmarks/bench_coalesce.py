@@ -0,0 +1,116 @@
+"""
+Write coalescing on a chatty channel: frames written and flush latency.
+
+A channel with websocket stubs gets a steady stream of messages (one per
+millisecond by default), with coalescing disabled and with growing
+`coalesce_ms` windows. Reports socket writes per subscriber, messages per
+write and the flush latency histogram of coalesced frames.
+
+Usage:
+
+    python benchmarks/bench_coalesce.py [messages] [subscribers]
+"""
+from __future__ import print_function
+
+import sys
+import time
+import uuid
+from datetime import datetime
+
+import gevent
+
+from channelstream.channel import Channel
+from channelstream.connection import Connection
+from channelstream.server_state import get_state, FLUSH_LATENCY_BUCKETS
+from channelstream.utils import Histogram
+
+WINDOWS = (0, 5, 10, 20)
+
+
+class CountingSocket(object):
+    terminated = False
+
+    def __init__(self):
+        self.writes = 0
+
+    def send(self, payload):
+        self.writes += 1
+
+
+def make_message():
+    return {
+        "uuid": uuid.uuid4(),
+        "type": "message",
+        "user": "system",
+        "channel": "bench",
+        "timestamp": datetime.utcnow(),
+        "message": {"text": "x" * 50},
+        "no_history": False,
+        "pm_users": [],
+        "exclude_users": [],
+        "catchup": False,
+        "edited": None,
+    }
+
+
+def measure(coalesce_ms, messages, subscribers):
+    server_state = get_state()
+    server_state.flush_latency = Histogram(FLUSH_LATENCY_BUCKETS)
+    channel = Channel("bench", channel_config={"coalesce_ms": coalesce_ms})
+    sockets = []
+    connections = []
+    for i in range(subscribers):
+        connection = Connection("user_{}".format(i), uuid.uuid4())
+        socket = CountingSocket()
+        connection.attach_socket(socket)
+        channel.add_connection(connection)
+        sockets.append(socket)
+        connections.append(connection)
+    start = time.time()
+    for i in range(messages):
+        channel.add_message(make_message())
+        gevent.sleep(0.001)
+    while any(connection.send_queue for connection in connections):
+        gevent.sleep(0.001)
+    elapsed = time.time() - start
+    for socket in sockets:
+        socket.terminated = True
+    writes = sum(socket.writes for socket in sockets) / float(subscribers)
+    return writes, elapsed, server_state.flush_latency
+
+
+def percentile(histogram, fraction):
+    """
+    Upper bound of bucket holding the percentile
+    """
+    wanted = histogram.count * fraction
+    for bound, count in zip(histogram.bounds, histogram.counts):
+        if count >= wanted:
+            return bound
+    return float("inf")
+
+
+def run():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    subscribers = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    print("{} messages, {} subscribers".format(messages, subscribers))
+    print(
+        "{:>11}{:>14}{:>12}{:>10}{:>12}{:>12}".format(
+            "coalesce_ms", "writes/conn", "msgs/write", "time s", "mean ms", "p99 ms"
+        )
+    )
+    for coalesce_ms in WINDOWS:
+        writes, elapsed, latency = measure(coalesce_ms, messages, subscribers)
+        mean = p99 = 0
+        if latency.count:
+            mean = latency.sum / latency.count * 1000
+            p99 = percentile(latency, 0.99) * 1000
+        print(
+            "{:>11}{:>14.0f}{:>12.1f}{:>10.2f}{:>12.1f}{:>12.1f}".format(
+                coalesce_ms, writes, messages / writes, elapsed, mean, p99
+            )
+        )
+
+
+if __name__ == "__main__":
+    run()
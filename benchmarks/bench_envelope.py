@@ -0,0 +1,125 @@
+"""
+Allocation profile of broadcasting a 1KB payload to a 1k-subscriber channel.
+
+Subscribers have websocket stubs without writers attached, so the profile
+covers what the broadcast itself allocates: delivery copies, frame storage,
+catchup representation and the encoded frame. Catchup lookup for every
+subscriber is profiled separately.
+
+Usage:
+
+    python benchmarks/bench_envelope.py
+"""
+from __future__ import print_function
+
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+
+from channelstream.channel import Channel
+from channelstream.connection import Connection
+from channelstream.server_state import get_state
+from channelstream.user import User
+
+SUBSCRIBERS = 1000
+BROADCASTS = 200
+
+
+class StubSocket(object):
+    terminated = False
+
+    def send(self, payload):
+        pass
+
+
+def make_channel():
+    server_state = get_state()
+    channel = Channel("bench", channel_config={"store_history": True})
+    server_state.channels[channel.name] = channel
+    connections = []
+    for i in range(SUBSCRIBERS):
+        username = "user_{}".format(i)
+        user = User(username)
+        server_state.users[username] = user
+        connection = Connection(username, uuid.uuid4())
+        connection.socket = StubSocket()
+        user.add_connection(connection)
+        channel.add_connection(connection)
+        connections.append(connection)
+    return channel, connections
+
+
+def make_message():
+    return {
+        "uuid": uuid.uuid4(),
+        "type": "message",
+        "user": "system",
+        "channel": "bench",
+        "timestamp": datetime.utcnow(),
+        "message": {
+            "text": "x" * 700,
+            "attachments": [{"name": "file_{}".format(i), "size": i} for i in range(8)],
+            "meta": {"lang": "en", "tags": ["a", "b", "c"]},
+        },
+        "no_history": False,
+        "pm_users": [],
+        "exclude_users": [],
+        "catchup": False,
+        "edited": None,
+    }
+
+
+def profile(func, rounds):
+    """
+    Returns average peak traced memory, retained memory and time per call,
+    peak includes short lived copies that are freed before call returns
+    """
+    peak_total = retained_total = elapsed = 0
+    for _ in range(rounds):
+        tracemalloc.start()
+        start = time.time()
+        func()
+        elapsed += time.time() - start
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peak_total += peak
+        retained_total += retained
+    return (
+        peak_total / float(rounds),
+        retained_total / float(rounds),
+        elapsed / rounds,
+    )
+
+
+def run():
+    channel, connections = make_channel()
+    messages = [make_message() for _ in range(BROADCASTS)]
+    feed = iter(messages)
+    since = datetime.utcnow()
+
+    def broadcast():
+        channel.add_message(next(feed))
+        for connection in connections:
+            connection.send_queue.clear()
+
+    def catchup():
+        for connection in connections:
+            channel.get_catchup_frames(since, connection.username)
+
+    print("{} subscribers, {} broadcasts".format(SUBSCRIBERS, BROADCASTS))
+    print("{:<12}{:>16}{:>16}{:>12}".format("", "peak B/op", "kept B/op", "ms/op"))
+    for label, func, rounds in (
+        ("broadcast", broadcast, BROADCASTS),
+        ("catchup", catchup, 5),
+    ):
+        peak, retained, elapsed = profile(func, rounds)
+        print(
+            "{:<12}{:>16.0f}{:>16.0f}{:>12.3f}".format(
+                label, peak, retained, elapsed * 1000
+            )
+        )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,98 @@
+"""
+Measures JSON encoding work done for a single channel broadcast.
+
+Every subscriber gets a websocket stub, the script counts how many times
+the wire encoder runs per broadcast and how long a broadcast takes for
+growing subscriber counts.
+
+Usage:
+
+    python benchmarks/bench_fanout.py
+"""
+from __future__ import print_function
+
+import time
+import uuid
+from datetime import datetime
+
+from channelstream import patched_json
+from channelstream.channel import Channel
+from channelstream.connection import Connection
+from channelstream.server_state import get_state
+from channelstream.user import User
+
+SUBSCRIBER_COUNTS = (10, 100, 1000, 10000, 20000)
+BROADCASTS = 20
+
+
+class StubSocket(object):
+    terminated = False
+
+    def send(self, payload):
+        pass
+
+
+class CountingDumps(object):
+    def __init__(self, dumps):
+        self.dumps = dumps
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        return self.dumps(*args, **kwargs)
+
+
+def make_channel(subscribers):
+    server_state = get_state()
+    server_state.users = {}
+    server_state.connections = {}
+    channel = Channel("bench")
+    for i in range(subscribers):
+        username = "user_{}".format(i)
+        user = User(username)
+        server_state.users[username] = user
+        connection = Connection(username, uuid.uuid4())
+        connection.socket = StubSocket()
+        user.add_connection(connection)
+        channel.add_connection(connection)
+    return channel
+
+
+def make_message():
+    return {
+        "uuid": uuid.uuid4(),
+        "type": "message",
+        "user": "system",
+        "channel": "bench",
+        "timestamp": datetime.utcnow(),
+        "message": {"text": "x" * 200, "tags": ["a", "b", "c"]},
+        "no_history": False,
+        "pm_users": [],
+        "exclude_users": [],
+        "catchup": False,
+        "edited": None,
+    }
+
+
+def run():
+    counter = CountingDumps(patched_json.dumps)
+    patched_json.dumps = counter
+    print("subscribers  encodes/broadcast  ms/broadcast")
+    for subscribers in SUBSCRIBER_COUNTS:
+        channel = make_channel(subscribers)
+        counter.calls = 0
+        start = time.time()
+        for _ in range(BROADCASTS):
+            channel.add_message(make_message())
+        elapsed = time.time() - start
+        print(
+            "{:>11}  {:>17.1f}  {:>12.3f}".format(
+                subscribers,
+                counter.calls / float(BROADCASTS),
+                elapsed * 1000 / BROADCASTS,
+            )
+        )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,132 @@
+"""
+/info on a large channel: rebuilt every request vs cached per version.
+
+Fills a channel with members and history, then answers /info the way it
+was done before (info dict rebuilt with list membership checks, then
+encoded), with channel info cached per version and pre-encoded, and for
+clients that send back the ETag they got. Reports requests per second.
+
+Usage:
+
+    python benchmarks/bench_info.py [members] [requests]
+"""
+from __future__ import print_function
+
+import logging
+import sys
+import time
+import uuid
+
+from webob.etag import ETagMatcher
+
+from channelstream import cluster, patched_json as json
+from channelstream.channel import Channel
+from channelstream.connection import Connection
+from channelstream.server_state import get_state
+from channelstream.user import User
+from channelstream.wsgi_views.server import SharedUtils
+
+
+class Request(object):
+    tenant_id = "0"
+
+
+def previous_get_info(channel):
+    server_state = get_state(channel.tenant_id)
+    chan_info = {
+        "uuid": channel.uuid,
+        "name": channel.name,
+        "long_name": channel.long_name,
+        "settings": channel.settings,
+        "history": list(channel.history),
+        "last_active": channel.last_active,
+        "total_connections": sum(
+            [len(conns) for conns in channel.connections.values()]
+        ),
+        "total_users": 0,
+        "users": [],
+    }
+    for username in channel.connections.keys():
+        user_inst = server_state.users.get(username)
+        if user_inst.username not in chan_info["users"]:
+            chan_info["users"].append(user_inst.username)
+    remote_members = cluster.remote_members(channel.tenant_id, channel.name)
+    for username, (connections, _) in remote_members.items():
+        chan_info["total_connections"] += connections
+        if username not in chan_info["users"]:
+            chan_info["users"].append(username)
+    chan_info["users"] = sorted(chan_info["users"])
+    chan_info["total_users"] = len(chan_info["users"])
+    return chan_info
+
+
+def previous(utils, channel, etag):
+    info = previous_get_info(channel)
+    users = utils.get_users_info(set(info["users"]))
+    return json.dumps({"channels": {channel.name: info}, "users": users})
+
+
+def cached(utils, channel, etag):
+    return utils.get_channel_info_json(None, include_users=True)[1]
+
+
+def not_modified(utils, channel, etag):
+    return utils.get_channel_info_json(
+        None, include_users=True, if_none_match=ETagMatcher([etag])
+    )[1]
+
+
+def run():
+    members = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    logging.disable(logging.INFO)
+    server_state = get_state()
+    channel = Channel(
+        "bench", channel_config={"store_history": True, "history_size": 50}
+    )
+    server_state.channels["bench"] = channel
+    for i in range(members):
+        username = "user_{}".format(i)
+        user = User(username)
+        user.state_from_dict({"name": username, "color": "red"})
+        server_state.users[username] = user
+        channel.add_connection(Connection(username, uuid.uuid4()))
+    for i in range(50):
+        channel.add_message(
+            {
+                "uuid": uuid.uuid4(),
+                "type": "message",
+                "user": "system",
+                "channel": "bench",
+                "message": {"text": "x" * 100},
+                "no_history": False,
+                "pm_users": [],
+                "exclude_users": [],
+                "catchup": False,
+            }
+        )
+    utils = SharedUtils(Request())
+    etag, body = utils.get_channel_info_json(None, include_users=True)
+    expected = json.loads(previous(utils, channel, etag))
+    got = json.loads(body)
+    assert got["channels"] == expected["channels"]
+    assert sorted(got["users"], key=lambda u: u["user"]) == sorted(
+        expected["users"], key=lambda u: u["user"]
+    )
+    print("{} members, {} requests".format(members, requests))
+    print("{:<14}{:>12}{:>12}".format("info", "req/s", "KiB/req"))
+    for name, answer in (
+        ("previous", previous),
+        ("cached", cached),
+        ("etag match", not_modified),
+    ):
+        start = time.time()
+        for _ in range(requests):
+            body = answer(utils, channel, etag)
+        elapsed = time.time() - start
+        size = len(body or "") / 1024.0
+        print("{:<14}{:>12.0f}{:>12.1f}".format(name, requests / elapsed, size))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,113 @@
+"""
+/info over many channels: one response vs pages vs streaming.
+
+Creates lots of small channels and walks the whole state the three ways
+`/info` supports: everything in one response, pages of `limit` channels
+following `next_cursor`, and a streamed response consumed chunk by chunk.
+A probe greenlet wakes up every millisecond meanwhile. Reports total time,
+the longest event loop stall seen by the probe and the largest string
+built at once.
+
+Usage:
+
+    python benchmarks/bench_info_pages.py [channels] [page size]
+"""
+from __future__ import print_function
+
+import logging
+import sys
+import time
+import uuid
+
+import gevent
+
+from channelstream.channel import Channel
+from channelstream.connection import Connection
+from channelstream.server_state import get_state
+from channelstream.user import User
+from channelstream.wsgi_views.server import SharedUtils
+
+
+class Request(object):
+    tenant_id = "0"
+
+
+def probe(stalls, done):
+    while not done:
+        start = time.time()
+        gevent.sleep(0.001)
+        stalls.append(time.time() - start - 0.001)
+
+
+def whole(utils, page_size):
+    return [utils.get_channel_info_json(None, include_users=True)[1]]
+
+
+def pages(utils, page_size):
+    cursor = None
+    while True:
+        _, body = utils.get_channel_info_json(
+            None, include_users=True, cursor=cursor, limit=page_size
+        )
+        yield body
+        # client round trip between requests
+        gevent.sleep(0.001)
+        cursor = body[body.rindex('"next_cursor":') + 14 : -1]
+        if cursor == "null":
+            break
+        cursor = cursor.strip('"')
+
+
+def streamed(utils, page_size):
+    return utils.get_channel_info_json(None, include_users=True, stream=True)[1]
+
+
+def measure(walk, utils, page_size):
+    stalls = []
+    done = []
+    prober = gevent.spawn(probe, stalls, done)
+    gevent.sleep(0.01)
+    start = time.time()
+    largest = 0
+    total = 0
+    for chunk in walk(utils, page_size):
+        largest = max(largest, len(chunk))
+        total += len(chunk)
+    elapsed = time.time() - start
+    done.append(True)
+    prober.join()
+    return elapsed, max(stalls), largest, total
+
+
+def run():
+    channels = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    page_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    logging.disable(logging.INFO)
+    server_state = get_state()
+    for i in range(channels):
+        name = "channel_{:06}".format(i)
+        username = "user_{}".format(i)
+        user = User(username)
+        user.state_from_dict({"name": username})
+        server_state.users[username] = user
+        channel = Channel(name)
+        channel.add_connection(Connection(username, uuid.uuid4()))
+        server_state.channels[name] = channel
+    utils = SharedUtils(Request())
+    print("{} channels, pages of {}".format(channels, page_size))
+    print(
+        "{:<10}{:>10}{:>16}{:>18}{:>12}".format(
+            "mode", "time s", "max stall ms", "largest KiB", "total MiB"
+        )
+    )
+    for name, walk in (("whole", whole), ("pages", pages), ("stream", streamed)):
+        elapsed, stall, largest, total = measure(walk, utils, page_size)
+        print(
+            "{:<10}{:>10.2f}{:>16.1f}{:>18.1f}{:>12.1f}".format(
+                name, elapsed, stall * 1000, largest / 1024.0, total / 1048576.0
+            )
+        )
+
+
+if __name__ == "__main__":
+    run()
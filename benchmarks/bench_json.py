@@ -0,0 +1,119 @@
+"""
+Compares wire encoders from channelstream.patched_json over representative
+message shapes.
+
+"legacy" is the previous `dumps` (stdlib json with indent=4), other columns
+are the backends selectable with `--json-backend`.
+
+Usage:
+
+    python benchmarks/bench_json.py
+"""
+from __future__ import print_function
+
+import timeit
+import uuid
+from datetime import datetime
+
+from channelstream import patched_json
+
+ROUNDS = 5000
+
+
+def chat_message():
+    return [
+        {
+            "uuid": uuid.uuid4(),
+            "type": "message",
+            "user": "some_user",
+            "channel": "pub_chan",
+            "timestamp": datetime.utcnow(),
+            "edited": None,
+            "catchup": False,
+            "message": {"text": "hello there " * 10, "mentions": ["a", "b"]},
+        }
+    ]
+
+
+def presence_with_users():
+    return [
+        {
+            "uuid": uuid.uuid4(),
+            "type": "presence",
+            "user": "some_user",
+            "channel": "pub_chan",
+            "timestamp": datetime.utcnow(),
+            "catchup": False,
+            "message": {"action": "joined"},
+            "state": {"status": "online"},
+            "users": [
+                {"user": "user_{}".format(i), "state": {"status": "online", "n": i}}
+                for i in range(200)
+            ],
+        }
+    ]
+
+
+def heartbeat():
+    return []
+
+
+def channel_info():
+    return {
+        "channels": {
+            "chan_{}".format(c): {
+                "uuid": uuid.uuid4(),
+                "name": "chan_{}".format(c),
+                "long_name": None,
+                "last_active": datetime.utcnow(),
+                "settings": {"notify_presence": True, "history_size": 10},
+                "history": chat_message() * 10,
+                "total_connections": 50,
+                "total_users": 50,
+                "users": ["user_{}".format(i) for i in range(50)],
+            }
+            for c in range(20)
+        },
+        "users": [],
+    }
+
+
+SHAPES = (
+    ("chat message", chat_message, ROUNDS),
+    ("presence w/ users", presence_with_users, ROUNDS // 10),
+    ("heartbeat", heartbeat, ROUNDS * 10),
+    ("channel info", channel_info, ROUNDS // 100),
+)
+
+
+def encoders():
+    found = [
+        ("legacy", patched_json.dumps_pretty),
+        ("json", patched_json.json_dumps),
+    ]
+    if patched_json.orjson_dumps is not None:
+        found.append(("orjson", patched_json.orjson_dumps))
+    return found
+
+
+def run():
+    available = encoders()
+    header = "{:<20}".format("shape") + "".join(
+        "{:>16}".format(name + " us") for name, _ in available
+    )
+    print(header)
+    for label, factory, rounds in SHAPES:
+        obj = factory()
+        row = "{:<20}".format(label)
+        for name, encoder in available:
+            elapsed = timeit.timeit(lambda: encoder(obj), number=rounds)
+            row += "{:>16.2f}".format(elapsed * 1e6 / rounds)
+        print(row)
+    row = "{:<20}".format("bytes (chat)")
+    for name, encoder in available:
+        row += "{:>16}".format(len(encoder(chat_message())))
+    print(row)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,95 @@
+"""
+Durable history log: append throughput, recovery time and heap usage.
+
+Posts messages to history enabled channels backed by a tenant log in
+a temporary directory, then restores channels from that log like a restart
+would. Reports messages appended per second, recovery time and traced
+memory held by channel histories with and without the log.
+
+Usage:
+
+    python benchmarks/bench_log.py [channels] [messages_per_channel]
+"""
+from __future__ import print_function
+
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+
+from channelstream import storage
+from channelstream.channel import Channel
+from channelstream.operations import restore_from_log
+from channelstream.server_state import get_state
+
+
+def message(channel_name, i):
+    return {
+        "uuid": uuid.uuid4(),
+        "type": "message",
+        "user": "bench",
+        "channel": channel_name,
+        "message": {"text": "x" * 200, "i": i},
+        "timestamp": datetime.utcnow(),
+        "no_history": False,
+        "pm_users": [],
+        "exclude_users": [],
+        "catchup": False,
+        "edited": None,
+    }
+
+
+def fill(channels, messages):
+    config = {"store_history": True, "history_size": messages, "frames_size": 100}
+    state = get_state()
+    tracemalloc.start()
+    start = time.time()
+    for c in range(channels):
+        name = "channel_{}".format(c)
+        channel = Channel(name, channel_config=config)
+        state.channels[name] = channel
+        for i in range(messages):
+            channel.add_message(message(name, i))
+    elapsed = time.time() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    state.channels = {}
+    return channels * messages / elapsed, current
+
+
+def run():
+    channels = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    print("{} channels, {} history messages each".format(channels, messages))
+
+    rate, memory = fill(channels, messages)
+    print("{:<10}{:>16.0f} msg/s{:>12.1f} MB".format("memory", rate, memory / 1e6))
+
+    directory = tempfile.mkdtemp()
+    try:
+        storage.LOGS["0"] = storage.TenantLog(directory)
+        rate, memory = fill(channels, messages)
+        storage.LOGS["0"].sync()
+        size = storage.LOGS["0"].segments.size()
+        storage.LOGS.pop("0").close()
+        print("{:<10}{:>16.0f} msg/s{:>12.1f} MB".format("log", rate, memory / 1e6))
+
+        start = time.time()
+        restore_from_log(storage.TenantLog(directory))
+        elapsed = time.time() - start
+        state = get_state()
+        restored = sum(len(channel.history) for channel in state.channels.values())
+        print(
+            "recovered {} messages from {:.1f} MB log in {:.2f}s".format(
+                restored, size / 1e6, elapsed
+            )
+        )
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,162 @@
+"""
+Long polling with many clients: delivery latency, gaps and duplicates.
+
+Every client is a greenlet that polls the way `/listen` does and waits
+a simulated round trip between polls. A channel all clients are subscribed
+to gets a message at regular intervals. Polls are driven two ways:
+
+* queue - previous behaviour, every poll attaches a fresh queue, delivers
+  timestamp catchup and lingers in 0.25s `queue.get` loops
+* cursor - persistent poll buffer, clients resume from their cursor
+
+Reports polls per second, mean delivery latency and how many messages
+clients missed or got twice.
+
+Usage:
+
+    python benchmarks/bench_longpoll.py [clients] [messages]
+"""
+from __future__ import print_function
+
+from gevent import monkey
+
+monkey.patch_all()
+
+import collections
+import logging
+import sys
+import time
+import uuid
+
+import gevent
+from gevent.queue import Empty, Queue
+
+from channelstream import operations
+from channelstream.server_state import get_state
+from channelstream.wsgi_views.server import await_data
+
+CONFIG = {"wake_connections_after": 5, "long_poll_linger": 0}
+ROUND_TRIP = 0.01
+INTERVAL = 1.0
+SETTLE = 10
+
+
+def queue_poll(connection):
+    connection.attach_queue(Queue())
+    connection.deliver_catchup_messages()
+    messages = []
+    try:
+        messages.extend(connection.queue.get(timeout=CONFIG["wake_connections_after"]))
+    except Empty:
+        pass
+    while True:
+        try:
+            messages.extend(connection.queue.get(timeout=0.25))
+        except Empty:
+            break
+    connection.mark_activity()
+    return messages
+
+
+def queue_client(connection, received, done):
+    while not done:
+        messages = queue_poll(connection)
+        received.append((time.time(), messages))
+        gevent.sleep(ROUND_TRIP)
+
+
+def cursor_client(connection, received, done):
+    cursor = 0
+    if connection.attach_poll_buffer():
+        connection.deliver_catchup_messages()
+    while not done:
+        messages, cursor = await_data(connection, CONFIG, cursor)
+        connection.mark_activity()
+        received.append((time.time(), messages))
+        gevent.sleep(ROUND_TRIP)
+
+
+def measure(client, clients, messages):
+    server_state = get_state()
+    server_state.users = {}
+    server_state.connections = {}
+    server_state.channels = {}
+    connections = []
+    for i in range(clients):
+        connection, _ = operations.connect(
+            username="user_{}".format(i),
+            conn_id=uuid.uuid4(),
+            channels=["bench"],
+            channel_configs={"bench": {"store_frames": True}},
+            fresh_user_state={},
+            update_user_state={},
+        )
+        connections.append(connection)
+    done = []
+    received = [[] for _ in range(clients)]
+    greenlets = [
+        gevent.spawn(client, connection, received[i], done)
+        for i, connection in enumerate(connections)
+    ]
+    gevent.sleep(1)
+    stats = collections.Counter()
+    start = time.time()
+    for i in range(messages):
+        operations.pass_message(
+            {
+                "uuid": uuid.uuid4(),
+                "user": "system",
+                "channel": "bench",
+                "message": {"i": i, "sent": time.time()},
+                "no_history": True,
+                "pm_users": [],
+                "exclude_users": [],
+            },
+            stats,
+        )
+        gevent.sleep(INTERVAL)
+    elapsed = time.time() - start
+    # let clients that are behind catch up
+    gevent.sleep(SETTLE)
+    done.append(True)
+    polls = 0
+    latency = 0.0
+    delivered = 0
+    missing = 0
+    duplicates = 0
+    for responses in received:
+        seen = collections.Counter()
+        for returned_at, batch in responses:
+            if start <= returned_at <= start + elapsed:
+                polls += 1
+            for message in batch:
+                seen[message["message"]["i"]] += 1
+                latency += returned_at - message["message"]["sent"]
+                delivered += 1
+        missing += sum(1 for i in range(messages) if not seen[i])
+        duplicates += sum(count - 1 for count in seen.values() if count > 1)
+    gevent.killall(greenlets)
+    return polls / elapsed, latency / max(delivered, 1), missing, duplicates
+
+
+def run():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    logging.disable(logging.INFO)
+    print("{} clients, {} messages".format(clients, messages))
+    print(
+        "{:<8}{:>12}{:>18}{:>10}{:>12}".format(
+            "mode", "polls/s", "mean latency ms", "missing", "duplicates"
+        )
+    )
+    for name, client in (("queue", queue_client), ("cursor", cursor_client)):
+        rate, latency, missing, duplicates = measure(client, clients, messages)
+        print(
+            "{:<8}{:>12.0f}{:>18.1f}{:>10}{:>12}".format(
+                name, rate, latency * 1000, missing, duplicates
+            )
+        )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,153 @@
+"""
+Cost of hot path metrics: broadcasts written to websockets.
+
+Subscribes websocket stubs (frames are built like ws4py builds them and
+written to /dev/null) to a channel and sends broadcasts until every
+frame got written, writers get to run after every broadcast or after bursts
+of them. Runs with histograms that ignore observed values, with the previous
+histogram that bumped every bucket above the value and with current one.
+Reports broadcasts per second of CPU time and overhead over no metrics.
+
+Usage:
+
+    python benchmarks/bench_metrics.py [connections] [broadcasts]
+"""
+from __future__ import print_function
+
+import bisect
+import logging
+import os
+import sys
+import time
+import uuid
+
+import gevent
+from ws4py.messaging import TextMessage
+
+from channelstream import operations
+from channelstream.server_state import get_state
+from channelstream.utils import Histogram
+
+REPEAT = 7
+# wall clock of a busy machine is too noisy to tell a few percent apart
+cpu_time = getattr(time, "process_time", None) or time.clock
+
+HISTOGRAMS = (
+    "flush_latency",
+    "fanout_latency",
+    "fanout_subscribers",
+    "send_latency",
+    "queue_depth",
+)
+
+
+class NullHistogram(object):
+    def __init__(self, buckets):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+class CumulativeHistogram(Histogram):
+    def observe(self, value):
+        for i in range(bisect.bisect_left(self.bounds, value), len(self.bounds)):
+            self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class CountingSocket(object):
+    terminated = False
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.frames = 0
+
+    def send(self, payload):
+        os.write(self.fd, TextMessage(payload).single())
+        self.frames += 1
+
+
+def measure(histogram_class, connections, broadcasts, burst, fd):
+    server_state = get_state()
+    server_state.users = {}
+    server_state.connections = {}
+    server_state.channels = {}
+    server_state.reset_histograms()
+    for name in HISTOGRAMS:
+        histogram = getattr(server_state, name)
+        setattr(server_state, name, histogram_class(histogram.bounds))
+    sockets = []
+    for i in range(connections):
+        connection, _ = operations.connect(
+            username="user_{}".format(i),
+            conn_id=uuid.uuid4(),
+            channels=["bench"],
+            channel_configs={},
+        )
+        socket = CountingSocket(fd)
+        connection.attach_socket(socket)
+        sockets.append(socket)
+    gevent.sleep(0.1)
+    start = cpu_time()
+    for i in range(broadcasts):
+        operations.pass_message(
+            {
+                "uuid": uuid.uuid4(),
+                "type": "message",
+                "user": "system",
+                "channel": "bench",
+                "message": {"text": "x" * 100, "i": i},
+                "no_history": True,
+                "pm_users": [],
+                "exclude_users": [],
+            },
+            server_state.stats,
+        )
+        if i % burst == burst - 1:
+            # writers drain their queues
+            gevent.sleep(0)
+    while sum(socket.frames for socket in sockets) < connections * broadcasts:
+        gevent.sleep(0.001)
+    elapsed = cpu_time() - start
+    for socket in sockets:
+        socket.terminated = True
+    return broadcasts / elapsed
+
+
+def run():
+    connections = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    broadcasts = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    logging.disable(logging.INFO)
+    fd = os.open(os.devnull, os.O_WRONLY)
+    modes = (
+        ("none", NullHistogram),
+        ("cumulative", CumulativeHistogram),
+        ("current", Histogram),
+    )
+    print("{} connections, {} broadcasts".format(connections, broadcasts))
+    print(
+        "{:<8}{:<14}{:>14}{:>12}".format("burst", "metrics", "broadcasts/s", "overhead")
+    )
+    for burst in (1, 10):
+        # modes take turns so that machine noise hits all of them alike
+        rates = dict((name, []) for name, _ in modes)
+        for _ in range(REPEAT):
+            for name, histogram_class in modes:
+                rate = measure(histogram_class, connections, broadcasts, burst, fd)
+                rates[name].append(rate)
+        medians = dict((name, sorted(rates[name])[REPEAT // 2]) for name, _ in modes)
+        for name, _ in modes:
+            print(
+                "{:<8}{:<14}{:>14.1f}{:>11.1f}%".format(
+                    burst,
+                    name,
+                    medians[name],
+                    (medians["none"] / medians[name] - 1) * 100,
+                )
+            )
+
+
+if __name__ == "__main__":
+    run()
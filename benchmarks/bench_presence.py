@@ -0,0 +1,102 @@
+"""
+Presence while a large channel fills up: full user lists vs batched deltas.
+
+Members join a channel one per millisecond, every member has a websocket
+stub. Presence is sent the old way (`broadcast_presence_with_user_lists`,
+every join carries the whole user list) and as deltas coalesced over
+`presence_window_ms` windows. Reports frames and bytes written per
+member and time spent.
+
+Usage:
+
+    python benchmarks/bench_presence.py [members]
+"""
+from __future__ import print_function
+
+import sys
+import time
+import uuid
+
+import gevent
+
+from channelstream.channel import Channel
+from channelstream.connection import Connection
+from channelstream.server_state import get_state
+from channelstream.user import User
+
+MODES = (
+    ("full lists", {"broadcast_presence_with_user_lists": True}),
+    ("deltas 0ms", {"presence_deltas": True, "presence_window_ms": 0}),
+    ("deltas 50ms", {"presence_deltas": True, "presence_window_ms": 50}),
+)
+
+
+class CountingSocket(object):
+    terminated = False
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+
+    def send(self, payload):
+        self.frames += 1
+        self.bytes += len(payload)
+
+
+def measure(config, members):
+    server_state = get_state()
+    server_state.users = {}
+    server_state.connections = {}
+    server_state.channels = {}
+    channel_config = {"notify_presence": True}
+    channel_config.update(config)
+    channel = Channel("bench", channel_config=channel_config)
+    sockets = []
+    connections = []
+    start = time.time()
+    for i in range(members):
+        username = "user_{}".format(i)
+        user = User(username)
+        user.state_from_dict({"name": username})
+        user.state_public_keys = ["name"]
+        server_state.users[username] = user
+        connection = Connection(username, uuid.uuid4())
+        connection.max_send_queue = sys.maxsize
+        socket = CountingSocket()
+        connection.attach_socket(socket)
+        user.add_connection(connection)
+        with server_state.channel_lock("bench"):
+            channel.add_connection(connection)
+        sockets.append(socket)
+        connections.append(connection)
+        gevent.sleep(0.001)
+    gevent.sleep(0.1)
+    while any(connection.send_queue for connection in connections):
+        gevent.sleep(0.001)
+    elapsed = time.time() - start
+    for socket in sockets:
+        socket.terminated = True
+    frames = sum(socket.frames for socket in sockets) / float(members)
+    sent = sum(socket.bytes for socket in sockets) / float(members)
+    return frames, sent, elapsed
+
+
+def run():
+    members = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print("{} members joining".format(members))
+    print(
+        "{:<14}{:>14}{:>16}{:>10}".format(
+            "presence", "frames/member", "KiB/member", "time s"
+        )
+    )
+    for name, config in MODES:
+        frames, sent, elapsed = measure(config, members)
+        print(
+            "{:<14}{:>14.1f}{:>16.1f}{:>10.2f}".format(
+                name, frames, sent / 1024, elapsed
+            )
+        )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,126 @@
+"""
+Bulk POST /message delivery: greenlet per message vs batched dispatch.
+
+A batch of messages spread over a few channels is delivered the way
+`/message` used to do it (`pass_message` spawned for every message) and with
+`pass_messages`, which walks every channel's subscribers once per batch.
+Every subscriber has a websocket stub, the script waits until all frames
+are written and reports messages/sec and frames sent per connection.
+
+Usage:
+
+    python benchmarks/bench_publish.py [messages] [channels] [subscribers]
+"""
+from __future__ import print_function
+
+import collections
+import sys
+import time
+import uuid
+from datetime import datetime
+
+import gevent
+
+from channelstream import operations
+from channelstream.channel import Channel
+from channelstream.connection import Connection
+from channelstream.server_state import get_state
+from channelstream.user import User
+
+
+class CountingSocket(object):
+    terminated = False
+
+    def __init__(self):
+        self.frames = 0
+
+    def send(self, payload):
+        self.frames += 1
+
+
+def make_state(channels, subscribers):
+    server_state = get_state()
+    server_state.users = {}
+    server_state.connections = {}
+    server_state.channels = {}
+    sockets = []
+    for c in range(channels):
+        channel_name = "channel_{}".format(c)
+        channel = Channel(channel_name)
+        server_state.channels[channel_name] = channel
+        for i in range(subscribers):
+            username = "user_{}_{}".format(c, i)
+            user = User(username)
+            server_state.users[username] = user
+            connection = Connection(username, uuid.uuid4())
+            connection.max_send_queue = sys.maxsize
+            socket = CountingSocket()
+            connection.attach_socket(socket)
+            sockets.append(socket)
+            user.add_connection(connection)
+            channel.add_connection(connection)
+    return sockets
+
+
+def make_messages(messages, channels):
+    return [
+        {
+            "uuid": uuid.uuid4(),
+            "user": "system",
+            "channel": "channel_{}".format(i % channels),
+            "timestamp": datetime.utcnow(),
+            "message": {"text": "x" * 200, "i": i},
+            "no_history": False,
+            "pm_users": [],
+            "exclude_users": [],
+        }
+        for i in range(messages)
+    ]
+
+
+def per_message(msgs, stats):
+    gevent.joinall([gevent.spawn(operations.pass_message, msg, stats) for msg in msgs])
+
+
+def batched(msgs, stats):
+    gevent.spawn(operations.pass_messages, msgs, stats).join()
+
+
+def measure(dispatch, messages, channels, subscribers):
+    sockets = make_state(channels, subscribers)
+    gevent.sleep(0)
+    msgs = make_messages(messages, channels)
+    stats = collections.Counter()
+    start = time.time()
+    dispatch(msgs, stats)
+    # let writer greenlets drain send queues
+    connections = list(get_state().connections.values())
+    for user in get_state().users.values():
+        connections.extend(user.connections)
+    while any(connection.send_queue for connection in connections):
+        gevent.sleep(0)
+    elapsed = time.time() - start
+    frames = sum(socket.frames for socket in sockets)
+    for socket in sockets:
+        socket.terminated = True
+    return messages / elapsed, frames / float(len(sockets)), stats
+
+
+def run():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    channels = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    subscribers = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+    print(
+        "{} messages over {} channels, {} subscribers each".format(
+            messages, channels, subscribers
+        )
+    )
+    print("{:<12}{:>14}{:>18}".format("dispatch", "msg/s", "frames/conn"))
+    for name, dispatch in (("per message", per_message), ("batched", batched)):
+        rate, frames, stats = measure(dispatch, messages, channels, subscribers)
+        assert stats["total_messages"] == messages * subscribers
+        print("{:<12}{:>14.0f}{:>18.1f}".format(name, rate, frames))
+
+
+if __name__ == "__main__":
+    run()
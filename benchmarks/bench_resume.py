@@ -0,0 +1,82 @@
+"""
+Catchup on reconnect: resume by sequence number vs by last activity.
+
+Fills a channel with catchup frames and reconnects simulated clients that
+received messages up to a random point. Their connection was last marked
+active a little later (a heartbeat went out after the last message they got
+but before they dropped), which is what timestamp catchup relies on.
+Reports messages missed and lookup time of both methods.
+
+Usage:
+
+    python benchmarks/bench_resume.py [frames] [reconnects]
+"""
+from __future__ import print_function
+
+import random
+import sys
+import time
+import uuid
+from datetime import timedelta
+
+from channelstream.channel import Channel
+
+
+def make_message(i):
+    return {
+        "uuid": uuid.uuid4(),
+        "type": "message",
+        "user": "system",
+        "channel": "bench",
+        "message": {"i": i},
+        "no_history": True,
+        "pm_users": [],
+        "exclude_users": [],
+        "catchup": False,
+        "edited": None,
+    }
+
+
+def run():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    reconnects = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    channel = Channel("bench", channel_config={"frames_size": frames})
+    for i in range(frames):
+        channel.add_message(make_message(i))
+    random.seed(1)
+    clients = []
+    for _ in range(reconnects):
+        received = random.randrange(frames // 2, frames - 1)
+        # heartbeat happened while next few messages were on their way
+        heartbeat = min(received + random.randint(0, 3), frames - 1)
+        last_active = channel.frames[heartbeat][0] + timedelta(microseconds=1)
+        clients.append((received, last_active))
+    print("{} frames, {} reconnects".format(frames, reconnects))
+    print(
+        "{:<12}{:>10}{:>14}{:>16}".format("method", "missed", "duplicated", "us/lookup")
+    )
+
+    for method in ("timestamp", "seq"):
+        missed = duplicated = 0
+        start = time.time()
+        for received, last_active in clients:
+            if method == "seq":
+                # seq of message i is i + 1
+                found = channel.get_frames_after_seq(received + 1, "client")
+            else:
+                found = channel.get_catchup_frames(last_active, "client")
+            indexes = [m["message"]["i"] for m in found]
+            expected = frames - received - 1
+            got = len([i for i in indexes if i > received])
+            missed += expected - got
+            duplicated += len(indexes) - got
+        elapsed = time.time() - start
+        print(
+            "{:<12}{:>10}{:>14}{:>16.1f}".format(
+                method, missed, duplicated, elapsed / reconnects * 1e6
+            )
+        )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,82 @@
+"""
+Compares channel frame/history storage strategies at 100k active channels.
+
+"list" appends and re-slices a list like channels did before,
+"ringbuffer" is channelstream.utils.RingBuffer used now.
+Reports appends per second and traced memory (current and peak).
+
+Usage:
+
+    python benchmarks/bench_ringbuffer.py [channels] [messages_per_channel]
+"""
+from __future__ import print_function
+
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+from channelstream.utils import RingBuffer
+
+FRAMES_SIZE = 100
+HISTORY_SIZE = 10
+
+
+class ListStorage(object):
+    def __init__(self):
+        self.frames = []
+        self.history = []
+
+    def add(self, message):
+        self.frames.append((datetime.utcnow(), message))
+        self.frames = self.frames[-FRAMES_SIZE:]
+        self.history.append(message)
+        self.history = self.history[HISTORY_SIZE * -1 :]
+
+
+class RingStorage(object):
+    def __init__(self):
+        self.frames = RingBuffer(maxlen=FRAMES_SIZE)
+        self.history = RingBuffer(maxlen=HISTORY_SIZE)
+
+    def add(self, message):
+        self.frames.append((datetime.utcnow(), message))
+        self.history.append(message)
+
+
+def bench(storage_cls, channels, messages):
+    message = {"type": "message", "message": {"text": "x"}}
+    tracemalloc.start()
+    storages = [storage_cls() for _ in range(channels)]
+    start = time.time()
+    for _ in range(messages):
+        for storage in storages:
+            storage.add(message)
+    elapsed = time.time() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return channels * messages / elapsed, current, peak
+
+
+def run():
+    channels = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 120
+    print(
+        "{} channels, {} messages each, frames={} history={}".format(
+            channels, messages, FRAMES_SIZE, HISTORY_SIZE
+        )
+    )
+    print(
+        "{:<12}{:>16}{:>16}{:>16}".format("storage", "appends/s", "MB now", "MB peak")
+    )
+    for name, storage_cls in (("list", ListStorage), ("ringbuffer", RingStorage)):
+        rate, current, peak = bench(storage_cls, channels, messages)
+        print(
+            "{:<12}{:>16.0f}{:>16.1f}{:>16.1f}".format(
+                name, rate, current / 1024.0 / 1024, peak / 1024.0 / 1024
+            )
+        )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,151 @@
+"""
+Warm restart from a snapshot: size, write time, startup time and memory.
+
+Live state of a million connected users doesn't fit on a small machine
+together with tracemalloc, so live state memory per user is measured on a
+sample of users built through the regular objects and captured with
+`snapshot.capture`. The full snapshot is generated in the same format -
+N users, each with one connection subscribed to one of 1000 channels.
+It is loaded into an empty state like a restarted server would and
+a sample of connections is reattached.
+
+Usage:
+
+    python benchmarks/bench_snapshot.py [users]
+"""
+from __future__ import print_function
+
+import gc
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+from six.moves import cPickle as pickle
+
+from channelstream import snapshot
+from channelstream.channel import Channel
+from channelstream.connection import Connection
+from channelstream.operations import find_connection
+from channelstream.server_state import get_state
+from channelstream.user import User
+
+CHANNELS = 1000
+SAMPLE_USERS = 10000
+REATTACHED = 10000
+
+
+def build_live(users):
+    state = get_state()
+    for c in range(CHANNELS):
+        name = "channel_{}".format(c)
+        state.channels[name] = Channel(name, channel_config={"store_history": True})
+    for i in range(users):
+        username = "user_{}".format(i)
+        user = User(username)
+        user.state_from_dict({"status": "online", "n": i})
+        user.state_public_keys = ["status"]
+        state.users[username] = user
+        connection = Connection(username, uuid.uuid4())
+        state.connections[connection.id] = connection
+        user.add_connection(connection)
+        state.channels["channel_{}".format(i % CHANNELS)].add_connection(connection)
+
+
+def generate(users):
+    """
+    Snapshot data of tenant in `snapshot.capture` format
+    """
+    channels = [
+        ("channel_{}".format(c), None, {"store_history": True}, [], 0)
+        for c in range(CHANNELS)
+    ]
+    protocol = pickle.HIGHEST_PROTOCOL
+    saved_users = []
+    connections = []
+    for i in range(users):
+        username = "user_{}".format(i)
+        user_state = ({"status": "online", "n": i}, ["status"])
+        saved_users.append((username, pickle.dumps(user_state, protocol)))
+        connections.append(
+            (uuid.uuid4().bytes, username, ("channel_{}".format(i % CHANNELS),))
+        )
+    return {"users": saved_users, "channels": channels, "connections": connections}
+
+
+def reset():
+    state = get_state()
+    state.channels = {}
+    state.users = {}
+    state.connections = {}
+    state.saved_connections = {}
+    gc.collect()
+
+
+def run():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    logging.disable(logging.INFO)
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "snapshot")
+    try:
+        tracemalloc.start()
+        build_live(SAMPLE_USERS)
+        live_memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        start = time.time()
+        sample = snapshot.capture(get_state())
+        print(
+            "live state {:.0f} bytes per user, captured {} users in {:.3f}s".format(
+                live_memory / SAMPLE_USERS, SAMPLE_USERS, time.time() - start
+            )
+        )
+        assert len(sample["connections"]) == SAMPLE_USERS
+        reset()
+
+        data = {"0": generate(users)}
+        conn_ids = [uuid.UUID(bytes=c[0]) for c in data["0"]["connections"]]
+        start = time.time()
+        size = snapshot.dump(data, path)
+        print(
+            "{} users: snapshot {:.1f} MB written in {:.2f}s".format(
+                users, size / 1e6, time.time() - start
+            )
+        )
+        del data
+        gc.collect()
+
+        tracemalloc.start()
+        start = time.time()
+        snapshot.load_snapshot(path)
+        elapsed = time.time() - start
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(
+            "startup load {:.2f}s (traced), holds {:.0f} MB, "
+            "{:.0f} bytes per user".format(elapsed, memory / 1e6, memory / users)
+        )
+        reset()
+        start = time.time()
+        snapshot.load_snapshot(path)
+        print("startup load {:.2f}s".format(time.time() - start))
+
+        sample = conn_ids[:: max(len(conn_ids) // REATTACHED, 1)]
+        start = time.time()
+        for conn_id in sample:
+            find_connection(conn_id)
+        elapsed = time.time() - start
+        print(
+            "reattached {} connections, {:.0f} per second".format(
+                len(sample), len(sample) / elapsed
+            )
+        )
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,175 @@
+"""
+Server-sent events vs long polling over HTTP: requests and server CPU.
+
+Starts a server in a subprocess, connects clients that either keep
+polling `/listen` with a cursor or keep one `/sse` stream open, and
+publishes messages to a channel they are all subscribed to. Reports HTTP
+requests made by clients, server CPU time (from /proc, Linux only) and mean
+delivery latency.
+
+Usage:
+
+    python benchmarks/bench_sse.py [clients] [messages]
+"""
+from __future__ import print_function
+
+from gevent import monkey
+
+monkey.patch_all()
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+import gevent
+import requests
+from itsdangerous import TimestampSigner
+
+PORT = 8398
+URL = "http://127.0.0.1:{}".format(PORT)
+INTERVAL = 0.1
+
+
+def post(session, path, payload):
+    signature = TimestampSigner("secret").sign("bench").decode("utf8")
+    response = session.post(
+        URL + path, json=payload, headers={"x-channelstream-secret": signature}
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def start_server():
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "from channelstream.cli import cli_start; cli_start()",
+            "--port",
+            str(PORT),
+            "--policy-server-port",
+            "0",
+            "--log-level",
+            "WARNING",
+        ],
+        stderr=subprocess.DEVNULL,
+    )
+    session = requests.Session()
+    for _ in range(100):
+        try:
+            post(session, "/info", {"info": {"channels": []}})
+            return server
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise RuntimeError("server did not start")
+
+
+def cpu_seconds(pid):
+    with open("/proc/{}/stat".format(pid)) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf("SC_CLK_TCK"))
+
+
+def record(latencies, messages):
+    now = time.time()
+    for message in messages:
+        latencies.append(now - message["message"]["sent"])
+
+
+def poll_client(conn_id, latencies, counters, done):
+    session = requests.Session()
+    cursor = 0
+    while not done:
+        response = session.get(
+            URL + "/listen", params={"conn_id": conn_id, "cursor": cursor}
+        )
+        counters["requests"] += 1
+        data = response.json()
+        cursor = data["cursor"]
+        record(latencies, data["messages"])
+
+
+def sse_client(conn_id, latencies, counters, done):
+    session = requests.Session()
+    response = session.get(URL + "/sse", params={"conn_id": conn_id}, stream=True)
+    counters["requests"] += 1
+    for line in response.iter_lines():
+        if done:
+            break
+        if line.startswith(b"data: "):
+            record(latencies, json.loads(line[6:].decode("utf8")))
+    response.close()
+
+
+def measure(client, clients, messages):
+    server = start_server()
+    session = requests.Session()
+    try:
+        conn_ids = [
+            post(
+                session,
+                "/connect",
+                {"username": "user_{}".format(i), "channels": ["bench"]},
+            )["conn_id"]
+            for i in range(clients)
+        ]
+        latencies = []
+        counters = {"requests": 0}
+        done = []
+        greenlets = [
+            gevent.spawn(client, conn_id, latencies, counters, done)
+            for conn_id in conn_ids
+        ]
+        gevent.sleep(1)
+        cpu = cpu_seconds(server.pid)
+        for i in range(messages):
+            post(
+                session,
+                "/message",
+                [
+                    {
+                        "type": "message",
+                        "user": "system",
+                        "channel": "bench",
+                        "message": {"i": i, "sent": time.time()},
+                    }
+                ],
+            )
+            gevent.sleep(INTERVAL)
+        gevent.sleep(1)
+        cpu = cpu_seconds(server.pid) - cpu
+        done.append(True)
+        gevent.killall(greenlets, timeout=1)
+        return (
+            counters["requests"],
+            cpu,
+            sum(latencies) / max(len(latencies), 1),
+            len(latencies),
+        )
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def run():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    print("{} clients, {} messages".format(clients, messages))
+    print(
+        "{:<10}{:>10}{:>14}{:>18}{:>12}".format(
+            "transport", "requests", "server cpu s", "mean latency ms", "delivered"
+        )
+    )
+    for name, client in (("listen", poll_client), ("sse", sse_client)):
+        requests_made, cpu, latency, delivered = measure(client, clients, messages)
+        print(
+            "{:<10}{:>10}{:>14.2f}{:>18.1f}{:>12}".format(
+                name, requests_made, cpu, latency * 1000, delivered
+            )
+        )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,141 @@
+"""
+Reconnect storm: presence traffic, catchup and event loop responsiveness.
+
+Members of a presence channel all drop at once, their connections get
+collected and every client reconnects with a new connection within
+a couple of seconds, resuming a few dozen messages behind. Runs with storm
+mode disabled and enabled. Reports presence messages written, the longest
+stall of a probe greenlet that wakes up every 5ms and how long it took
+until every client got its catchup.
+
+Usage:
+
+    python benchmarks/bench_storm.py [members] [reconnect seconds]
+"""
+from __future__ import print_function
+
+import logging
+import sys
+import time
+import uuid
+
+import gevent
+
+from channelstream import operations, storm
+from channelstream.gc import collect_connection
+from channelstream.server_state import get_state, MessageRate
+
+BEHIND = 50
+TICK = 0.01
+
+
+class CountingSocket(object):
+    terminated = False
+
+    def __init__(self):
+        self.presence = 0
+        self.catchup = 0
+
+    def send(self, payload):
+        self.presence += payload.count('"type":"presence"')
+        self.catchup += payload.count('"catchup":true')
+
+
+def connect(username):
+    connection, _ = operations.connect(
+        username=username,
+        conn_id=uuid.uuid4(),
+        channels=["bench"],
+        channel_configs={"bench": {"notify_presence": True, "frames_size": 200}},
+        fresh_user_state={},
+        update_user_state={},
+    )
+    connection.max_send_queue = sys.maxsize
+    socket = CountingSocket()
+    connection.attach_socket(socket)
+    return connection, socket
+
+
+def probe(stalls, done):
+    while not done:
+        start = time.time()
+        gevent.sleep(0.005)
+        stalls.append(time.time() - start - 0.005)
+
+
+def measure(threshold, members, seconds):
+    server_state = get_state()
+    server_state.users = {}
+    server_state.connections = {}
+    server_state.channels = {}
+    server_state.storm_reconnects_per_second = threshold
+    server_state.reconnect_rate = MessageRate()
+    server_state.storm_until = 0
+    connections = [connect("user_{}".format(i))[0] for i in range(members)]
+    channel = server_state.channels["bench"]
+    for i in range(BEHIND):
+        channel.add_message(
+            {
+                "uuid": uuid.uuid4(),
+                "type": "message",
+                "user": "system",
+                "channel": "bench",
+                "message": {"text": "x" * 100, "i": i},
+                "no_history": True,
+                "pm_users": [],
+                "exclude_users": [],
+                "catchup": False,
+            }
+        )
+    gevent.sleep(0.1)
+    resume = {"bench": channel.seq - BEHIND}
+    # everything drops, GC collects old connections as clients come back
+    stalls = []
+    done = []
+    prober = gevent.spawn(probe, stalls, done)
+    sockets = []
+    per_tick = max(int(members / (seconds / TICK)), 1)
+    start = time.time()
+    for i, old in enumerate(connections):
+        collect_connection(old)
+        connection, socket = connect(old.username)
+        sockets.append(socket)
+        storm.record_reconnect()
+        storm.deliver_catchup(connection, resume=resume)
+        if i % per_tick == per_tick - 1:
+            gevent.sleep(TICK)
+    while sum(socket.catchup for socket in sockets) < members * BEHIND:
+        gevent.sleep(0.01)
+    elapsed = time.time() - start
+    # parted messages held back during storm go out after grace period
+    channel.expire_parting(now=time.time() + server_state.storm_grace)
+    gevent.sleep(0.1)
+    done.append(True)
+    prober.join()
+    for socket in sockets:
+        socket.terminated = True
+    presence = sum(socket.presence for socket in sockets)
+    return presence, max(stalls), elapsed
+
+
+def run():
+    members = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 2
+    logging.disable(logging.INFO)
+    print("{} members reconnecting over {}s".format(members, seconds))
+    print(
+        "{:<10}{:>14}{:>18}{:>16}".format(
+            "storm", "presence msgs", "max stall ms", "catchup done s"
+        )
+    )
+    for name, threshold in (("disabled", 0), ("enabled", 20)):
+        presence, stall, elapsed = measure(threshold, members, seconds)
+        print(
+            "{:<10}{:>14}{:>18.1f}{:>16.2f}".format(
+                name, presence, stall * 1000, elapsed
+            )
+        )
+
+
+if __name__ == "__main__":
+    run()
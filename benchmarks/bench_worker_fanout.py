@@ -0,0 +1,127 @@
+"""
+Broadcast cost of one worker out of N.
+
+Every worker keeps a full replica of connections, but only 1/N of them have
+their socket attached to it, the rest are attached to other workers. Runs
+broadcasts in one process set up like such worker and reports broadcasts per
+second of CPU time when fan-out walks every subscribed connection (previous
+behaviour) and when it walks only the locally attached ones. Every worker
+handles every broadcast, with a core per worker they do it in parallel and
+all connections get broadcasts at the rate of one worker, reported as
+projected deliveries per second.
+
+Usage:
+
+    python benchmarks/bench_worker_fanout.py [workers,...] [connections] [broadcasts]
+"""
+from __future__ import print_function
+
+import logging
+import os
+import sys
+import time
+import uuid
+
+import gevent
+from ws4py.messaging import TextMessage
+
+from channelstream import operations
+from channelstream.server_state import get_state
+
+REPEAT = 5
+cpu_time = getattr(time, "process_time", None) or time.clock
+
+
+class CountingSocket(object):
+    terminated = False
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.frames = 0
+
+    def send(self, payload):
+        os.write(self.fd, TextMessage(payload).single())
+        self.frames += 1
+
+
+def measure(workers, connections, broadcasts, full_replica, fd):
+    server_state = get_state()
+    server_state.users = {}
+    server_state.connections = {}
+    server_state.channels = {}
+    sockets = []
+    for i in range(connections):
+        connection, _ = operations.connect(
+            username="user_{}".format(i),
+            conn_id=uuid.uuid4(),
+            channels=["bench"],
+            channel_configs={},
+        )
+        if i % workers == 0:
+            socket = CountingSocket(fd)
+            connection.attach_socket(socket)
+            sockets.append(socket)
+        else:
+            operations.attached_remotely(connection.id)
+    channel = server_state.channels["bench"]
+    if full_replica:
+        channel.attached = channel.connections
+    gevent.sleep(0.1)
+    start = cpu_time()
+    for i in range(broadcasts):
+        operations.pass_message(
+            {
+                "uuid": uuid.uuid4(),
+                "type": "message",
+                "user": "system",
+                "channel": "bench",
+                "message": {"text": "x" * 100, "i": i},
+                "no_history": True,
+                "pm_users": [],
+                "exclude_users": [],
+            },
+            server_state.stats,
+        )
+        gevent.sleep(0)
+    while sum(socket.frames for socket in sockets) < len(sockets) * broadcasts:
+        gevent.sleep(0.001)
+    elapsed = cpu_time() - start
+    for socket in sockets:
+        socket.terminated = True
+    return broadcasts / elapsed
+
+
+def run():
+    worker_counts = [
+        int(w) for w in (sys.argv[1] if len(sys.argv) > 1 else "1,2,4,8").split(",")
+    ]
+    connections = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    broadcasts = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+    logging.disable(logging.INFO)
+    fd = os.open(os.devnull, os.O_WRONLY)
+    print("{} connections, {} broadcasts".format(connections, broadcasts))
+    print(
+        "{:<9}{:<10}{:>16}{:>26}{:>10}".format(
+            "workers", "fan-out", "broadcasts/s", "projected deliveries/s", "scaling"
+        )
+    )
+    baseline = None
+    for workers in worker_counts:
+        for name, full_replica in (("every", True), ("attached", False)):
+            rates = sorted(
+                measure(workers, connections, broadcasts, full_replica, fd)
+                for _ in range(REPEAT)
+            )
+            rate = rates[REPEAT // 2]
+            deliveries = rate * connections
+            if baseline is None:
+                baseline = deliveries
+            print(
+                "{:<9}{:<10}{:>16.1f}{:>26.0f}{:>10.2f}".format(
+                    workers, name, rate, deliveries, deliveries / baseline
+                )
+            )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,177 @@
+"""
+Broadcast throughput of `channelstream --workers N`.
+
+Starts the server with every requested worker count, connects websocket
+clients (spread over several client processes) to one channel, posts
+messages through the API and measures how fast all of them reach every
+client. Reports deliveries (messages x clients) per second.
+
+Client processes compete with workers for CPU, run it on a machine with
+more cores than the largest worker count to see scaling.
+
+Usage:
+
+    python benchmarks/bench_workers.py [workers,...] [clients] [messages]
+
+    python benchmarks/bench_workers.py 1,2,4,8 2000 200
+"""
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+import time
+
+PORT = 8765
+SECRET = "bench_secret"
+CLIENT_PROCESSES = max((os.cpu_count() or 2) // 2, 1)
+BATCH = 20
+
+
+def run_client(port, expected, conn_ids):
+    """
+    Client process, prints `ready` when sockets are open and
+    `done <timestamp>` when all messages arrived on every socket
+    """
+    from gevent import monkey
+
+    monkey.patch_all()
+    import gevent
+    import json
+    from ws4py.client.geventclient import WebSocketClient
+
+    received = {"count": 0, "last": 0.0}
+    total = expected * len(conn_ids)
+
+    def listen(conn_id):
+        ws = WebSocketClient("ws://127.0.0.1:{}/ws?conn_id={}".format(port, conn_id))
+        ws.connect()
+        return ws
+
+    def consume(ws):
+        while True:
+            frame = ws.receive()
+            if frame is None:
+                return
+            received["count"] += len(json.loads(frame.data))
+            received["last"] = time.time()
+
+    sockets = [listen(conn_id) for conn_id in conn_ids]
+    print("ready", flush=True)
+    for ws in sockets:
+        gevent.spawn(consume, ws)
+    deadline = time.time() + 120
+    while received["count"] < total and time.time() < deadline:
+        gevent.sleep(0.05)
+    print("done {} {}".format(received["last"], received["count"]), flush=True)
+
+
+def post(path, payload):
+    import requests
+    from itsdangerous import TimestampSigner
+
+    signature = TimestampSigner(SECRET).sign("bench").decode("utf8")
+    response = requests.post(
+        "http://127.0.0.1:{}{}".format(PORT, path),
+        json=payload,
+        headers={"x-channelstream-secret": signature, "Connection": "close"},
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def start_server(workers):
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "from channelstream.cli import cli_start; cli_start()",
+            "--workers",
+            str(workers),
+            "--port",
+            str(PORT),
+            "--secret",
+            SECRET,
+            "--log-level",
+            "WARNING",
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    for _ in range(100):
+        try:
+            post("/info", {"info": {"channels": []}})
+            return server
+        except Exception:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError("server did not start")
+
+
+def bench(workers, clients, messages):
+    server = start_server(workers)
+    try:
+        conn_ids = [
+            post("/connect", {"username": "user_{}".format(i), "channels": ["b"]})[
+                "conn_id"
+            ]
+            for i in range(clients)
+        ]
+        procs = []
+        for i in range(CLIENT_PROCESSES):
+            chunk = conn_ids[i::CLIENT_PROCESSES]
+            proc = subprocess.Popen(
+                [sys.executable, __file__, "client", str(PORT), str(messages)] + chunk,
+                stdout=subprocess.PIPE,
+                universal_newlines=True,
+            )
+            procs.append(proc)
+        for proc in procs:
+            assert proc.stdout.readline().strip() == "ready"
+
+        message = {
+            "type": "message",
+            "user": "system",
+            "channel": "b",
+            "message": {"text": "x" * 200},
+        }
+        start = time.time()
+        for _ in range(messages // BATCH):
+            post("/message", [message] * BATCH)
+        finished = []
+        for proc in procs:
+            _, last, count = proc.stdout.readline().split()
+            finished.append(float(last))
+            proc.wait()
+        elapsed = max(finished) - start
+        return clients * (messages // BATCH) * BATCH / elapsed
+    finally:
+        server.terminate()
+        server.wait()
+        time.sleep(0.5)
+
+
+def run():
+    worker_counts = [
+        int(w) for w in (sys.argv[1] if len(sys.argv) > 1 else "1,2,4,8").split(",")
+    ]
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    messages = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    print(
+        "{} clients in {} processes, {} messages, {} cpus".format(
+            clients, CLIENT_PROCESSES, messages, os.cpu_count()
+        )
+    )
+    print("{:<10}{:>20}{:>12}".format("workers", "deliveries/s", "scaling"))
+    baseline = None
+    for workers in worker_counts:
+        rate = bench(workers, clients, messages)
+        baseline = baseline or rate
+        print("{:<10}{:>20.0f}{:>12.2f}".format(workers, rate, rate / baseline))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "client":
+        run_client(int(sys.argv[2]), int(sys.argv[3]), sys.argv[4:])
+    else:
+        run()
@@ -0,0 +1,252 @@
+"""
+Message bus between worker processes.
+
+Every worker keeps a full replica of channels, users and connections,
+only sockets are local. A worker that handles an API request applies the
+operation locally and publishes it, other workers apply the same operation
+to their replicas and deliver the result to sockets they hold.
+
+Workers are connected with a mesh of unix socket pairs created before
+forking, frames are length prefixed pickles - peers are trusted processes
+of the same server. Links to other hosts (see channelstream.cluster) carry
+JSON instead, so a forged frame can't run code, sign every frame with shared
+secret and drop the link on a bad signature.
+"""
+import hashlib
+import hmac
+import json
+import logging
+import socket
+import struct
+import uuid
+from datetime import datetime
+
+import gevent
+from gevent.event import Event
+from six.moves import cPickle as pickle
+
+log = logging.getLogger(__name__)
+
+HEADER = struct.Struct("!I")
+DIGEST_SIZE = hashlib.sha256().digest_size
+# links announcing bigger frames are dropped
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# operation name -> callable applying it to local replica
+HANDLERS = {}
+
+# bus of current worker, None when running single process
+BUS = None
+
+
+def register(op, handler):
+    """
+    Registers function that applies replicated operation
+    :param op: operation name
+    :param handler:
+    :return:
+    """
+    HANDLERS[op] = handler
+
+
+def publish(op, *args, **kwargs):
+    """
+    Sends operation to all other workers, does nothing without a bus
+    :param op: registered operation name
+    :return:
+    """
+    if BUS is not None:
+        BUS.publish(op, args, kwargs)
+
+
+def worker_id():
+    return BUS.worker_id if BUS is not None else None
+
+
+def encode_wire(obj):
+    """
+    Tags values JSON has no type for so they are restored on the other side,
+    aware datetimes are sent as naive UTC
+    """
+    if isinstance(obj, uuid.UUID):
+        return {"__uuid__": obj.hex}
+    if isinstance(obj, datetime):
+        if obj.utcoffset() is not None:
+            obj = obj.replace(tzinfo=None) - obj.utcoffset()
+        return {
+            "__datetime__": [
+                obj.year,
+                obj.month,
+                obj.day,
+                obj.hour,
+                obj.minute,
+                obj.second,
+                obj.microsecond,
+            ]
+        }
+    if isinstance(obj, set):
+        return list(obj)
+    raise TypeError("{!r} can't be sent to other nodes".format(obj))
+
+
+def decode_wire(obj):
+    """
+    Restores values tagged by encode_wire, dicts that only look like tagged
+    values are left alone
+    """
+    if len(obj) == 1:
+        try:
+            if "__uuid__" in obj:
+                return uuid.UUID(obj["__uuid__"])
+            if "__datetime__" in obj:
+                return datetime(*obj["__datetime__"])
+        except (TypeError, ValueError):
+            pass
+    return obj
+
+
+def pack(op, args, kwargs, secret=None):
+    """
+    Serializes operation into a frame
+
+    :param op:
+    :param args:
+    :param kwargs:
+    :param secret: signs frame when set, signed frames are JSON
+    :return:
+    """
+    if secret is None:
+        payload = pickle.dumps((op, args, kwargs), pickle.HIGHEST_PROTOCOL)
+    else:
+        payload = json.dumps(
+            [op, args, kwargs], default=encode_wire, separators=(",", ":")
+        ).encode("utf8")
+        payload = hmac.new(secret, payload, hashlib.sha256).digest() + payload
+    return HEADER.pack(len(payload)) + payload
+
+
+def dispatch(operation, handlers=None):
+    """
+    Applies decoded operation to local replica
+
+    :param operation: (op, args, kwargs)
+    :param handlers: defaults to HANDLERS
+    :return:
+    """
+    op, args, kwargs = operation
+    try:
+        (HANDLERS if handlers is None else handlers)[op](*args, **kwargs)
+    except Exception:
+        log.exception("Failed to apply replicated operation {}".format(op))
+
+
+def make_mesh(workers):
+    """
+    Creates socket pairs connecting every worker with every other worker
+
+    :param workers: number of workers
+    :return: list with {peer_worker_id: socket} for every worker
+    """
+    mesh = [{} for _ in range(workers)]
+    for i in range(workers):
+        for j in range(i + 1, workers):
+            left, right = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+            mesh[i][j] = left
+            mesh[j][i] = right
+    return mesh
+
+
+class Peer(object):
+    """
+    Connection to another worker, outgoing frames are buffered and written
+    in batches by a writer greenlet so publishing never blocks the caller
+    """
+
+    def __init__(self, peer_id, sock, secret=None, handlers=None):
+        """
+
+        :param peer_id:
+        :param sock:
+        :param secret: bytes, incoming frames must be signed with it
+        :param handlers: operation handlers, defaults to HANDLERS
+        """
+        self.peer_id = peer_id
+        self.sock = sock
+        self.secret = secret
+        self.handlers = handlers
+        self.outgoing = []
+        self.send_event = Event()
+
+    def send(self, frame):
+        self.outgoing.append(frame)
+        self.send_event.set()
+
+    def write_frames(self):
+        while True:
+            self.send_event.wait()
+            self.send_event.clear()
+            frames, self.outgoing = self.outgoing, []
+            if frames:
+                self.sock.sendall(b"".join(frames))
+
+    def unpack(self, payload):
+        """
+        Decodes operation from payload, None if signature or JSON is bad
+        """
+        if self.secret is None:
+            return pickle.loads(payload)
+        digest, frame = payload[:DIGEST_SIZE], payload[DIGEST_SIZE:]
+        expected = hmac.new(self.secret, frame, hashlib.sha256).digest()
+        if not hmac.compare_digest(digest, expected):
+            return None
+        try:
+            op, args, kwargs = json.loads(frame.decode("utf8"), object_hook=decode_wire)
+        except (TypeError, ValueError):
+            return None
+        return op, args, kwargs
+
+    def read_frames(self):
+        buf = b""
+        while True:
+            data = self.sock.recv(65536)
+            if not data:
+                log.warning("peer {} went away".format(self.peer_id))
+                return
+            buf += data
+            offset = 0
+            while len(buf) - offset >= HEADER.size:
+                (size,) = HEADER.unpack_from(buf, offset)
+                if size > MAX_FRAME_SIZE:
+                    log.warning("oversized frame from {}".format(self.peer_id))
+                    return
+                end = offset + HEADER.size + size
+                if len(buf) < end:
+                    break
+                operation = self.unpack(buf[offset + HEADER.size : end])
+                if operation is None:
+                    log.warning("bad frame from {}".format(self.peer_id))
+                    return
+                dispatch(operation, self.handlers)
+                offset = end
+            buf = buf[offset:]
+
+
+class WorkerBus(object):
+    def __init__(self, worker_id, peer_sockets):
+        """
+
+        :param worker_id: index of this worker
+        :param peer_sockets: {peer_worker_id: socket} from make_mesh()
+        """
+        self.worker_id = worker_id
+        self.peers = [Peer(peer_id, sock) for peer_id, sock in peer_sockets.items()]
+
+    def publish(self, op, args, kwargs):
+        frame = pack(op, args, kwargs)
+        for peer in self.peers:
+            peer.send(frame)
+
+    def start(self):
+        for peer in self.peers:
+            gevent.spawn(peer.write_frames)
+            gevent.spawn(peer.read_frames)
@@ -1,12 +1,17 @@
-import copy
 import logging
+import time
 import uuid
+from collections import OrderedDict
 from datetime import datetime
 
+import gevent
 import six
 
-from channelstream.server_state import get_state
-from channelstream.utils import process_catchup
+from channelstream import cluster, storage, storm
+from channelstream import patched_json as json
+from channelstream.envelope import Envelope
+from channelstream.server_state import get_state, DEFAULT_TENANT
+from channelstream.utils import frames_after_seq, frames_since, RingBuffer
 from channelstream.validation import MSG_EDITABLE_KEYS
 
 log = logging.getLogger(__name__)
@@ -22,20 +27,34 @@ class Channel(object):
         "broadcast_presence_with_user_lists",
         "notify_state",
         "store_frames",
+        "frames_size",
+        "overflow_policy",
+        "coalesce_ms",
+        "coalesce_messages",
+        "presence_deltas",
+        "presence_window_ms",
+        "presence_snapshot_interval",
     ]
 
-    def __init__(self, name, long_name=None, channel_config=None):
+    def __init__(
+        self, name, long_name=None, channel_config=None, tenant_id=DEFAULT_TENANT
+    ):
         """
 
         :param name:
         :param long_name:
         :param channel_config:
+        :param tenant_id:
         """
         self.uuid = uuid.uuid4()
         self.name = name
+        self.tenant_id = tenant_id
         self.long_name = long_name
         self.last_active = None
         self.connections = {}
+        # username -> connections whose socket or poll buffer is held by
+        # this worker, messages are fanned out only to these
+        self.attached = {}
         self.notify_presence = False
         self.broadcast_presence_with_user_lists = False
         # channel sends all user state key changes
@@ -43,13 +62,43 @@ class Channel(object):
         self.salvageable = False
         self.store_history = False
         self.store_frames = True
-        self.history_size = 10
-        self.history = []
+        # what happens when subscriber can't keep up with messages
+        self.overflow_policy = "drop_oldest"
+        # subscribers get messages merged into one frame per window,
+        # 0 sends every message right away
+        self.coalesce_ms = 0
+        self.coalesce_messages = 0
+        # presence goes out as batched joined/parted deltas instead of
+        # a message per event, joining connections get the full user list
+        self.presence_deltas = False
+        self.presence_window_ms = 50
+        # seconds between full user lists sent along with deltas, 0 disables
+        self.presence_snapshot_interval = 0
+        self.presence_joined = OrderedDict()
+        self.presence_parted = OrderedDict()
+        self.presence_connections = []
+        self.presence_timer = None
+        self.presence_snapshot_at = time.time()
+        # username -> deadline of users who left during reconnect storm,
+        # they are announced as parted unless they come back before it
+        self.parting = OrderedDict()
+        self.parting_timer = None
+        # bumped whenever membership, config or history change,
+        # info built for a version is reused until the next bump
+        self.info_version = 0
+        self.info_cache = {}
+        # history lives in tenant log when durable storage is enabled
+        self.log = storage.get_log(tenant_id)
+        self.history = storage.history_buffer(self.log, name, 10)
         # store frames for fetching when connection is established
         # those frames will store channel messages including presence ones
-        self.frames = []
+        self.frames = RingBuffer(maxlen=100)
+        # sequence number of last message sent to the channel
+        self.seq = 0
         if channel_config:
             self.reconfigure_from_dict(channel_config)
+        else:
+            self.persist_config()
         log.info("%s created" % self)
         log.info("Configuration used: {}".format(channel_config))
         self.mark_activity()
@@ -57,34 +106,100 @@ class Channel(object):
     def mark_activity(self):
         self.last_active = datetime.utcnow()
 
+    @property
+    def history_size(self):
+        return self.history.maxlen
+
+    @history_size.setter
+    def history_size(self, value):
+        if value != self.history.maxlen:
+            self.history = self.history.resized(value)
+            self.info_changed()
+
+    @property
+    def frames_size(self):
+        return self.frames.maxlen
+
+    @frames_size.setter
+    def frames_size(self, value):
+        if value != self.frames.maxlen:
+            self.frames = self.frames.resized(value)
+
     def get_catchup_frames(self, newer_than, username):
         found = []
-        for t, f in self.frames:
-            # either old frame or user is excluded or PM not meant for user
-            if (
-                t < newer_than
-                or (f["exclude_users"] and username in f["exclude_users"])
-                or (f["pm_users"] and username not in f["pm_users"])
-            ):
-                continue
-
-            found.append(process_catchup(f))
+        for t, f, envelope in frames_since(self.frames, newer_than):
+            # user is excluded or PM not meant for user
+            if envelope.delivers_to(username):
+                found.append(envelope.catchup_payload)
         return found
 
+    def get_frames_after_seq(self, seq, username):
+        """
+        Catchup frames client is missing after message `seq`, sequence
+        number from the future (channel was recreated) gets every frame
+
+        :param seq:
+        :param username:
+        :return: list of catchup payloads
+        """
+        if seq > self.seq:
+            seq = 0
+        return [
+            envelope.catchup_payload
+            for t, f, envelope in frames_after_seq(self.frames, seq)
+            if envelope.delivers_to(username)
+        ]
+
+    def next_seq(self):
+        self.seq += 1
+        return self.seq
+
+    @property
+    def settings(self):
+        return {k: getattr(self, k) for k in self.config_keys}
+
     def reconfigure_from_dict(self, config):
         if config:
             for key in self.config_keys:
                 val = config.get(key)
                 if val is not None:
                     setattr(self, key, val)
+            self.info_changed()
+            self.persist_config()
+
+    def info_changed(self):
+        self.info_version += 1
+        self.info_cache = {}
+
+    def persist_config(self):
+        if self.log:
+            self.log.channel_config(self.name, self.long_name, self.settings)
 
     def add_connection(self, connection):
         username = connection.username
         connections = self.connections.setdefault(username, [])
-        if not connections and self.notify_presence:
+        notify = (
+            not connections
+            and self.notify_presence
+            and not cluster.is_remote_member(self.tenant_id, self.name, username)
+        )
+        if notify and self.parting.pop(username, None) is not None:
+            # nobody was told user left
+            get_state(self.tenant_id).stats["suppressed_presence"] += 2
+            notify = False
+        if notify and not self.presence_deltas:
             self.send_notify_presence_info(username, "joined")
         if connection not in connections:
             connections.append(connection)
+            connection.channel_names.add(self.name)
+            self.track_attachment(connection)
+            self.info_changed()
+            cluster.membership_changed(
+                self.tenant_id, self.name, username, len(connections)
+            )
+            if self.notify_presence and self.presence_deltas:
+                self.presence_connections.append(connection)
+                self.queue_presence(username, "joined" if notify else None)
             return True
         return False
 
@@ -95,10 +210,41 @@ class Channel(object):
         if connection in connections:
             self.connections[username].remove(connection)
             was_found = True
+            self.info_changed()
+        connection.channel_names.discard(self.name)
+        self.track_attachment(connection)
 
         self.after_parted(username)
+        if was_found:
+            cluster.membership_changed(
+                self.tenant_id,
+                self.name,
+                username,
+                len(self.connections.get(username, [])),
+            )
         return was_found
 
+    def track_attachment(self, connection):
+        """
+        Keeps connection in `attached` index only while it is subscribed
+        and attached to this worker
+
+        :param connection:
+        :return:
+        """
+        username = connection.username
+        attached = self.attached.get(username, [])
+        subscribed = connection in self.connections.get(username, ())
+        if subscribed and connection.attached_locally:
+            if connection not in attached:
+                self.attached[username] = attached + [connection]
+        elif connection in attached:
+            attached = [conn for conn in attached if conn is not connection]
+            if attached:
+                self.attached[username] = attached
+            else:
+                del self.attached[username]
+
     def after_parted(self, username):
         """
         Sends parted message if necessary and removed username from
@@ -109,8 +255,195 @@ class Channel(object):
         """
         if not self.connections[username]:
             del self.connections[username]
-            if self.notify_presence:
-                self.send_notify_presence_info(username, "parted")
+            if self.notify_presence and not cluster.is_remote_member(
+                self.tenant_id, self.name, username
+            ):
+                server_state = get_state(self.tenant_id)
+                if storm.storm_active(server_state):
+                    self.defer_parted(username, server_state.storm_grace)
+                else:
+                    self.notify_parted(username)
+
+    def notify_parted(self, username):
+        if self.presence_deltas:
+            self.queue_presence(username, "parted")
+        else:
+            self.send_notify_presence_info(username, "parted")
+
+    def defer_parted(self, username, grace):
+        """
+        Announces user as parted after grace period unless
+        they come back before that
+
+        :param username:
+        :param grace: seconds
+        :return:
+        """
+        # deadlines stay in order
+        self.parting.pop(username, None)
+        self.parting[username] = time.time() + grace
+        if self.parting_timer is None:
+            self.parting_timer = gevent.spawn_later(grace, self.expire_parting_locked)
+
+    def expire_parting_locked(self):
+        server_state = get_state(self.tenant_id)
+        with server_state.channel_lock(self.name):
+            self.expire_parting()
+
+    def expire_parting(self, now=None):
+        """
+        Sends parted messages for users whose grace period is over
+
+        :param now: timestamp, defaults to current time
+        :return: list of parted usernames
+        """
+        self.parting_timer = None
+        now = time.time() if now is None else now
+        parted = []
+        while self.parting:
+            username, deadline = next(iter(self.parting.items()))
+            if deadline > now:
+                self.parting_timer = gevent.spawn_later(
+                    deadline - now, self.expire_parting_locked
+                )
+                break
+            del self.parting[username]
+            if username not in self.connections and not cluster.is_remote_member(
+                self.tenant_id, self.name, username
+            ):
+                self.notify_parted(username)
+                parted.append(username)
+        return parted
+
+    def presence_users(self):
+        """
+        Public states of users connected to the channel here and on other
+        cluster nodes
+
+        :return: list of user dicts
+        """
+        server_state = get_state(self.tenant_id)
+        connected_users = []
+        for _username in self.connections.keys():
+            user_inst = server_state.users.get(_username)
+            user_data = {"user": user_inst.username, "state": user_inst.public_state}
+            connected_users.append(user_data)
+        remote_members = cluster.remote_members(self.tenant_id, self.name)
+        for _username, (_, state) in sorted(remote_members.items()):
+            if _username not in self.connections:
+                connected_users.append({"user": _username, "state": state})
+        return connected_users
+
+    def queue_presence(self, username, action):
+        """
+        Records presence change for next delta, user that joins and parts
+        within one window cancels out
+
+        :param username:
+        :param action: joined, parted or None when only a new connection
+            needs the user list
+        :return:
+        """
+        if action == "joined":
+            if self.presence_parted.pop(username, None) is None:
+                self.presence_joined[username] = True
+        elif action == "parted":
+            if self.presence_joined.pop(username, None) is None:
+                self.presence_parted[username] = True
+        if not self.presence_window_ms:
+            self.flush_presence()
+        elif self.presence_timer is None:
+            self.presence_timer = gevent.spawn_later(
+                self.presence_window_ms / 1000.0, self.flush_presence_locked
+            )
+
+    def flush_presence_locked(self):
+        server_state = get_state(self.tenant_id)
+        with server_state.channel_lock(self.name):
+            self.flush_presence()
+
+    def flush_presence(self):
+        """
+        Sends presence changes queued since last flush as one delta message,
+        connections that joined in the meantime get the user list instead
+
+        :return: delta payload or None
+        """
+        server_state = get_state(self.tenant_id)
+        self.presence_timer = None
+        joined = list(self.presence_joined)
+        parted = list(self.presence_parted)
+        new_connections = [
+            c for c in self.presence_connections if self.name in c.channel_names
+        ]
+        self.presence_joined = OrderedDict()
+        self.presence_parted = OrderedDict()
+        self.presence_connections = []
+        now = time.time()
+        snapshot_due = (
+            self.presence_snapshot_interval
+            and now - self.presence_snapshot_at >= self.presence_snapshot_interval
+        )
+        connected_users = []
+        if new_connections or snapshot_due:
+            connected_users = self.presence_users()
+        self.mark_activity()
+        payload = None
+        if joined or parted:
+            joined_users = []
+            for username in joined:
+                user_inst = server_state.users.get(username)
+                if user_inst is not None:
+                    joined_users.append(
+                        {"user": username, "state": user_inst.public_state}
+                    )
+            payload = {
+                "uuid": uuid.uuid4(),
+                "type": "presence",
+                "no_history": False,
+                "pm_users": [],
+                # joining users get the user list
+                "exclude_users": joined,
+                "user": None,
+                "users": connected_users if snapshot_due else [],
+                "timestamp": self.last_active,
+                "channel": self.name,
+                "message": {
+                    "action": "delta",
+                    "joined": joined_users,
+                    "parted": parted,
+                },
+                "state": None,
+                "catchup": False,
+            }
+            if snapshot_due:
+                self.presence_snapshot_at = now
+            self.add_message(payload, exclude_users=payload["exclude_users"])
+            cluster.relay(
+                "cluster_channel_message", self.tenant_id, self.name, self.name, payload
+            )
+        if new_connections:
+            snapshot = {
+                "uuid": uuid.uuid4(),
+                "type": "presence",
+                "user": None,
+                "users": connected_users,
+                "timestamp": self.last_active,
+                "channel": self.name,
+                "message": {"action": "snapshot"},
+                "state": None,
+                "catchup": False,
+            }
+            encoded = json.dumps([snapshot])
+            for connection in new_connections:
+                connection.add_message(
+                    snapshot,
+                    encoded=encoded,
+                    overflow_policy=self.overflow_policy,
+                    coalesce_ms=self.coalesce_ms,
+                    coalesce_messages=self.coalesce_messages,
+                )
+        return payload
 
     def send_notify_presence_info(self, username, action):
         """
@@ -119,16 +452,10 @@ class Channel(object):
         :param action:
         :return:
         """
-        server_state = get_state()
+        server_state = get_state(self.tenant_id)
         connected_users = []
         if self.broadcast_presence_with_user_lists:
-            for _username in self.connections.keys():
-                user_inst = server_state.users.get(_username)
-                user_data = {
-                    "user": user_inst.username,
-                    "state": user_inst.public_state,
-                }
-                connected_users.append(user_data)
+            connected_users = self.presence_users()
 
         self.mark_activity()
         payload = {
@@ -148,6 +475,9 @@ class Channel(object):
         if action == "joined":
             payload["state"] = server_state.users[username].public_state
         self.add_message(payload, exclude_users=payload["exclude_users"])
+        cluster.relay(
+            "cluster_channel_message", self.tenant_id, self.name, self.name, payload
+        )
         return payload
 
     def send_user_state(self, user_inst, changed):
@@ -168,95 +498,203 @@ class Channel(object):
             "message": {"state": user_inst.public_state, "changed": public_changed},
         }
         self.add_message(payload)
+        cluster.relay(
+            "cluster_channel_message", self.tenant_id, self.name, self.name, payload
+        )
         return payload
 
-    def add_frame(self, frame):
+    def add_frame(self, frame, envelope=None):
         if self.store_frames:
-            self.frames.append((datetime.utcnow(), frame))
-            self.frames = self.frames[-100:]
+            # envelope holds catchup representation that is prepared once
+            if envelope is None:
+                envelope = Envelope(frame, seq=self.next_seq())
+            entry = (datetime.utcnow(), frame, envelope)
+            self.frames.append(entry)
+            if self.log:
+                self.log.add_frame(storage.CHANNEL, self.name, entry)
 
     def add_to_history(self, message):
         if self.store_history and message["type"] == "message":
             self.history.append(message)
-            self.history = self.history[self.history_size * -1 :]
+            self.info_changed()
 
     def add_message(self, message, pm_users=None, exclude_users=None):
         """
         Sends the message to all connections subscribed to this channel
         """
-        pm_users = pm_users or []
-        exclude_users = exclude_users or []
+        started = time.time()
+        # envelope does not leak delivery info to clients
+        envelope = Envelope(
+            message, pm_users=pm_users, exclude_users=exclude_users, seq=self.next_seq()
+        )
         self.mark_activity()
         if not message["no_history"]:
             self.add_to_history(message)
-        self.add_frame(message)
-        message = copy.deepcopy(message)
-        # do not leak delivery info
-        del message["no_history"]
-        del message["pm_users"]
-        del message["exclude_users"]
+        self.add_frame(message, envelope)
+        # serialize once, every websocket gets the same frame
+        encoded = envelope.encode()
         total_sent = 0
-        # message everyone subscribed except excluded
-        for user, conns in six.iteritems(self.connections):
-            if not exclude_users or user not in exclude_users:
+        # message everyone attached here except excluded,
+        # other workers deliver to their own connections
+        for user, conns in six.iteritems(self.attached):
+            if envelope.delivers_to(user):
                 for connection in conns:
-                    if not pm_users or connection.username in pm_users:
-                        connection.add_message(message)
-                        total_sent += 1
+                    connection.add_message(
+                        envelope.payload,
+                        encoded=encoded,
+                        overflow_policy=self.overflow_policy,
+                        coalesce_ms=self.coalesce_ms,
+                        coalesce_messages=self.coalesce_messages,
+                    )
+                    total_sent += 1
+        self.observe_fanout(started, total_sent)
         return total_sent
 
+    def add_messages(self, messages):
+        """
+        Sends a batch of messages, every subscribed connection gets messages
+        meant for it in a single frame. Delivery info is read from messages.
+
+        :param messages: list of message dicts
+        :return: number of delivered messages
+        """
+        if len(messages) == 1:
+            return self.add_message(messages[0])
+        started = time.time()
+        envelopes = [Envelope(message, seq=self.next_seq()) for message in messages]
+        self.mark_activity()
+        for message, envelope in zip(messages, envelopes):
+            if not message["no_history"]:
+                self.add_to_history(message)
+            self.add_frame(message, envelope)
+        everything = tuple(range(len(envelopes)))
+        restricted = [e for e in envelopes if e.pm_users or e.exclude_users]
+        # frames are serialized once per distinct set of delivered messages
+        frames = {}
+        total_sent = 0
+        reached = 0
+        for user, conns in six.iteritems(self.attached):
+            delivered = everything
+            if restricted:
+                delivered = tuple(
+                    i for i in everything if envelopes[i].delivers_to(user)
+                )
+                if not delivered:
+                    continue
+            if delivered not in frames:
+                payloads = [envelopes[i].payload for i in delivered]
+                frames[delivered] = (payloads, json.dumps(payloads))
+            payloads, encoded = frames[delivered]
+            for connection in conns:
+                connection.add_messages(
+                    payloads,
+                    encoded=encoded,
+                    overflow_policy=self.overflow_policy,
+                    coalesce_ms=self.coalesce_ms,
+                    coalesce_messages=self.coalesce_messages,
+                )
+                total_sent += len(delivered)
+                reached += 1
+        self.observe_fanout(started, reached)
+        return total_sent
+
+    def observe_fanout(self, started, reached):
+        """
+        Records how long a broadcast took and how many connections it reached
+
+        :param started: timestamp broadcast started at
+        :param reached: number of connections
+        :return:
+        """
+        server_state = get_state(self.tenant_id)
+        server_state.fanout_latency.observe(time.time() - started)
+        server_state.fanout_subscribers.observe(reached)
+
     def __repr__(self):
         return "<Channel: %s, connections:%s>" % (self.name, len(self.connections))
 
     def get_info(self, include_history=True, include_users=False):
-        server_state = get_state()
-        settings = {k: getattr(self, k) for k in self.config_keys}
+        """
+        Channel info, built once per info version and cluster membership
+        version, last activity is always current
+
+        :param include_history:
+        :param include_users:
+        :return: info dict, history and users lists are shared with the cache
+        """
+        info = dict(self.cached_info(include_history, include_users))
+        info["last_active"] = self.last_active
+        return info
+
+    def get_info_json(self, include_history=True, include_users=False):
+        """
+        Same as get_info() encoded as JSON object, encoding is cached too
 
+        :param include_history:
+        :param include_users:
+        :return: JSON string
+        """
+        key = ("json", bool(include_history), bool(include_users))
+        encoded = self.info_cache.get(key)
+        if encoded is None or encoded[0] != cluster.remote_version():
+            info = self.cached_info(include_history, include_users)
+            encoded = (cluster.remote_version(), json.dumps(info))
+            self.info_cache[key] = encoded
+        # cached encoding has no last_active, it goes in front
+        return '{"last_active":' + json.dumps(self.last_active) + "," + encoded[1][1:]
+
+    def cached_info(self, include_history=True, include_users=False):
+        """
+        :return: info dict without last_active, must not be modified
+        """
+        key = (bool(include_history), bool(include_users))
+        cached = self.info_cache.get(key)
+        if cached is None or cached[0] != cluster.remote_version():
+            cached = (
+                cluster.remote_version(),
+                self.build_info(include_history, include_users),
+            )
+            self.info_cache[key] = cached
+        return cached[1]
+
+    def build_info(self, include_history=True, include_users=False):
         chan_info = {
             "uuid": self.uuid,
             "name": self.name,
             "long_name": self.long_name,
-            "settings": settings,
-            "history": self.history if include_history else [],
-            "last_active": self.last_active,
+            "settings": self.settings,
+            "history": list(self.history) if include_history else [],
             "total_connections": sum(
                 [len(conns) for conns in self.connections.values()]
             ),
             "total_users": 0,
             "users": [],
         }
-
-        for username in self.connections.keys():
-            user_inst = server_state.users.get(username)
-            if include_users and user_inst.username not in chan_info["users"]:
-                chan_info["users"].append(user_inst.username)
-        chan_info["users"] = sorted(chan_info["users"])
+        users = set(self.connections)
+        # members connected to other cluster nodes
+        remote_members = cluster.remote_members(self.tenant_id, self.name)
+        for username, (connections, _) in six.iteritems(remote_members):
+            chan_info["total_connections"] += connections
+            users.add(username)
+        if include_users:
+            chan_info["users"] = sorted(users)
         chan_info["total_users"] = len(chan_info["users"])
         return chan_info
 
     def alter_message(self, to_edit):
-        found = False
-        for msg in self.history:
-            if msg["uuid"] == to_edit["uuid"]:
-                found = True
-                msg.update(
-                    {k: v for k, v in six.iteritems(to_edit) if k in MSG_EDITABLE_KEYS}
-                )
+        changes = {k: v for k, v in six.iteritems(to_edit) if k in MSG_EDITABLE_KEYS}
+        self.history.edit_message(to_edit["uuid"], changes)
+        self.info_changed()
+        # in memory history and frames share message objects,
+        # but envelope payload is immutable and needs to be rebuilt
+        for i, (t, msg, envelope) in enumerate(self.frames):
+            if msg["uuid"] == to_edit["uuid"] and msg["type"] == "message":
+                msg.update(changes)
+                self.frames[i] = (t, msg, Envelope(msg, seq=envelope.seq))
+                if self.log:
+                    self.log.edit_frame(storage.CHANNEL, self.name, self.frames[i])
                 break
-        # if found history then reference in frames will be also updated,
-        # otherwise search frames for channels that do not store history
-        if not found:
-            for f, msg in self.frames:
-                if msg["uuid"] == to_edit["uuid"] and msg["type"] == "message":
-                    msg.update(
-                        {
-                            k: v
-                            for k, v in six.iteritems(to_edit)
-                            if k in MSG_EDITABLE_KEYS
-                        }
-                    )
-                    break
-        altered = copy.deepcopy(to_edit)
+        altered = dict(to_edit)
         altered["type"] = "message:edit"
         self.add_message(
             altered,
@@ -265,18 +703,18 @@ class Channel(object):
         )
 
     def delete_message(self, to_delete):
-        for i, msg in enumerate(self.history):
-            if msg["uuid"] == to_delete["uuid"]:
-                self.history.pop(i)
-                break
+        self.history.delete_message(to_delete["uuid"])
+        self.info_changed()
 
         for i, frame in enumerate(self.frames):
             msg = frame[1]
             if msg["uuid"] == to_delete["uuid"] and msg["type"] == "message":
-                self.frames.pop(i)
+                del self.frames[i]
+                if self.log:
+                    self.log.delete_frame(storage.CHANNEL, self.name, msg["uuid"])
                 break
 
-        deleted = copy.deepcopy(to_delete)
+        deleted = dict(to_delete)
         deleted["type"] = "message:delete"
         self.add_message(
             deleted,
@@ -5,17 +5,25 @@ monkey.patch_all()
 import copy
 import logging
 import argparse
+import os
+import signal
+import socket
 import sys
 
 from six.moves import configparser
 
+import gevent
 from gevent.server import StreamServer
 from pyramid.settings import asbool
 
 import channelstream.wsgi_app as pyramid_app
 import channelstream
-from channelstream.gc import gc_conns_forever, gc_users_forever
+from channelstream import bus, cluster, operations, patched_json, snapshot, storage
+from channelstream.connection import Connection
+from channelstream.gc import start_gc
+from channelstream.heartbeat import heartbeat_forever
 from channelstream.policy_server import client_handle
+from channelstream.server_state import configure_tenants, DEFAULT_TENANT, STATES
 from channelstream.ws_app import ChatApplicationSocket
 
 from ws4py.server.geventserver import WSGIServer
@@ -45,6 +53,10 @@ SHARED_DEFAULTS = {
     "gc_conns_after": 30,
     "gc_channels_after": 3600 * 72,
     "wake_connections_after": 5,
+    "long_poll_linger": 0,
+    "storm_reconnects_per_second": 0,
+    "storm_grace": 30,
+    "storm_catchup_rate": 200,
     "allow_posting_from": "127.0.0.1",
     "port": 8000,
     "host": "0.0.0.0",
@@ -53,9 +65,40 @@ SHARED_DEFAULTS = {
     "demo": False,
     "allow_cors": "",
     "validate_requests": True,
+    "json_backend": "auto",
+    "max_send_queue": 1000,
+    "tenants": "",
+    "tenant_max_connections": 0,
+    "tenant_max_messages_per_second": 0,
+    "workers": 1,
+    "cluster_node": "",
+    "cluster_peers": "",
+    "cluster_secret": "",
+    "policy_server_port": 10843,
+    "log_dir": "",
+    "log_segment_mb": 64,
+    "snapshot_path": "",
+    "snapshot_interval": 60,
 }
 
 
+def parse_tenants(value):
+    """
+    Parses comma separated tenant_id:secret pairs into a dict
+    :param value:
+    :return:
+    """
+    tenants = {}
+    for pair in value.split(","):
+        if not pair.strip():
+            continue
+        tenant_id, _, secret = pair.strip().partition(":")
+        if not secret or tenant_id == DEFAULT_TENANT:
+            raise ValueError("Invalid tenant definition: {}".format(pair))
+        tenants[tenant_id] = secret
+    return tenants
+
+
 def cli_start():
     if sys.version_info.major < 3 or (
         sys.version_info.major <= 3 and sys.version_info.minor < 6
@@ -114,6 +157,116 @@ def cli_start():
         dest="validate_requests",
         help="Enable timestamp check on signed requests",
     )
+    parser.add_argument(
+        "--json-backend",
+        dest="json_backend",
+        choices=patched_json.BACKENDS,
+        help="JSON encoder used for wire traffic, auto picks the fastest installed",
+    )
+    parser.add_argument(
+        "--max-send-queue",
+        type=int,
+        dest="max_send_queue",
+        help="How many frames can wait to be written to single websocket",
+    )
+    parser.add_argument(
+        "--tenants",
+        dest="tenants",
+        help="comma separated list of tenant_id:secret pairs, "
+        "secret option is used for default tenant",
+    )
+    parser.add_argument(
+        "--tenant-max-connections",
+        type=int,
+        dest="tenant_max_connections",
+        help="Connection quota of every tenant, 0 means unlimited",
+    )
+    parser.add_argument(
+        "--tenant-max-messages-per-second",
+        type=int,
+        dest="tenant_max_messages_per_second",
+        help="Message quota of every tenant, 0 means unlimited",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        dest="workers",
+        help="Number of worker processes sharing the listening port",
+    )
+    parser.add_argument(
+        "--cluster-node",
+        dest="cluster_node",
+        help="host:port this node listens on for other cluster nodes",
+    )
+    parser.add_argument(
+        "--cluster-peers",
+        dest="cluster_peers",
+        help="comma separated list of host:port of other cluster nodes",
+    )
+    parser.add_argument(
+        "--cluster-secret",
+        dest="cluster_secret",
+        help="Secret used to sign traffic between nodes, required in cluster mode "
+        "and must differ from secret",
+    )
+    parser.add_argument(
+        "--policy-server-port",
+        type=int,
+        dest="policy_server_port",
+        help="Port of flash policy server, 0 disables it",
+    )
+    parser.add_argument(
+        "--log-dir",
+        dest="log_dir",
+        help="Directory of durable history and catchup frame logs, "
+        "keeps everything in memory when not set",
+    )
+    parser.add_argument(
+        "--log-segment-mb",
+        type=int,
+        dest="log_segment_mb",
+        help="Size of log segment files in megabytes",
+    )
+    parser.add_argument(
+        "--snapshot-path",
+        dest="snapshot_path",
+        help="File with snapshot of users, channels and connections "
+        "loaded on startup and written at intervals and on shutdown",
+    )
+    parser.add_argument(
+        "--snapshot-interval",
+        type=int,
+        dest="snapshot_interval",
+        help="Seconds between snapshots, 0 writes snapshot only on shutdown",
+    )
+    parser.add_argument(
+        "--long-poll-linger",
+        type=float,
+        dest="long_poll_linger",
+        help="Seconds long poll waits for more messages once it has some, "
+        "0 responds right away",
+    )
+    parser.add_argument(
+        "--storm-reconnects-per-second",
+        type=int,
+        dest="storm_reconnects_per_second",
+        help="Clients reattaching per second that start reconnect storm mode, "
+        "0 disables it",
+    )
+    parser.add_argument(
+        "--storm-grace",
+        type=int,
+        dest="storm_grace",
+        help="Seconds users have to come back before parting during "
+        "reconnect storm, storm mode lasts that long after reconnects calm down",
+    )
+    parser.add_argument(
+        "--storm-catchup-rate",
+        type=int,
+        dest="storm_catchup_rate",
+        help="Catchups delivered per second during reconnect storm, "
+        "0 means unlimited",
+    )
     args = parser.parse_args()
 
     parameters = (
@@ -127,6 +280,24 @@ def cli_start():
         "allow_posting_from",
         "allow_cors",
         "validate_requests",
+        "json_backend",
+        "max_send_queue",
+        "tenants",
+        "tenant_max_connections",
+        "tenant_max_messages_per_second",
+        "workers",
+        "cluster_node",
+        "cluster_peers",
+        "cluster_secret",
+        "policy_server_port",
+        "log_dir",
+        "log_segment_mb",
+        "snapshot_path",
+        "snapshot_interval",
+        "long_poll_linger",
+        "storm_reconnects_per_second",
+        "storm_grace",
+        "storm_catchup_rate",
     )
 
     if args.ini:
@@ -141,15 +312,29 @@ def cli_start():
     else:
         for key in parameters:
             conf_value = getattr(args, key)
-            if conf_value:
+            if conf_value is not None:
                 config[key] = conf_value
 
     # convert types
     config["debug"] = asbool(config["debug"])
     config["port"] = int(config["port"])
     config["validate_requests"] = asbool(config["validate_requests"])
+    config["max_send_queue"] = int(config["max_send_queue"])
+    config["tenant_max_connections"] = int(config["tenant_max_connections"])
+    config["tenant_max_messages_per_second"] = int(
+        config["tenant_max_messages_per_second"]
+    )
+    config["tenants"] = parse_tenants(config["tenants"])
+    config["workers"] = max(int(config["workers"]), 1)
+    config["policy_server_port"] = int(config["policy_server_port"])
+    config["log_segment_mb"] = int(config["log_segment_mb"])
+    config["snapshot_interval"] = int(config["snapshot_interval"])
+    config["long_poll_linger"] = float(config["long_poll_linger"])
+    config["storm_reconnects_per_second"] = int(config["storm_reconnects_per_second"])
+    config["storm_grace"] = int(config["storm_grace"])
+    config["storm_catchup_rate"] = int(config["storm_catchup_rate"])
 
-    for key in ["allow_posting_from", "allow_cors"]:
+    for key in ["allow_posting_from", "allow_cors", "cluster_peers"]:
         if not config[key]:
             continue
         try:
@@ -161,13 +346,33 @@ def cli_start():
     log_level = getattr(logging, config.get("log_level", "INFO").upper())
     logging.basicConfig(level=log_level)
     log.info("Starting channelstream {}".format(channelstream.__version__))
+    patched_json.set_backend(config["json_backend"])
+    Connection.max_send_queue = config["max_send_queue"]
+    configure_tenants(
+        [DEFAULT_TENANT] + list(config["tenants"]),
+        max_connections=config["tenant_max_connections"],
+        max_messages_per_second=config["tenant_max_messages_per_second"],
+        storm_reconnects_per_second=config["storm_reconnects_per_second"],
+        storm_grace=config["storm_grace"],
+        storm_catchup_rate=config["storm_catchup_rate"],
+    )
+    if config["cluster_node"]:
+        if config["workers"] > 1:
+            raise ValueError("cluster mode runs a single worker per node")
+        # anyone holding the secret can make nodes run arbitrary operations
+        cluster_secret = config["cluster_secret"]
+        if not cluster_secret or cluster_secret in ("secret", config["secret"]):
+            raise ValueError(
+                "cluster mode needs cluster_secret that is not default "
+                "and differs from secret"
+            )
+        cluster.NODE = cluster.ClusterNode(
+            config["cluster_node"], config["cluster_peers"] or [], cluster_secret
+        )
+        cluster.NODE.start()
+        log.info("Cluster node {} started".format(config["cluster_node"]))
     url = "http://{}:{}".format(config["host"], config["port"])
 
-    log.info("Starting flash policy server on port 10843")
-    gc_conns_forever()
-    gc_users_forever()
-    server = StreamServer(("0.0.0.0", 10843), client_handle)
-    server.start()
     log.info("Serving on {}".format(url))
     log.info("Admin interface available on {}/admin".format(url))
     if config["secret"] == "secret":
@@ -175,9 +380,142 @@ def cli_start():
     if config["admin_secret"] == "admin_secret":
         log.warning("Using default admin secret! Remember to set that for production.")
 
+    if config["workers"] > 1:
+        run_workers(config)
+    else:
+        serve(config, (config["host"], config["port"]))
+
+
+def serve(config, listener, policy_server=True):
+    """
+    Starts background loops and serves requests in current process
+
+    :param config:
+    :param listener: address tuple or listening socket
+    :param policy_server: start flash policy server
+    :return:
+    """
+    if config["log_dir"]:
+        open_logs(config)
+    # replicas are identical, one worker writes snapshots
+    writes_snapshot = config["snapshot_path"] and bus.worker_id() in (None, 0)
+    if config["snapshot_path"]:
+        snapshot.load_snapshot(config["snapshot_path"])
+        if writes_snapshot and config["snapshot_interval"]:
+            gevent.spawn_later(
+                config["snapshot_interval"],
+                snapshot.snapshot_forever,
+                config["snapshot_path"],
+                config["snapshot_interval"],
+            )
+    start_gc()
+    heartbeat_forever()
+    if policy_server and config["policy_server_port"]:
+        log.info(
+            "Starting flash policy server on port {}".format(
+                config["policy_server_port"]
+            )
+        )
+        server = StreamServer(("0.0.0.0", config["policy_server_port"]), client_handle)
+        server.start()
+
     server = WSGIServer(
-        (config["host"], config["port"]),
+        listener,
         RoutingApplication(config),
         log=logging.getLogger("channelstream.WSGIServer"),
     )
-    server.serve_forever()
+    if writes_snapshot:
+        # stop serving and write snapshot on SIGTERM
+        # gevent < 1.5 names it gevent.signal
+        signal_handler = getattr(gevent, "signal_handler", None) or gevent.signal
+        signal_handler(signal.SIGTERM, server.stop)
+        try:
+            server.serve_forever()
+        finally:
+            snapshot.write_snapshot(config["snapshot_path"])
+    else:
+        server.serve_forever()
+
+
+def open_logs(config):
+    """
+    Restores every tenant from its log and starts log maintenance,
+    each worker process keeps its own logs
+
+    :param config:
+    :return:
+    """
+    for tenant_id in list(STATES):
+        tenant_log = storage.open_log(
+            config["log_dir"],
+            tenant_id,
+            segment_size=config["log_segment_mb"] * 1024 * 1024,
+            worker_id=bus.worker_id(),
+        )
+        operations.restore_from_log(tenant_log, tenant_id)
+    storage.maintain_logs_forever()
+
+
+def make_listener(host, port, reuse_port=False):
+    """
+    Creates listening socket, with `reuse_port` every worker binds its own
+    socket and kernel balances connections between them
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    return sock
+
+
+def run_workers(config):
+    """
+    Forks worker processes connected with a message bus,
+    any worker exiting stops the others as their replicas would diverge
+
+    :param config:
+    :return:
+    """
+    workers = config["workers"]
+    reuse_port = hasattr(socket, "SO_REUSEPORT")
+    # without SO_REUSEPORT workers accept from one inherited socket
+    shared_listener = (
+        None if reuse_port else make_listener(config["host"], config["port"])
+    )
+    mesh = bus.make_mesh(workers)
+    pids = []
+    for worker_id in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            for other_id, peer_sockets in enumerate(mesh):
+                if other_id != worker_id:
+                    for sock in peer_sockets.values():
+                        sock.close()
+            bus.BUS = bus.WorkerBus(worker_id, mesh[worker_id])
+            bus.BUS.start()
+            listener = shared_listener or make_listener(
+                config["host"], config["port"], reuse_port=True
+            )
+            log.info("Worker {} started, pid {}".format(worker_id, os.getpid()))
+            serve(config, listener, policy_server=worker_id == 0)
+            os._exit(0)
+        pids.append(pid)
+
+    for peer_sockets in mesh:
+        for sock in peer_sockets.values():
+            sock.close()
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        pid, status = os.waitpid(-1, 0)
+        log.error("Worker with pid {} exited ({}), stopping".format(pid, status))
+        pids.remove(pid)
+        sys.exit(1)
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
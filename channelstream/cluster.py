@@ -0,0 +1,347 @@
+"""
+Cluster of independent channelstream nodes.
+
+Every node owns its connections, users and channels. Nodes keep persistent
+TCP links to peers from a static list and replicate a subscription interest
+table - which users are subscribed to which channels on which node.
+Messages posted to a node are relayed only to nodes with subscribers
+in the channel (private messages go to every node), presence and channel
+info include members from other nodes.
+
+Each node sends over the link it opened and receives over links opened
+by peers, frames are signed with the cluster secret.
+"""
+import logging
+
+import gevent
+import six
+from gevent import socket
+from gevent.server import StreamServer
+
+from channelstream import bus
+from channelstream.server_state import STATES
+
+log = logging.getLogger(__name__)
+
+RECONNECT_DELAY = 1
+PING_INTERVAL = 5
+
+# data operation name -> callable applying relayed operation locally,
+# registered by channelstream.operations
+HANDLERS = {}
+
+# node of current process, None when not running in cluster mode
+NODE = None
+
+
+def register(op, handler):
+    HANDLERS[op] = handler
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(":")
+    return host, int(port)
+
+
+class InterestTable(object):
+    """
+    Members of channels on other nodes
+    """
+
+    def __init__(self):
+        # (tenant_id, channel_name) -> {node_id: {username: (connections, state)}}
+        self.channels = {}
+        # bumped on every change, cached channel info depends on it
+        self.version = 0
+
+    def set_member(self, node_id, tenant_id, channel_name, username, count, state):
+        key = (tenant_id, channel_name)
+        self.version += 1
+        if count:
+            nodes = self.channels.setdefault(key, {})
+            nodes.setdefault(node_id, {})[username] = (count, state)
+            return
+        members = self.channels.get(key, {}).get(node_id)
+        if members is not None:
+            members.pop(username, None)
+            if not members:
+                del self.channels[key][node_id]
+                if not self.channels[key]:
+                    del self.channels[key]
+
+    def drop_node(self, node_id):
+        self.version += 1
+        for key in list(self.channels):
+            self.channels[key].pop(node_id, None)
+            if not self.channels[key]:
+                del self.channels[key]
+
+    def replace_node(self, node_id, members):
+        """
+        Replaces everything known about node with a snapshot
+        :param node_id:
+        :param members: list of (tenant_id, channel, username, count, state)
+        :return:
+        """
+        self.drop_node(node_id)
+        for tenant_id, channel_name, username, count, state in members:
+            self.set_member(node_id, tenant_id, channel_name, username, count, state)
+
+    def nodes_for(self, tenant_id, channel_name):
+        return set(self.channels.get((tenant_id, channel_name), {}))
+
+    def members(self, tenant_id, channel_name):
+        """
+        Members aggregated over nodes
+        :return: {username: (connections, state)}
+        """
+        found = {}
+        for members in six.itervalues(self.channels.get((tenant_id, channel_name), {})):
+            for username, (count, state) in six.iteritems(members):
+                known = found.get(username, (0, state))
+                found[username] = (known[0] + count, state)
+        return found
+
+    def channel_names(self, tenant_id):
+        return set(name for t, name in self.channels if t == tenant_id)
+
+
+class NodeHandlers(dict):
+    """
+    Node control operations, data operations are looked up when dispatched
+    as they get registered after the node is created
+    """
+
+    def __init__(self, control, data):
+        super(NodeHandlers, self).__init__(control)
+        self.data = data
+
+    def __missing__(self, op):
+        return self.data[op]
+
+
+class ClusterNode(object):
+    def __init__(self, node_id, peers, secret, handlers=None):
+        """
+
+        :param node_id: host:port this node listens on for peers
+        :param peers: host:port of other nodes, own address is ignored
+        :param secret: shared cluster secret
+        :param handlers: data operation handlers, defaults to HANDLERS
+        """
+        self.node_id = node_id
+        self.peer_addresses = [a for a in peers if a and a != node_id]
+        self.secret = secret if isinstance(secret, bytes) else secret.encode("utf8")
+        self.handlers = NodeHandlers(
+            {
+                "cluster_hello": self.on_hello,
+                "cluster_snapshot": self.on_snapshot,
+                "cluster_member": self.on_member,
+                "cluster_ping": lambda: None,
+            },
+            HANDLERS if handlers is None else handlers,
+        )
+        # outgoing links that are up, by peer address
+        self.links = {}
+        self.interest = InterestTable()
+        self.server = None
+        self.greenlets = []
+
+    def start(self):
+        self.server = StreamServer(parse_address(self.node_id), self.handle_inbound)
+        self.server.start()
+        for address in self.peer_addresses:
+            self.greenlets.append(gevent.spawn(self.link_forever, address))
+
+    def stop(self):
+        gevent.killall(self.greenlets)
+        self.server.stop()
+
+    def handle_inbound(self, sock, address):
+        peer = bus.Peer(address, sock, secret=self.secret, handlers=self.handlers)
+        try:
+            peer.read_frames()
+        except socket.error as exc:
+            log.info("cluster link from {} failed: {}".format(address, exc))
+
+    def link_forever(self, address):
+        """
+        Keeps outgoing link to peer open, interest of an unreachable peer
+        is forgotten until it reconnects
+        """
+        while True:
+            try:
+                sock = socket.create_connection(parse_address(address))
+            except socket.error:
+                gevent.sleep(RECONNECT_DELAY)
+                continue
+            peer = bus.Peer(address, sock, secret=self.secret)
+            self.links[address] = peer
+            peer.send(self.pack("cluster_hello", self.node_id, local_members()))
+            pinger = gevent.spawn(self.ping_forever, peer)
+            try:
+                peer.write_frames()
+            except socket.error as exc:
+                log.info("cluster link to {} failed: {}".format(address, exc))
+            finally:
+                pinger.kill()
+                self.links.pop(address, None)
+                self.interest.drop_node(address)
+                sock.close()
+            gevent.sleep(RECONNECT_DELAY)
+
+    def ping_forever(self, peer):
+        while True:
+            gevent.sleep(PING_INTERVAL)
+            peer.send(self.pack("cluster_ping"))
+
+    def pack(self, op, *args, **kwargs):
+        return bus.pack(op, args, kwargs, secret=self.secret)
+
+    def send(self, node_ids, op, *args, **kwargs):
+        """
+        Sends operation to peers with links that are up
+        :param node_ids: None sends to every peer
+        :return:
+        """
+        frame = self.pack(op, *args, **kwargs)
+        for address, peer in list(six.iteritems(self.links)):
+            if node_ids is None or address in node_ids:
+                peer.send(frame)
+
+    def on_hello(self, node_id, members):
+        self.interest.replace_node(node_id, members)
+        # peer (re)connected, it may have missed our membership
+        self.send([node_id], "cluster_snapshot", self.node_id, local_members())
+
+    def on_snapshot(self, node_id, members):
+        self.interest.replace_node(node_id, members)
+
+    def on_member(self, node_id, tenant_id, channel_name, username, count, state):
+        self.interest.set_member(
+            node_id, tenant_id, channel_name, username, count, state
+        )
+
+
+def local_members():
+    """
+    Snapshot of channel members on this node
+    :return: list of (tenant_id, channel, username, count, state)
+    """
+    members = []
+    for tenant_id, server_state in list(six.iteritems(STATES)):
+        for channel in list(six.itervalues(server_state.channels)):
+            for username, connections in list(six.iteritems(channel.connections)):
+                if connections:
+                    user = server_state.users.get(username)
+                    state = user.public_state if user else {}
+                    members.append(
+                        (tenant_id, channel.name, username, len(connections), state)
+                    )
+    return members
+
+
+def membership_changed(tenant_id, channel_name, username, count):
+    """
+    Announces number of user connections in a channel on this node
+    """
+    if NODE is None:
+        return
+    user = STATES[tenant_id].users.get(username)
+    state = user.public_state if user else {}
+    NODE.send(
+        None,
+        "cluster_member",
+        NODE.node_id,
+        tenant_id,
+        channel_name,
+        username,
+        count,
+        state,
+    )
+
+
+def relay(op, tenant_id, channel_name, *args):
+    """
+    Sends data operation to nodes with members in channel,
+    to every node if there is no channel
+
+    :param op:
+    :param tenant_id:
+    :param channel_name: selects receiving nodes, not sent
+    :param args: handler arguments following tenant_id
+    :return:
+    """
+    if NODE is None:
+        return
+    if channel_name:
+        node_ids = NODE.interest.nodes_for(tenant_id, channel_name)
+        if not node_ids:
+            return
+    else:
+        node_ids = None
+    NODE.send(node_ids, op, tenant_id, *args)
+
+
+def remote_members(tenant_id, channel_name):
+    """
+    Members of channel on other nodes
+    :return: {username: (connections, state)}
+    """
+    if NODE is None:
+        return {}
+    return NODE.interest.members(tenant_id, channel_name)
+
+
+def remote_version():
+    """
+    Changes whenever membership on other nodes changes
+    """
+    if NODE is None:
+        return 0
+    return NODE.interest.version
+
+
+def is_remote_member(tenant_id, channel_name, username):
+    return username in remote_members(tenant_id, channel_name)
+
+
+def remote_channel_names(tenant_id):
+    if NODE is None:
+        return set()
+    return NODE.interest.channel_names(tenant_id)
+
+
+def remote_user_state(tenant_id, username):
+    """
+    Public state user had when joining a channel on other node
+    """
+    if NODE is None:
+        return None
+    for (t, channel_name), nodes in list(six.iteritems(NODE.interest.channels)):
+        if t != tenant_id:
+            continue
+        for members in six.itervalues(nodes):
+            if username in members:
+                return members[username][1]
+    return None
+
+
+def remote_channel_info(tenant_id, channel_name, include_users=False):
+    """
+    Info for channel that only exists on other nodes,
+    settings and history are not replicated
+    """
+    members = remote_members(tenant_id, channel_name)
+    users = sorted(members) if include_users else []
+    return {
+        "uuid": None,
+        "name": channel_name,
+        "long_name": None,
+        "settings": {},
+        "history": [],
+        "last_active": None,
+        "total_connections": sum(count for count, _ in six.itervalues(members)),
+        "total_users": len(users),
+        "users": users,
+    }
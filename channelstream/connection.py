@@ -1,26 +1,188 @@
+import collections
 import logging
+import time
 from datetime import datetime, timedelta
 
 import gevent
-import six
+from gevent.event import Event
 
 from channelstream import patched_json as json
-from channelstream.server_state import get_state
+from channelstream.gc import schedule_conn_gc
+from channelstream.heartbeat import WHEEL
+from channelstream.server_state import get_state, DEFAULT_TENANT
+from channelstream.utils import merge_frames
 
 log = logging.getLogger(__name__)
 
+HEARTBEAT_FRAME = json.dumps([])
+
+
+class PollBuffer(object):
+    """
+    Messages waiting for long polling client. Buffer outlives single polls,
+    client acknowledges received messages by passing cursor of the next poll -
+    `seq` of last received message in every channel and among private
+    messages. Sequence numbers are shared by all workers, so the cursor
+    stays valid when client comes back to another one.
+    """
+
+    def __init__(self, maxlen=1000):
+        # (channel name or None, seq, message) tuples, oldest are dropped
+        # when buffer is full
+        self.messages = collections.deque()
+        self.maxlen = maxlen
+        self.dropped = 0
+        self.event = Event()
+        # live messages waiting for deferred catchup to go out first
+        self.held = None
+
+    def put(self, messages):
+        """
+        Buffers messages and wakes up waiting polls, an empty list only wakes
+        them up so they can return (heartbeat)
+
+        :param messages: list of message dicts
+        """
+        if self.held is not None:
+            self.held.extend(messages)
+            overflow = len(self.held) - self.maxlen
+            if overflow > 0:
+                del self.held[:overflow]
+                self.dropped += overflow
+            if messages:
+                # nothing new for polls until catchup is released
+                return
+        for message in messages:
+            self.messages.append(
+                (message.get("channel") or None, message.get("seq", 0), message)
+            )
+        while len(self.messages) > self.maxlen:
+            self.messages.popleft()
+            self.dropped += 1
+        self.event.set()
+
+    def hold(self):
+        """
+        Holds live messages back until release(), used while catchup
+        of the client is deferred so its cursor never skips catchup messages
+        """
+        if self.held is None:
+            self.held = []
+
+    def release(self, catchup):
+        """
+        Buffers catchup messages followed by messages held meanwhile
+
+        :param catchup: list of catchup message dicts
+        """
+        held, self.held = self.held or [], None
+        self.put(catchup + held)
+
+    @staticmethod
+    def received(entry, cursor):
+        channel_name, seq, message = entry
+        return channel_name in cursor and seq <= cursor[channel_name]
+
+    def acknowledge(self, cursor, keep=0):
+        """
+        Forgets messages client already received
+
+        :param cursor: {channel name or None: seq} of last received messages
+        :param keep: number of newest received messages to keep buffered
+        """
+        if not cursor:
+            return
+        forget = sum(1 for entry in self.messages if self.received(entry, cursor))
+        forget -= keep
+        if forget <= 0:
+            return
+        kept = collections.deque()
+        for entry in self.messages:
+            if forget and self.received(entry, cursor):
+                forget -= 1
+            else:
+                kept.append(entry)
+        self.messages = kept
+
+    def wait(self, timeout, cursor=None):
+        """
+        Blocks until messages newer than cursor are buffered
+        or timeout passes
+        :return: True if messages are available
+        """
+        if not self.pending(cursor):
+            self.event.clear()
+            self.event.wait(timeout=timeout)
+        return self.pending(cursor)
+
+    def pending(self, cursor=None):
+        cursor = cursor or {}
+        return any(not self.received(entry, cursor) for entry in self.messages)
+
+    def take(self, cursor=None):
+        """
+        :param cursor: positions of last received messages
+        :return: (messages newer than cursor, cursor after the last of them)
+        """
+        cursor = cursor or {}
+        messages = []
+        last = dict(cursor)
+        for entry in self.messages:
+            if not self.received(entry, cursor):
+                channel_name, seq, message = entry
+                messages.append(message)
+                last[channel_name] = seq
+        return messages, last
+
 
 class Connection(object):
     """ Represents a client connection"""
 
-    def __init__(self, username, conn_id):
+    # how many frames can wait for websocket writer before overflow policy
+    # kicks in
+    max_send_queue = 1000
+
+    def __init__(
+        self,
+        username,
+        conn_id,
+        tenant_id=DEFAULT_TENANT,
+        coalesce_ms=0,
+        coalesce_messages=0,
+    ):
         self.username = username  # hold user id/name of connection
+        self.tenant_id = tenant_id
         self.last_active = None
         self.socket = None
         self.queue = None
         self.id = conn_id
+        # names of channels this connection is subscribed to,
+        # maintained by Channel.add_connection/remove_connection
+        self.channel_names = set()
+        self.gc_deadline = None
+        # outgoing websocket frames drained by writer greenlet
+        self.send_queue = collections.deque()
+        self.send_event = Event()
+        self.dropped_frames = 0
+        # frames are held up to `coalesce_ms` (or until `coalesce_messages`
+        # are pending) and written as one frame, 0 sends right away
+        self.coalesce_ms = coalesce_ms
+        self.coalesce_messages = coalesce_messages
+        # open coalescing window - when pending frames have to be written,
+        # when the window was opened and how many messages it holds
+        self.flush_at = None
+        self.flush_limit = 0
+        self.window_started = None
+        self.pending_messages = 0
+        # socket or long poll queue is held by another worker process
+        self.attached_remotely = False
+        # how the client listens: websocket, long_poll or sse
+        self.transport = None
+        # recreated from snapshot, client had it attached before restart
+        self.restored = False
         self.mark_activity()
-        gevent.spawn_later(5, self.heartbeat)
+        schedule_conn_gc(self)
+        WHEEL.add(self)
 
     def __repr__(self):
         return "<Connection: id:%s, owner:%s>" % (self.id, self.username)
@@ -28,58 +190,393 @@ class Connection(object):
     def mark_activity(self):
         self.last_active = datetime.utcnow()
 
-    def add_message(self, message=None):
-        server_state = get_state()
-        """ Sends the message to the client connection """
+    def add_message(
+        self,
+        message=None,
+        encoded=None,
+        overflow_policy="drop_oldest",
+        coalesce_ms=0,
+        coalesce_messages=0,
+    ):
+        """
+        Sends the message to the client connection
+
+        :param message: message dict, empty frame is sent if not present
+        :param encoded: pre-encoded JSON frame for `[message]`, callers
+                        that fan out one message can serialize it only once
+        :param overflow_policy: what to do when websocket send queue is full
+        :param coalesce_ms: coalescing window requested by the sender
+        :param coalesce_messages: message limit of the sender's window
+        """
+        self.add_messages(
+            [message] if message else [],
+            encoded=encoded,
+            overflow_policy=overflow_policy,
+            coalesce_ms=coalesce_ms,
+            coalesce_messages=coalesce_messages,
+        )
+
+    def add_messages(
+        self,
+        messages,
+        encoded=None,
+        overflow_policy="drop_oldest",
+        coalesce_ms=0,
+        coalesce_messages=0,
+    ):
+        """
+        Sends list of messages to the client connection as a single frame
+
+        :param messages: list of message dicts
+        :param encoded: pre-encoded JSON frame for `messages`
+        :param overflow_policy: what to do when websocket send queue is full
+        :param coalesce_ms: coalescing window requested by the sender
+        :param coalesce_messages: message limit of the sender's window
+        """
         # handle websockets
         if self.socket and self.socket.terminated:
             self.mark_for_gc()
         elif self.socket and not self.socket.terminated:
-            try:
-                # payload needs to be converted to JSON now as it gets
-                # piped to client
-                self.socket.send(json.dumps([message] if message else []))
-                self.mark_activity()
-                server_state.users[self.username].mark_activity()
-            except Exception as exc:
-                log.info(exc)
-                self.mark_for_gc()
+            # payload needs to be converted to JSON now as it gets
+            # piped to client
+            if encoded is None:
+                encoded = json.dumps(messages)
+            self.enqueue_frame(
+                encoded,
+                overflow_policy,
+                count=len(messages),
+                coalesce_ms=coalesce_ms,
+                coalesce_messages=coalesce_messages,
+            )
         elif self.queue:
             # handle long polling
             # payload will be converted to JSON in WSGI response
-            self.queue.put([message] if message else [])
+            self.queue.put(messages)
+
+    def enqueue_frame(
+        self,
+        frame,
+        overflow_policy="drop_oldest",
+        count=1,
+        coalesce_ms=0,
+        coalesce_messages=0,
+    ):
+        """
+        Puts encoded frame on the send queue, writer greenlet sends it
+        to the websocket so slow clients never block the caller.
+        Coalesced frames wait in the queue until the window ends and are
+        written together.
+
+        :param frame:
+        :param overflow_policy: one of validation.OVERFLOW_POLICIES
+        :param count: number of messages in the frame
+        :param coalesce_ms: coalescing window requested by the sender,
+                            the longer of sender's and connection's is used
+        :param coalesce_messages: flush the window once that many messages
+                                  are pending, 0 means no limit
+        :return: True if frame got queued
+        """
+        if len(self.send_queue) >= self.max_send_queue:
+            self.dropped_frames += 1
+            if overflow_policy == "drop_newest":
+                return False
+            elif overflow_policy == "disconnect":
+                log.info("%s send queue overflow, disconnecting" % self)
+                self.send_queue.clear()
+                self.close_window()
+                self.mark_for_gc()
+                return False
+            self.send_queue.popleft()
+        self.send_queue.append(frame)
+        coalesce_ms = max(coalesce_ms, self.coalesce_ms)
+        if coalesce_ms:
+            self.coalesce(coalesce_ms, coalesce_messages, count)
+        elif self.flush_at is not None:
+            # frames that shouldn't wait flush the open window with them
+            self.flush_at = time.time()
+            self.send_event.set()
+        else:
+            self.send_event.set()
+        return True
+
+    def coalesce(self, coalesce_ms, coalesce_messages, count):
+        """
+        Adds queued frame to the coalescing window, writer is woken up only
+        when window opens, gets shorter or fills up
+        """
+        now = time.time()
+        deadline = now + coalesce_ms / 1000.0
+        limits = [
+            limit for limit in (coalesce_messages, self.coalesce_messages) if limit
+        ]
+        limit = min(limits) if limits else 0
+        wake = False
+        if self.flush_at is None:
+            self.window_started = now
+            self.flush_at = deadline
+            self.flush_limit = limit
+            self.pending_messages = 0
+            wake = True
+        else:
+            if deadline < self.flush_at:
+                self.flush_at = deadline
+                wake = True
+            if limit and (not self.flush_limit or limit < self.flush_limit):
+                self.flush_limit = limit
+        self.pending_messages += count
+        if self.flush_limit and self.pending_messages >= self.flush_limit:
+            self.flush_at = now
+            wake = True
+        if wake:
+            self.send_event.set()
+
+    def close_window(self):
+        self.flush_at = None
+        self.flush_limit = 0
+        self.window_started = None
+        self.pending_messages = 0
+
+    def attach_socket(self, socket):
+        """
+        Attaches websocket to connection and starts writer for it
+        :param socket:
+        """
+        self.socket = socket
+        self.transport = "websocket"
+        self.attached_remotely = False
+        self.attachment_changed()
+        gevent.spawn(self.write_frames, socket)
+
+    def attach_queue(self, queue):
+        """
+        Attaches long polling queue to connection
+        :param queue:
+        """
+        self.queue = queue
+        self.transport = "long_poll"
+        self.attached_remotely = False
+        self.attachment_changed()
+
+    def attach_poll_buffer(self, transport="long_poll"):
+        """
+        Attaches long polling buffer to connection unless it has one already,
+        messages sent between polls wait there for the next poll. Client
+        coming back from another worker gets a new buffer, it has to catch up.
+        :param transport: long_poll or sse
+        :return: True if new buffer was attached
+        """
+        self.transport = transport
+        reuse = isinstance(self.queue, PollBuffer) and not self.attached_remotely
+        self.attached_remotely = False
+        if reuse:
+            self.attachment_changed()
+            return False
+        self.queue = PollBuffer(maxlen=self.max_send_queue)
+        self.attachment_changed()
+        return True
+
+    @property
+    def reattaching(self):
+        """
+        True if client had this connection attached before - on this worker,
+        on another one or before restart
+        """
+        return self.restored or self.attached_remotely or self.transport is not None
+
+    @property
+    def attached_locally(self):
+        """
+        True if socket or poll buffer of this connection is held by this worker
+        """
+        if self.attached_remotely:
+            return False
+        return self.socket is not None or self.queue is not None
+
+    def attachment_changed(self):
+        """
+        Updates subscribed channels' indexes of locally attached connections
+        """
+        server_state = get_state(self.tenant_id)
+        for channel_name in sorted(self.channel_names):
+            with server_state.channel_lock(channel_name):
+                channel = server_state.channels.get(channel_name)
+                if channel is not None:
+                    channel.track_attachment(self)
+
+    def write_frames(self, socket):
+        """
+        Writer loop, drains the send queue until socket goes away
+        :param socket:
+        """
+        server_state = get_state(self.tenant_id)
+        while self.socket is socket and not socket.terminated:
+            # heartbeats wake us up periodically anyway
+            timeout = 5
+            if self.flush_at is not None:
+                timeout = max(self.flush_at - time.time(), 0)
+            self.send_event.wait(timeout=timeout)
+            self.send_event.clear()
+            depth = len(self.send_queue)
+            started = time.time()
+            if self.flush_at is not None:
+                now = started
+                if now < self.flush_at:
+                    continue
+                # whole window goes out as one frame
+                frames = list(self.send_queue)
+                self.send_queue.clear()
+                server_state.flush_latency.observe(now - self.window_started)
+                self.close_window()
+                if frames and not self.write_frame(
+                    socket, merge_frames(frames), server_state
+                ):
+                    return
+            while self.send_queue and self.flush_at is None and not socket.terminated:
+                frame = self.send_queue.popleft()
+                if not self.write_frame(socket, frame, server_state):
+                    return
+            if depth:
+                # observed once per wake up, not per frame
+                server_state.queue_depth.observe(depth)
+                server_state.send_latency.observe(time.time() - started)
+
+    def write_frame(self, socket, frame, server_state):
+        """
+        Writes frame to the websocket
+        :return: False if socket failed
+        """
+        try:
+            socket.send(frame)
+        except Exception as exc:
+            log.info(exc)
+            self.mark_for_gc()
+            return False
+        self.mark_activity()
+        user = server_state.users.get(self.username)
+        if user:
+            user.mark_activity()
+        return True
+
+    @property
+    def is_slow_consumer(self):
+        return self.dropped_frames > 0 or len(self.send_queue) > self.max_send_queue / 2
 
     def mark_for_gc(self):
         # set last active time for connection 1 hour in past for GC
         self.last_active -= timedelta(days=60)
+        # move collection forward unless it is already due or done
+        if self.gc_deadline is not None and self.gc_deadline > datetime.utcnow():
+            schedule_conn_gc(self)
 
     def heartbeat(self):
-        if self.socket or self.queue:
+        """
+        Sends empty frame to keep the connection alive,
+        called periodically by heartbeat wheel
+        """
+        # frames that are still waiting keep the connection alive anyway
+        if (self.socket or self.queue) and not self.send_queue:
             try:
-                self.add_message()
-                gevent.spawn_later(5, self.heartbeat)
+                self.add_message(encoded=HEARTBEAT_FRAME)
             except Exception:
                 self.mark_for_gc()
                 if self.socket:
                     self.socket.close()
 
-    def get_catchup_messages(self):
-        server_state = get_state()
+    def get_catchup_messages(
+        self, resume=None, resume_user=None, since=None, upto=None, upto_user=None
+    ):
+        """
+        Messages sent while client was away, channels and user frames
+        with known resume position are resumed right after that message,
+        others by last activity of connection
+
+        :param resume: {channel name: sequence number of last received message}
+        :param resume_user: sequence number of last received private message
+        :param since: catch up from this time instead of last activity
+        :param upto: {channel name: sequence number}, skips channel messages
+            sent after that message
+        :param upto_user: skips private messages sent after that message
+        :return:
+        """
+        server_state = get_state(self.tenant_id)
+        resume = resume or {}
+        if since is None:
+            since = self.last_active
         messages = []
         # return catchup messages for channels
         for channel in self.channels:
             channel_inst = server_state.channels[channel]
-            messages.extend(
-                channel_inst.get_catchup_frames(self.last_active, self.username)
-            )
+            if channel in resume:
+                found = channel_inst.get_frames_after_seq(
+                    resume[channel], self.username
+                )
+            else:
+                found = channel_inst.get_catchup_frames(since, self.username)
+            if upto is not None:
+                last = upto.get(channel, 0)
+                found = [m for m in found if m.get("seq", 0) <= last]
+            messages.extend(found)
         # and users
-        messages.extend(
-            server_state.users[self.username].get_catchup_frames(self.last_active)
-        )
+        user = server_state.users[self.username]
+        if resume_user is not None:
+            found = user.get_frames_after_seq(resume_user)
+        else:
+            found = user.get_catchup_frames(since)
+        if upto_user is not None:
+            found = [m for m in found if m.get("seq", 0) <= upto_user]
+        messages.extend(found)
         return messages
 
-    def deliver_catchup_messages(self):
-        [self.add_message(m) for m in self.get_catchup_messages()]
+    def catchup_bounds(self):
+        """
+        Current catchup window of the connection, catchup delivered later
+        with these bounds skips messages that were meanwhile sent live
+
+        :return: dict of `since`, `upto` and `upto_user` arguments
+            of get_catchup_messages()
+        """
+        server_state = get_state(self.tenant_id)
+        upto = {}
+        for channel in self.channel_names:
+            channel_inst = server_state.channels.get(channel)
+            if channel_inst is not None:
+                upto[channel] = channel_inst.seq
+        user = server_state.users.get(self.username)
+        return {
+            "since": self.last_active,
+            "upto": upto,
+            "upto_user": user.seq if user is not None else 0,
+        }
+
+    def deliver_catchup_messages(
+        self, resume=None, resume_user=None, since=None, upto=None, upto_user=None
+    ):
+        messages = self.get_catchup_messages(
+            resume, resume_user, since=since, upto=upto, upto_user=upto_user
+        )
+        if isinstance(self.queue, PollBuffer):
+            # catchup goes ahead of live messages held while it was deferred
+            self.queue.release(messages)
+        elif messages:
+            self.add_messages(messages)
+
+    def valid_cursor(self, cursor):
+        """
+        Positions from the future (e.g. issued before restart) are reset,
+        client gets all stored frames of such channel like on resume
+
+        :param cursor: {channel name or None: seq}
+        :return:
+        """
+        server_state = get_state(self.tenant_id)
+        valid = {}
+        for channel_name, seq in cursor.items():
+            if channel_name is None:
+                source = server_state.users.get(self.username)
+            else:
+                source = server_state.channels.get(channel_name)
+            valid[channel_name] = seq if source and seq <= source.seq else 0
+        return valid
 
     @property
     def channels(self):
@@ -87,13 +584,7 @@ class Connection(object):
         Return list of channels names connection belongs to
         :return:
         """
-        server_state = get_state()
-        found_channels = []
-        for channel in six.itervalues(server_state.channels):
-            user_conns = channel.connections.get(self.username) or []
-            if self in user_conns:
-                found_channels.append(channel.name)
-        return sorted(found_channels)
+        return sorted(self.channel_names)
 
     def __json__(self):
         return self.id
@@ -0,0 +1,58 @@
+from channelstream import patched_json as json
+
+# keys that control delivery and are never sent to clients
+DELIVERY_KEYS = ("no_history", "pm_users", "exclude_users")
+
+
+class Envelope(object):
+    """
+    Wraps a message for delivery, keeps delivery metadata apart from
+    the client visible payload. Payload is built once and shared by fan-out,
+    stored frames and catchup, it must not be mutated - edits create
+    a new envelope.
+    """
+
+    __slots__ = ("payload", "pm_users", "exclude_users", "seq", "_catchup")
+
+    def __init__(self, message, pm_users=None, exclude_users=None, seq=None):
+        """
+
+        :param message: message dict, delivery keys are stripped from payload
+        :param pm_users: defaults to message "pm_users"
+        :param exclude_users: defaults to message "exclude_users"
+        :param seq: sequence number of message in its channel or user frames,
+                    sent to clients so they can resume after it
+        """
+        self.payload = {k: v for k, v in message.items() if k not in DELIVERY_KEYS}
+        if seq is not None:
+            self.payload["seq"] = seq
+        self.seq = seq
+        self.pm_users = pm_users or message.get("pm_users") or []
+        self.exclude_users = exclude_users or message.get("exclude_users") or []
+        self._catchup = None
+
+    def delivers_to(self, username):
+        """
+        Checks if user should receive this message, exclusion wins over PM
+        :param username:
+        :return:
+        """
+        if self.exclude_users and username in self.exclude_users:
+            return False
+        return not self.pm_users or username in self.pm_users
+
+    def encode(self):
+        """
+        Serializes wire frame with the payload, not cached so stored frames
+        don't keep encoded copies around
+        """
+        return json.dumps([self.payload])
+
+    @property
+    def catchup_payload(self):
+        """
+        Payload variant delivered on reconnect, built on first use
+        """
+        if self._catchup is None:
+            self._catchup = dict(self.payload, catchup=True)
+        return self._catchup
@@ -1,66 +1,169 @@
+import heapq
+import itertools
 import logging
 from datetime import datetime, timedelta
 
 import gevent
 import six
 
-from channelstream.server_state import get_state
+from channelstream import bus
+from channelstream.heartbeat import WHEEL
+from channelstream.server_state import get_state, DEFAULT_TENANT, STATES
 
 log = logging.getLogger(__name__)
 
+# connections inactive for this long get collected
+CONN_TIMEOUT = timedelta(seconds=15)
 
-def gc_conns():
-    server_state = get_state()
-    with server_state.lock:
-        start_time = datetime.utcnow()
-        threshold = start_time - timedelta(seconds=15)
-        collected_conns = []
-        # collect every ref in chanels
-        # remove connections from channels
-        for channel in six.itervalues(server_state.channels):
-            for username, conns in list(channel.connections.items()):
-                for conn in conns:
-                    if conn.last_active < threshold:
-                        channel.connections[username].remove(conn)
-                        collected_conns.append(conn)
-                channel.after_parted(username)
-        # remove old conns from users and connection dictionaries
-        for conn in collected_conns:
-            if conn.username in server_state.users:
-                if conn in server_state.users[conn.username].connections:
-                    server_state.users[conn.username].connections.remove(conn)
-            if conn.id in server_state.connections:
-                del server_state.connections[conn.id]
-            # make sure connection is closed after we garbage
-            # collected it from our list
-            if conn.socket:
-                try:
-                    conn.socket.close()
-                except Exception:
-                    raise
-        log.debug("gc_conns() time %s" % (datetime.utcnow() - start_time))
-
-
-def gc_users():
-    server_state = get_state()
-    with server_state.lock:
+# tie breaker so heap never has to compare connections
+_deadline_counter = itertools.count()
+
+
+def schedule_conn_gc(connection, deadline=None):
+    """
+    Schedules expiry check for connection, entries pushed earlier for the
+    same connection become stale and are skipped by gc_conns()
+
+    :param connection:
+    :param deadline: defaults to last activity + CONN_TIMEOUT
+    :return:
+    """
+    server_state = get_state(connection.tenant_id)
+    if deadline is None:
+        deadline = connection.last_active + CONN_TIMEOUT
+    connection.gc_deadline = deadline
+    heapq.heappush(
+        server_state.conn_deadlines, (deadline, next(_deadline_counter), connection)
+    )
+
+
+def collect_connection(connection):
+    """
+    Removes connection from channels, user, connection registry
+    and heartbeat wheel, must not be called with a channel lock held
+    :param connection:
+    :return:
+    """
+    server_state = get_state(connection.tenant_id)
+    WHEEL.remove(connection)
+    for channel_name in list(connection.channel_names):
+        with server_state.channel_lock(channel_name):
+            channel = server_state.channels.get(channel_name)
+            if channel:
+                channel.remove_connection(connection)
+    connection.channel_names.clear()
+    with server_state.registry_lock:
+        user = server_state.users.get(connection.username)
+        if user and connection in user.connections:
+            user.connections.remove(connection)
+        if server_state.connections.get(connection.id) is connection:
+            del server_state.connections[connection.id]
+
+
+def gc_conns(tenant_id=DEFAULT_TENANT):
+    """
+    Collects connections of a tenant whose deadline passed without any
+    activity, only connections at the front of the deadline heap are inspected.
+    Expired connections are picked under the registry lock, then detached
+    from channels one channel lock at a time
+    """
+    server_state = get_state(tenant_id)
+    start_time = datetime.utcnow()
+    collected_conns = []
+    deadlines = server_state.conn_deadlines
+    with server_state.registry_lock:
+        while deadlines and deadlines[0][0] <= start_time:
+            deadline, _, conn = heapq.heappop(deadlines)
+            if conn.gc_deadline != deadline:
+                # rescheduled or already collected
+                continue
+            if conn.last_active + CONN_TIMEOUT > start_time:
+                # connection was active since it got scheduled
+                schedule_conn_gc(conn)
+                continue
+            if conn.attached_remotely:
+                # worker holding the socket decides when to collect it
+                schedule_conn_gc(conn, deadline=start_time + CONN_TIMEOUT)
+                continue
+            conn.gc_deadline = None
+            collected_conns.append(conn)
+    for conn in collected_conns:
+        collect_connection(conn)
+        bus.publish("collect", conn.id, tenant_id)
+    # make sure connection is closed after we garbage
+    # collected it from our lists, closing can block so do it without the lock
+    for conn in collected_conns:
+        if conn.socket:
+            try:
+                conn.socket.close()
+            except Exception as exc:
+                log.info(exc)
+    duration = (datetime.utcnow() - start_time).total_seconds()
+    server_state.gc_pause.observe(duration)
+    server_state.stats["gc_conns_collected"] += len(collected_conns)
+    server_state.stats["gc_conns_last_duration"] = duration
+    server_state.stats["gc_conns_max_duration"] = max(
+        duration, server_state.stats["gc_conns_max_duration"]
+    )
+    log.debug(
+        "gc_conns(%s) time %s, collected %s"
+        % (tenant_id, duration, len(collected_conns))
+    )
+    return collected_conns
+
+
+def gc_users(tenant_id=DEFAULT_TENANT):
+    server_state = get_state(tenant_id)
+    with server_state.registry_lock:
         start_time = datetime.utcnow()
         threshold = datetime.utcnow() - timedelta(days=1)
         for user in list(six.itervalues(server_state.users)):
-            if user.last_active < threshold:
+            # users connected through other workers look inactive here
+            if user.last_active < threshold and not user.connections:
                 server_state.users.pop(user.username)
-        log.debug("gc_users() time %s" % (datetime.utcnow() - start_time))
+        log.debug("gc_users(%s) time %s" % (tenant_id, datetime.utcnow() - start_time))
+
+
+def collect_remote(conn_id, tenant_id=DEFAULT_TENANT):
+    """
+    Collects connection that was collected by another worker
+    :param conn_id:
+    :param tenant_id:
+    :return:
+    """
+    conn = get_state(tenant_id).connections.get(conn_id)
+    if conn is not None:
+        conn.gc_deadline = None
+        collect_connection(conn)
+        if conn.socket:
+            try:
+                conn.socket.close()
+            except Exception as exc:
+                log.info(exc)
 
 
-def gc_users_forever():
+bus.register("collect", collect_remote)
+
+
+def gc_users_forever(tenant_id=DEFAULT_TENANT):
     try:
-        gc_users()
+        gc_users(tenant_id)
     finally:
-        gevent.spawn_later(60, gc_users_forever)
+        gevent.spawn_later(60, gc_users_forever, tenant_id)
 
 
-def gc_conns_forever():
+def gc_conns_forever(tenant_id=DEFAULT_TENANT):
     try:
-        gc_conns()
+        gc_conns(tenant_id)
     finally:
-        gevent.spawn_later(1, gc_conns_forever)
+        gevent.spawn_later(1, gc_conns_forever, tenant_id)
+
+
+def start_gc():
+    """
+    Starts separate GC loops for every tenant so a tenant with many
+    connections doesn't delay collection for others
+    """
+    for tenant_id in list(STATES):
+        gc_conns_forever(tenant_id)
+        gc_users_forever(tenant_id)
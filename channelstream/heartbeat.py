@@ -0,0 +1,69 @@
+import logging
+import random
+
+import gevent
+
+log = logging.getLogger(__name__)
+
+# seconds between heartbeats sent to single connection
+HEARTBEAT_INTERVAL = 5
+WHEEL_SLOTS = 50
+
+
+class HeartbeatWheel(object):
+    """
+    Timing wheel that spreads connection heartbeats over the interval,
+    every tick sends heartbeats to connections assigned to current slot
+    """
+
+    def __init__(self, interval=HEARTBEAT_INTERVAL, slots=WHEEL_SLOTS):
+        """
+
+        :param interval: seconds between heartbeats of a connection
+        :param slots: how many ticks one interval is divided into
+        """
+        self.interval = interval
+        self.slots = [set() for _ in range(slots)]
+        self.positions = {}
+        self.current = 0
+
+    def __len__(self):
+        return len(self.positions)
+
+    @property
+    def tick_interval(self):
+        return float(self.interval) / len(self.slots)
+
+    def add(self, connection):
+        if connection in self.positions:
+            return
+        # random slot works as jitter so heartbeats don't come in bursts
+        slot = random.randrange(len(self.slots))
+        self.slots[slot].add(connection)
+        self.positions[connection] = slot
+
+    def remove(self, connection):
+        slot = self.positions.pop(connection, None)
+        if slot is not None:
+            self.slots[slot].discard(connection)
+
+    def tick(self):
+        """
+        Sends heartbeats to connections in current slot and advances the wheel
+        :return: number of connections in processed slot
+        """
+        slot = self.slots[self.current]
+        self.current = (self.current + 1) % len(self.slots)
+        for connection in list(slot):
+            connection.heartbeat()
+        return len(slot)
+
+
+WHEEL = HeartbeatWheel()
+
+
+def heartbeat_forever():
+    try:
+        WHEEL.tick()
+    finally:
+        gevent.spawn_later(WHEEL.tick_interval, heartbeat_forever)
@@ -0,0 +1,78 @@
+import time
+
+from gevent.lock import RLock
+
+# number of locks channel names are spread over
+CHANNEL_LOCK_STRIPES = 64
+
+
+class TimedRLock(object):
+    """
+    Reentrant lock that records how long greenlets had to wait for it
+    """
+
+    def __init__(self):
+        self._lock = RLock()
+        self.acquired = 0
+        self.contended = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def acquire(self):
+        self.acquired += 1
+        if self._lock.acquire(blocking=False):
+            return True
+        start = time.time()
+        self._lock.acquire()
+        waited = time.time() - start
+        self.contended += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        return True
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def stats(self):
+        return {
+            "acquired": self.acquired,
+            "contended": self.contended,
+            "wait_total": self.wait_total,
+            "wait_max": self.wait_max,
+        }
+
+
+class LockStripes(object):
+    """
+    Fixed set of locks, a name always maps to the same lock so unrelated
+    channels rarely wait for each other
+    """
+
+    def __init__(self, size=CHANNEL_LOCK_STRIPES):
+        """
+
+        :param size: number of stripes
+        """
+        self.locks = [TimedRLock() for _ in range(size)]
+
+    def for_name(self, name):
+        return self.locks[hash(name) % len(self.locks)]
+
+    def stats(self):
+        """
+        Wait stats summed over all stripes
+        :return:
+        """
+        stats = {"acquired": 0, "contended": 0, "wait_total": 0.0, "wait_max": 0.0}
+        for lock in self.locks:
+            stats["acquired"] += lock.acquired
+            stats["contended"] += lock.contended
+            stats["wait_total"] += lock.wait_total
+            stats["wait_max"] = max(stats["wait_max"], lock.wait_max)
+        return stats
@@ -0,0 +1,231 @@
+"""
+Server metrics in Prometheus text exposition format.
+
+Hot paths only bump counters in `State.stats` and observe values into
+per tenant histograms, everything else is computed when metrics are scraped.
+"""
+from datetime import datetime
+
+import six
+
+from channelstream.server_state import STATES, STATS
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+TRANSPORTS = ("websocket", "long_poll", "sse", "remote", "detached")
+
+# (metric name, key of State.stats, help)
+COUNTERS = (
+    ("channelstream_messages_total", "total_messages", "Messages delivered"),
+    (
+        "channelstream_unique_messages_total",
+        "total_unique_messages",
+        "Messages received for delivery",
+    ),
+    (
+        "channelstream_rejected_connections_total",
+        "rejected_connections",
+        "Connections rejected by quota",
+    ),
+    (
+        "channelstream_rejected_messages_total",
+        "rejected_messages",
+        "Messages rejected by quota",
+    ),
+    (
+        "channelstream_gc_collected_connections_total",
+        "gc_conns_collected",
+        "Connections collected by GC",
+    ),
+    (
+        "channelstream_reconnect_storms_total",
+        "reconnect_storms",
+        "Times tenant entered reconnect storm mode",
+    ),
+    (
+        "channelstream_deferred_catchups_total",
+        "deferred_catchups",
+        "Catchups queued during reconnect storms",
+    ),
+    (
+        "channelstream_suppressed_presence_total",
+        "suppressed_presence",
+        "Presence messages not sent during reconnect storms",
+    ),
+)
+
+# (metric name, key of State.get_tenant_info(), help)
+GAUGES = (
+    ("channelstream_users", "total_users", "Users known to the server"),
+    ("channelstream_channels", "total_channels", "Channels"),
+    (
+        "channelstream_saved_connections",
+        "saved_connections",
+        "Connections restored from snapshot and not reattached yet",
+    ),
+    (
+        "channelstream_messages_per_second",
+        "messages_per_second",
+        "Messages received during last full second",
+    ),
+    (
+        "channelstream_reconnects_per_second",
+        "reconnects_per_second",
+        "Clients attaching during last full second",
+    ),
+    ("channelstream_reconnect_storm", "reconnect_storm", "1 during reconnect storm"),
+    ("channelstream_queued_catchups", "queued_catchups", "Catchups waiting in queue"),
+)
+
+# (metric name, State attribute, help)
+HISTOGRAMS = (
+    (
+        "channelstream_fanout_seconds",
+        "fanout_latency",
+        "Time to hand one broadcast to subscribed connections",
+    ),
+    (
+        "channelstream_fanout_subscribers",
+        "fanout_subscribers",
+        "Connections reached by one broadcast",
+    ),
+    (
+        "channelstream_websocket_send_seconds",
+        "send_latency",
+        "Time to write frames waiting when websocket writer wakes up",
+    ),
+    (
+        "channelstream_send_queue_depth",
+        "queue_depth",
+        "Frames waiting in send queue when websocket writer wakes up",
+    ),
+    (
+        "channelstream_flush_latency_seconds",
+        "flush_latency",
+        "Time coalesced frames waited before being written",
+    ),
+    ("channelstream_gc_pause_seconds", "gc_pause", "Duration of connection GC runs"),
+    (
+        "channelstream_connect_seconds",
+        "connect_latency",
+        "Time to handle connect request",
+    ),
+    (
+        "channelstream_subscribe_seconds",
+        "subscribe_latency",
+        "Time to handle subscribe request",
+    ),
+)
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
+
+
+def format_labels(labels):
+    """
+    :param labels: [(name, value)]
+    :return: labels in curly braces with escaped values
+    """
+    escaped = []
+    for name, value in labels:
+        value = (
+            six.text_type(value)
+            .replace("\\", "\\\\")
+            .replace("\n", "\\n")
+            .replace('"', '\\"')
+        )
+        escaped.append('{}="{}"'.format(name, value))
+    return "{" + ",".join(escaped) + "}"
+
+
+def connection_transport(connection):
+    """
+    :param connection:
+    :return: one of TRANSPORTS
+    """
+    if connection.attached_remotely:
+        return "remote"
+    if connection.transport == "websocket" and connection.socket.terminated:
+        return "detached"
+    return connection.transport or "detached"
+
+
+def count_transports(server_state):
+    """
+    :param server_state:
+    :return: {transport: number of connections}
+    """
+    counts = dict.fromkeys(TRANSPORTS, 0)
+    for connection in list(six.itervalues(server_state.connections)):
+        counts[connection_transport(connection)] += 1
+    return counts
+
+
+def render(states=None):
+    """
+    Renders metrics of every tenant, every sample has `tenant` label
+
+    :param states: {tenant id: State}, defaults to all tenants
+    :return: text exposition format
+    """
+    if states is None:
+        states = STATES
+    tenants = sorted(six.iteritems(states))
+    lines = []
+
+    def family(name, kind, help_text):
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} {}".format(name, kind))
+
+    def sample(name, labels, value):
+        lines.append(name + format_labels(labels) + " " + format_value(value))
+
+    uptime = (datetime.utcnow() - STATS["started_on"]).total_seconds()
+    family("channelstream_uptime_seconds", "gauge", "Time since server start")
+    lines.append("channelstream_uptime_seconds " + format_value(uptime))
+
+    family("channelstream_connections", "gauge", "Connections by transport clients use")
+    for tenant_id, server_state in tenants:
+        counts = count_transports(server_state)
+        for transport in TRANSPORTS:
+            sample(
+                "channelstream_connections",
+                [("tenant", tenant_id), ("transport", transport)],
+                counts[transport],
+            )
+
+    tenant_infos = [
+        (tenant_id, server_state.get_tenant_info())
+        for tenant_id, server_state in tenants
+    ]
+    for name, key, help_text in GAUGES:
+        family(name, "gauge", help_text)
+        for tenant_id, tenant_info in tenant_infos:
+            sample(name, [("tenant", tenant_id)], tenant_info[key])
+
+    for name, key, help_text in COUNTERS:
+        family(name, "counter", help_text)
+        for tenant_id, server_state in tenants:
+            sample(name, [("tenant", tenant_id)], server_state.stats[key])
+
+    for name, attribute, help_text in HISTOGRAMS:
+        family(name, "histogram", help_text)
+        for tenant_id, server_state in tenants:
+            histogram = getattr(server_state, attribute)
+            for bound, count in histogram.cumulative_counts():
+                sample(
+                    name + "_bucket",
+                    [("tenant", tenant_id), ("le", format_value(bound))],
+                    count,
+                )
+            sample(
+                name + "_bucket",
+                [("tenant", tenant_id), ("le", "+Inf")],
+                histogram.count,
+            )
+            sample(name + "_sum", [("tenant", tenant_id)], histogram.sum)
+            sample(name + "_count", [("tenant", tenant_id)], histogram.count)
+    return "\n".join(lines) + "\n"
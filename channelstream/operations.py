@@ -1,8 +1,14 @@
+import collections
+import functools
 import logging
 
+import six
+
+from channelstream import bus, cluster, storage
 from channelstream.channel import Channel
 from channelstream.connection import Connection
-from channelstream.server_state import get_state
+from channelstream.envelope import Envelope
+from channelstream.server_state import get_state, DEFAULT_TENANT
 from channelstream.user import User
 
 log = logging.getLogger(__name__)
@@ -16,6 +22,10 @@ def connect(
     conn_id=None,
     channels=None,
     channel_configs=None,
+    tenant_id=DEFAULT_TENANT,
+    enforce_quota=True,
+    coalesce_ms=0,
+    coalesce_messages=0,
 ):
     """
 
@@ -26,12 +36,18 @@ def connect(
     :param conn_id:
     :param channels:
     :param channel_configs:
+    :param tenant_id:
+    :param enforce_quota: replicas apply connections accepted by other workers
+    :param coalesce_ms: coalescing window of connection
+    :param coalesce_messages: message limit of connection's coalescing window
     :return:
     """
-    server_state = get_state()
-    with server_state.lock:
+    server_state = get_state(tenant_id)
+    with server_state.registry_lock:
+        if enforce_quota:
+            server_state.check_connection_quota(conn_id)
         if username not in server_state.users:
-            user = User(username)
+            user = User(username, tenant_id=tenant_id)
             user.state_from_dict(fresh_user_state)
             server_state.users[username] = user
         else:
@@ -40,20 +56,45 @@ def connect(
             user.state_public_keys = state_public_keys
 
         user.state_from_dict(update_user_state)
-        connection = Connection(username, conn_id)
+        connection = Connection(
+            username,
+            conn_id,
+            tenant_id=tenant_id,
+            coalesce_ms=coalesce_ms,
+            coalesce_messages=coalesce_messages,
+        )
         if connection.id not in server_state.connections:
             server_state.connections[connection.id] = connection
         user.add_connection(connection)
-        for channel_name in channels:
-            # user gets assigned to a channel
-            if channel_name not in server_state.channels:
-                channel = Channel(
-                    channel_name, channel_config=channel_configs.get(channel_name)
-                )
-                server_state.channels[channel_name] = channel
-            server_state.channels[channel_name].add_connection(connection)
-        log.info("connecting %s with uuid %s" % (username, connection.id))
-        return connection, user
+    for channel_name in channels:
+        # user gets assigned to a channel
+        with server_state.channel_lock(channel_name):
+            channel = get_or_create_channel(
+                channel_name, channel_configs.get(channel_name), tenant_id
+            )
+            channel.add_connection(connection)
+    log.info("connecting %s with uuid %s" % (username, connection.id))
+    return connection, user
+
+
+def get_or_create_channel(channel_name, channel_config=None, tenant_id=DEFAULT_TENANT):
+    """
+    Returns existing channel or registers a new one,
+    caller holds the channel lock
+
+    :param channel_name:
+    :param channel_config: used only when channel gets created
+    :param tenant_id:
+    :return:
+    """
+    server_state = get_state(tenant_id)
+    channel = server_state.channels.get(channel_name)
+    if channel is None:
+        channel = Channel(
+            channel_name, channel_config=channel_config, tenant_id=tenant_id
+        )
+        server_state.channels[channel_name] = channel
+    return channel
 
 
 def subscribe(connection=None, channels=None, channel_configs=None):
@@ -64,21 +105,18 @@ def subscribe(connection=None, channels=None, channel_configs=None):
     :param channel_configs:
     :return:
     """
-    server_state = get_state()
+    server_state = get_state(connection.tenant_id)
     user = server_state.users.get(connection.username)
     subscribed_to = []
-    with server_state.lock:
-        if user:
-            for channel_name in channels:
-                if channel_name not in server_state.channels:
-                    channel = Channel(
-                        channel_name, channel_config=channel_configs.get(channel_name)
-                    )
-                    server_state.channels[channel_name] = channel
-                is_found = server_state.channels[channel_name].add_connection(
-                    connection
+    if user:
+        for channel_name in channels:
+            with server_state.channel_lock(channel_name):
+                channel = get_or_create_channel(
+                    channel_name,
+                    channel_configs.get(channel_name),
+                    connection.tenant_id,
                 )
-                if is_found:
+                if channel.add_connection(connection):
                     subscribed_to.append(channel_name)
     return subscribed_to
 
@@ -90,18 +128,15 @@ def unsubscribe(connection=None, unsubscribe_channels=None):
     :param unsubscribe_channels:
     :return:
     """
-    server_state = get_state()
+    server_state = get_state(connection.tenant_id)
     user = server_state.users.get(connection.username)
     unsubscribed_from = []
-    with server_state.lock:
-        if user:
-            for channel_name in unsubscribe_channels:
-                if channel_name in server_state.channels:
-                    is_found = server_state.channels[channel_name].remove_connection(
-                        connection
-                    )
-                    if is_found:
-                        unsubscribed_from.append(channel_name)
+    if user:
+        for channel_name in unsubscribe_channels:
+            with server_state.channel_lock(channel_name):
+                channel = server_state.channels.get(channel_name)
+                if channel and channel.remove_connection(connection):
+                    unsubscribed_from.append(channel_name)
     return unsubscribed_from
 
 
@@ -116,19 +151,22 @@ def change_user_state(user_inst=None, user_state=None):
     # mark active
     user_inst.mark_activity()
     if changed:
-        channels = user_inst.get_channels()
-        for channel in [c for c in channels if c.notify_state]:
-            channel.send_user_state(user_inst, changed)
+        server_state = get_state(user_inst.tenant_id)
+        for channel in user_inst.get_channels():
+            with server_state.channel_lock(channel.name):
+                if channel.notify_state:
+                    channel.send_user_state(user_inst, changed)
     return changed
 
 
-def disconnect(conn_id):
+def disconnect(conn_id, tenant_id=DEFAULT_TENANT):
     """
 
     :param conn_id:
+    :param tenant_id:
     :return:
     """
-    server_state = get_state()
+    server_state = get_state(tenant_id)
     conn = server_state.connections.get(conn_id)
     if conn is not None:
         conn.mark_for_gc()
@@ -136,65 +174,96 @@ def disconnect(conn_id):
     return False
 
 
-def set_channel_config(channel_configs):
+def set_channel_config(channel_configs, tenant_id=DEFAULT_TENANT):
     """
 
     :param channel_configs:
+    :param tenant_id:
     :return:
     """
-    server_state = get_state()
-    with server_state.lock:
-        for channel_name, config in channel_configs.items():
+    server_state = get_state(tenant_id)
+    for channel_name, config in channel_configs.items():
+        with server_state.channel_lock(channel_name):
             if not server_state.channels.get(channel_name):
-                channel = Channel(
-                    channel_name, channel_config=channel_configs.get(channel_name)
-                )
-                server_state.channels[channel_name] = channel
+                get_or_create_channel(channel_name, config, tenant_id)
             else:
-                channel = server_state.channels[channel_name]
-                channel.reconfigure_from_dict(channel_configs.get(channel_name))
+                server_state.channels[channel_name].reconfigure_from_dict(config)
 
 
-def pass_message(msg, stats):
+def pass_message(msg, stats, tenant_id=DEFAULT_TENANT):
     """
 
     :param msg:
     :param stats:
+    :param tenant_id:
     :return:
     """
-    server_state = get_state()
-    msg["catchup"] = False
-    msg["edited"] = None
-    msg["type"] = "message"
+    pass_messages([msg], stats, tenant_id)
+
+
+def group_messages(msgs):
+    """
+    Groups messages by channel and by PM recipient keeping their order
+
+    :param msgs:
+    :return: ({channel_name: [msg]}, {username: [msg]})
+    """
+    by_channel = collections.OrderedDict()
+    by_user = collections.OrderedDict()
+    for msg in msgs:
+        if msg.get("channel"):
+            by_channel.setdefault(msg["channel"], []).append(msg)
+        elif msg["pm_users"]:
+            for username in msg["pm_users"]:
+                by_user.setdefault(username, []).append(msg)
+    return by_channel, by_user
+
+
+def pass_messages(msgs, stats, tenant_id=DEFAULT_TENANT):
+    """
+    Delivers a batch of messages, subscribers of every channel are walked
+    once per batch and each connection gets one frame
+
+    :param msgs:
+    :param stats:
+    :param tenant_id:
+    :return:
+    """
+    server_state = get_state(tenant_id)
+    for msg in msgs:
+        msg["catchup"] = False
+        msg["edited"] = None
+        msg["type"] = "message"
 
     total_sent = 0
-    stats["total_unique_messages"] += 1
-    if msg.get("channel"):
-        channel_inst = server_state.channels.get(msg["channel"])
-        if channel_inst:
-            total_sent += channel_inst.add_message(
-                msg, pm_users=msg["pm_users"], exclude_users=msg["exclude_users"]
-            )
-    elif msg["pm_users"]:
-        # if pm then iterate over all users and notify about new message!
-        for username in msg["pm_users"]:
-            user_inst = server_state.users.get(username)
-            if user_inst:
-                total_sent += user_inst.add_message(msg)
+    stats["total_unique_messages"] += len(msgs)
+    by_channel, by_user = group_messages(msgs)
+    for channel_name, channel_msgs in six.iteritems(by_channel):
+        with server_state.channel_lock(channel_name):
+            channel_inst = server_state.channels.get(channel_name)
+            if channel_inst:
+                total_sent += channel_inst.add_messages(channel_msgs)
+    # if pm then iterate over all users and notify about new messages!
+    for username, user_msgs in six.iteritems(by_user):
+        user_inst = server_state.users.get(username)
+        if user_inst:
+            total_sent += user_inst.add_messages(user_msgs)
     stats["total_messages"] += total_sent
 
 
-def edit_message(msg):
+def edit_message(msg, tenant_id=DEFAULT_TENANT):
     """
 
     :param msg:
+    :param tenant_id:
     :return:
     """
-    server_state = get_state()
+    server_state = get_state(tenant_id)
     if msg.get("channel"):
-        channel_inst = server_state.channels.get(msg["channel"])
-        if channel_inst:
-            channel_inst.alter_message(msg)
+        with server_state.channel_lock(msg["channel"]):
+            channel_inst = server_state.channels.get(msg["channel"])
+            if channel_inst:
+                channel_inst.alter_message(msg)
     elif msg["pm_users"]:
         # if pm then iterate over all users and notify about new message!
         for username in msg["pm_users"]:
@@ -203,20 +272,206 @@ def edit_message(msg):
                 user_inst.alter_message(msg)
 
 
-def delete_message(msg):
+def delete_message(msg, tenant_id=DEFAULT_TENANT):
     """
 
     :param msg:
+    :param tenant_id:
     :return:
     """
-    server_state = get_state()
+    server_state = get_state(tenant_id)
     if msg.get("channel"):
-        channel_inst = server_state.channels.get(msg["channel"])
-        if channel_inst:
-            channel_inst.delete_message(msg)
+        with server_state.channel_lock(msg["channel"]):
+            channel_inst = server_state.channels.get(msg["channel"])
+            if channel_inst:
+                channel_inst.delete_message(msg)
     elif msg["pm_users"]:
         # if pm then iterate over all users and notify about new message!
         for username in msg["pm_users"]:
             user_inst = server_state.users.get(username)
             if user_inst:
                 user_inst.delete_message(msg)
+
+
+def subscribe_by_id(conn_id, channels, channel_configs, tenant_id=DEFAULT_TENANT):
+    connection = get_state(tenant_id).connections.get(conn_id)
+    if connection is not None:
+        subscribe(
+            connection=connection, channels=channels, channel_configs=channel_configs
+        )
+
+
+def unsubscribe_by_id(conn_id, unsubscribe_channels, tenant_id=DEFAULT_TENANT):
+    connection = get_state(tenant_id).connections.get(conn_id)
+    if connection is not None:
+        unsubscribe(connection=connection, unsubscribe_channels=unsubscribe_channels)
+
+
+def set_user_state(username, user_state, state_public_keys, tenant_id=DEFAULT_TENANT):
+    """
+    Applies user state change made on another worker
+    :param username:
+    :param user_state:
+    :param state_public_keys:
+    :param tenant_id:
+    :return:
+    """
+    user_inst = get_state(tenant_id).users.get(username)
+    if user_inst is not None:
+        if state_public_keys is not None:
+            user_inst.state_public_keys = state_public_keys
+        change_user_state(user_inst=user_inst, user_state=user_state)
+
+
+def pass_replicated_messages(msgs, tenant_id=DEFAULT_TENANT):
+    pass_messages(msgs, get_state(tenant_id).stats, tenant_id)
+
+
+def attached_remotely(conn_id, tenant_id=DEFAULT_TENANT):
+    """
+    Marks connection as held by another worker, local GC leaves it
+    to that worker. Local poll buffer is dropped, client that comes back
+    catches up from its cursor instead of getting stale messages.
+    :param conn_id:
+    :param tenant_id:
+    :return:
+    """
+    connection = get_state(tenant_id).connections.get(conn_id)
+    if connection is not None:
+        connection.attached_remotely = True
+        connection.queue = None
+        connection.attachment_changed()
+
+
+def relayed_messages(tenant_id, msgs):
+    pass_messages(msgs, get_state(tenant_id).stats, tenant_id)
+
+
+def relayed_edit(tenant_id, msg):
+    edit_message(msg, tenant_id)
+
+
+def relayed_delete(tenant_id, msg):
+    delete_message(msg, tenant_id)
+
+
+def relayed_channel_message(tenant_id, channel_name, payload):
+    """
+    Delivers presence or state change message generated on other node
+    to local subscribers
+    """
+    server_state = get_state(tenant_id)
+    with server_state.channel_lock(channel_name):
+        channel = server_state.channels.get(channel_name)
+        if channel:
+            channel.add_message(payload, exclude_users=payload["exclude_users"])
+
+
+def find_connection(conn_id, tenant_id=DEFAULT_TENANT):
+    """
+    Returns connection with id, connection saved in a snapshot is restored
+    when its client comes back after restart
+
+    :param conn_id: uuid
+    :param tenant_id:
+    :return: Connection or None
+    """
+    server_state = get_state(tenant_id)
+    connection = server_state.connections.get(conn_id)
+    if connection is None and conn_id.bytes in server_state.saved_connections:
+        connection = restore_connection(conn_id, tenant_id)
+        bus.publish("restore_connection", conn_id, tenant_id)
+    return connection
+
+
+def restore_connection(conn_id, tenant_id=DEFAULT_TENANT):
+    """
+    Recreates connection saved in a snapshot with its subscriptions
+
+    :param conn_id: uuid
+    :param tenant_id:
+    :return: Connection or None if it was not saved
+    """
+    saved = get_state(tenant_id).saved_connections.pop(conn_id.bytes, None)
+    if saved is None:
+        return None
+    username, channel_names = saved
+    connection, _ = connect(
+        username=username,
+        conn_id=conn_id,
+        channels=channel_names,
+        channel_configs={},
+        tenant_id=tenant_id,
+        enforce_quota=False,
+    )
+    connection.restored = True
+    return connection
+
+
+def recovered_frames(recovered):
+    return [
+        (t, msg, Envelope(msg, pm_users=pm_users, exclude_users=exclude_users, seq=seq))
+        for t, msg, pm_users, exclude_users, seq in recovered.frames
+    ]
+
+
+def last_seq(frames):
+    return frames[-1][2].seq if frames else 0
+
+
+def restore_from_log(tenant_log, tenant_id=DEFAULT_TENANT):
+    """
+    Recreates channels and users with their history and catchup frames
+    from tenant log and keeps writing to it, runs before the server
+    accepts requests
+
+    :param tenant_log: storage.TenantLog
+    :param tenant_id:
+    :return:
+    """
+    server_state = get_state(tenant_id)
+    channels, users = tenant_log.recover(user_frames_size=User.frames_size)
+    for channel_name, recovered in six.iteritems(channels):
+        channel = Channel(
+            channel_name,
+            long_name=recovered.long_name,
+            channel_config=recovered.settings,
+            tenant_id=tenant_id,
+        )
+        channel.frames.extend(recovered_frames(recovered))
+        channel.seq = last_seq(channel.frames)
+        channel.log = tenant_log
+        channel.history = storage.LoggedHistory(
+            tenant_log, channel_name, channel.history_size, recovered.history
+        )
+        server_state.channels[channel_name] = channel
+    for username, recovered in six.iteritems(users):
+        user = User(username, tenant_id)
+        user.frames.extend(recovered_frames(recovered))
+        user.seq = last_seq(user.frames)
+        user.log = tenant_log
+        server_state.users[username] = user
+    storage.LOGS[tenant_id] = tenant_log
+    log.info(
+        "restored {} channels and {} users of tenant {}".format(
+            len(channels), len(users), tenant_id
+        )
+    )
+
+
+bus.register("connect", functools.partial(connect, enforce_quota=False))
+bus.register("subscribe", subscribe_by_id)
+bus.register("unsubscribe", unsubscribe_by_id)
+bus.register("user_state", set_user_state)
+bus.register("channel_config", set_channel_config)
+bus.register("messages", pass_replicated_messages)
+bus.register("edit", edit_message)
+bus.register("delete", delete_message)
+bus.register("disconnect", disconnect)
+bus.register("attach", attached_remotely)
+bus.register("restore_connection", restore_connection)
+
+cluster.register("cluster_messages", relayed_messages)
+cluster.register("cluster_edit", relayed_edit)
+cluster.register("cluster_delete", relayed_delete)
+cluster.register("cluster_channel_message", relayed_channel_message)
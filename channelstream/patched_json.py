@@ -4,41 +4,131 @@ import datetime
 import decimal
 import functools
 import json
+import logging
 import uuid
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+log = logging.getLogger(__name__)
+
+BACKENDS = ("auto", "json", "orjson")
+COMPACT_SEPARATORS = (",", ":")
+
+
+def encode_complex(obj):
+    """
+    Converts objects json can't handle natively into serializable values
+    """
+    if isinstance(obj, complex):
+        return [obj.real, obj.imag]
+    elif isinstance(obj, datetime.datetime):
+        r = obj.isoformat()
+        if r.endswith("+00:00"):
+            r = r[:-6] + "Z"
+        return r
+    elif isinstance(obj, uuid.UUID):
+        return str(obj)
+    elif isinstance(obj, datetime.date):
+        return obj.isoformat()
+    elif isinstance(obj, decimal.Decimal):
+        return str(obj)
+    elif isinstance(obj, datetime.time):
+        r = obj.isoformat()
+        if obj.microsecond:
+            r = r[:12]
+        return r
+    elif isinstance(obj, set):
+        return list(obj)
+    elif hasattr(obj, "__json__"):
+        if callable(obj.__json__):
+            return obj.__json__()
+        else:
+            return obj.__json__
+    else:
+        raise NotImplementedError
+
 
 class ComplexEncoder(json.JSONEncoder):
     def default(self, obj):
-        if isinstance(obj, complex):
-            return [obj.real, obj.imag]
-        elif isinstance(obj, datetime.datetime):
-            r = obj.isoformat()
-            if r.endswith("+00:00"):
-                r = r[:-6] + "Z"
-            return r
-        elif isinstance(obj, uuid.UUID):
-            return str(obj)
-        elif isinstance(obj, datetime.date):
-            return obj.isoformat()
-        elif isinstance(obj, decimal.Decimal):
-            return str(obj)
-        elif isinstance(obj, datetime.time):
-            r = obj.isoformat()
-            if obj.microsecond:
-                r = r[:12]
-            return r
-        elif isinstance(obj, set):
-            return list(obj)
-        elif hasattr(obj, "__json__"):
-            if callable(obj.__json__):
-                return obj.__json__()
-            else:
-                return obj.__json__
-        else:
-            raise NotImplementedError
+        return encode_complex(obj)
+
+
+# encoder instance is reused for wire traffic, creating one per call is costly
+_compact_encoder = ComplexEncoder(separators=COMPACT_SEPARATORS)
+
+
+def json_dumps(obj, **kw):
+    """
+    Compact encoding with stdlib json, keyword arguments like `indent`
+    or `default` (passed by pyramid renderers) are honored
+    """
+    if not kw:
+        return _compact_encoder.encode(obj)
+    kw.setdefault("separators", COMPACT_SEPARATORS)
+    return json.dumps(obj, cls=ComplexEncoder, **kw)
+
+
+if orjson is not None:
+    # datetimes go through encode_complex so output matches stdlib backend
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+    def orjson_dumps(obj, **kw):
+        """
+        Compact encoding with orjson, falls back to stdlib for pretty output
+        and for values orjson refuses (like integers over 64 bits)
+        """
+        if kw.get("indent"):
+            return json_dumps(obj, **kw)
+        try:
+            return orjson.dumps(
+                obj, default=kw.get("default", encode_complex), option=_ORJSON_OPTIONS
+            ).decode("utf8")
+        except TypeError:
+            return json_dumps(obj, **kw)
+
+
+else:
+    orjson_dumps = None
+
+
+_backend_dumps = json_dumps
+
+
+def set_backend(name="auto"):
+    """
+    Selects encoder used by `dumps`, "auto" picks the fastest available one
+
+    :param name: one of BACKENDS
+    :return: name of selected backend
+    """
+    global _backend_dumps
+    if name not in BACKENDS:
+        raise ValueError("Unknown json backend: {}".format(name))
+    if name == "auto":
+        name = "orjson" if orjson_dumps is not None else "json"
+    if name == "orjson":
+        if orjson_dumps is None:
+            raise ValueError("orjson backend requested but orjson is not installed")
+        _backend_dumps = orjson_dumps
+    else:
+        _backend_dumps = json_dumps
+    log.info("Using {} json backend".format(name))
+    return name
+
+
+def dumps(obj, **kw):
+    """
+    Serializes `obj` to compact JSON with currently selected backend,
+    used for everything sent over the wire
+    """
+    return _backend_dumps(obj, **kw)
 
 
 load = json.load
 loads = json.loads
 dump = json.load
-dumps = functools.partial(json.dumps, indent=4, cls=ComplexEncoder)
+# human readable output for admin/debug purposes
+dumps_pretty = functools.partial(json.dumps, indent=4, cls=ComplexEncoder)
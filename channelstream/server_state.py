@@ -1,27 +1,259 @@
+import collections
+import time
 from datetime import datetime
 
 from gevent.lock import RLock
 
+from channelstream.locks import LockStripes, TimedRLock
+from channelstream.utils import Histogram
+
 STATS = {"started_on": datetime.utcnow()}
 lock = RLock()
 
+DEFAULT_TENANT = "0"
+
+# upper bounds in seconds of coalesced frame flush latency buckets
+FLUSH_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1.0)
+# upper bounds in seconds of broadcast fan-out, websocket send and GC pauses
+FAST_LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    1.0,
+)
+# upper bounds in seconds of connect and subscribe requests
+REQUEST_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+SUBSCRIBER_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+# frames waiting in websocket send queue
+QUEUE_DEPTH_BUCKETS = (1, 2, 5, 10, 50, 100, 500, 1000)
+
+
+class QuotaExceeded(Exception):
+    """
+    Raised when tenant goes over its connection or message quota
+    """
+
+    def __init__(self, tenant_id, quota):
+        super(QuotaExceeded, self).__init__(
+            "Tenant {} exceeded {} quota".format(tenant_id, quota)
+        )
+        self.tenant_id = tenant_id
+        self.quota = quota
+
+
+class MessageRate(object):
+    """
+    Counts messages in one second windows
+    """
 
-class State(object):
     def __init__(self):
+        self.window = int(time.time())
+        self.current = 0
+        self.last = 0
+
+    def roll(self, now=None):
+        window = int(time.time() if now is None else now)
+        if window != self.window:
+            # previous window is only meaningful if it directly precedes this one
+            self.last = self.current if window == self.window + 1 else 0
+            self.window = window
+            self.current = 0
+
+    def add(self, count, limit=0, now=None):
+        """
+        Counts messages in current window
+
+        :param count:
+        :param limit: max messages per second, 0 means no limit
+        :param now: timestamp, defaults to current time
+        :return: False if messages would go over the limit and were not counted
+        """
+        self.roll(now)
+        if limit and self.current + count > limit:
+            return False
+        self.current += count
+        return True
+
+    def per_second(self, now=None):
+        """
+        Messages counted during last full second
+        """
+        self.roll(now)
+        return self.last
+
+
+class State(object):
+    """
+    Holds channels, connections and users of a tenant.
+
+    `registry_lock` guards the connection and user registries and the
+    connection GC heap, `channel_locks` guard channel creation, subscriptions,
+    configuration and messages of a channel - picked by channel name.
+    Lock order: registry lock first, then a single channel lock; never
+    acquire the registry lock or a second channel lock while holding
+    a channel lock.
+    """
+
+    def __init__(self, tenant_id=DEFAULT_TENANT):
+        """
+
+        :param tenant_id:
+        """
+        self.tenant_id = tenant_id
         self.channels = {}
         self.connections = {}
         self.users = {}
-        self.stats = {"total_messages": 0, "total_unique_messages": 0}
-        self.lock = RLock()
+        self.stats = {
+            "total_messages": 0,
+            "total_unique_messages": 0,
+            "gc_conns_collected": 0,
+            "gc_conns_last_duration": 0.0,
+            "gc_conns_max_duration": 0.0,
+            "rejected_connections": 0,
+            "rejected_messages": 0,
+            "reconnect_storms": 0,
+            "deferred_catchups": 0,
+            "suppressed_presence": 0,
+        }
+        # heap of (deadline, counter, connection) used by connection GC
+        self.conn_deadlines = []
+        self.registry_lock = TimedRLock()
+        self.channel_locks = LockStripes()
+        # quotas, 0 means unlimited
+        self.max_connections = 0
+        self.max_messages_per_second = 0
+        self.message_rate = MessageRate()
+        # conn_id bytes -> (username, channel names) of connections saved
+        # in a snapshot that were not reattached yet
+        self.saved_connections = {}
+        self.reset_histograms()
+        # reconnect storm smoothing, see channelstream.storm,
+        # 0 reconnects per second disables it
+        self.storm_reconnects_per_second = 0
+        self.storm_grace = 30
+        self.storm_catchup_rate = 200
+        self.reconnect_rate = MessageRate()
+        self.storm_until = 0
+        # (connection, poll buffer, resume positions, catchup bounds)
+        # waiting for rate limited catchup
+        self.catchup_queue = collections.deque()
+        self.catchup_worker = None
+
+    def reset_histograms(self):
+        """
+        Starts hot path histograms exposed in metrics from scratch
+        """
+        # time coalesced websocket frames waited before being written
+        self.flush_latency = Histogram(FLUSH_LATENCY_BUCKETS)
+        # time spent handing one broadcast to subscribed connections
+        # and how many connections got it
+        self.fanout_latency = Histogram(FAST_LATENCY_BUCKETS)
+        self.fanout_subscribers = Histogram(SUBSCRIBER_BUCKETS)
+        # frames waiting in websocket send queue when its writer wakes up
+        # and time spent writing them
+        self.send_latency = Histogram(FAST_LATENCY_BUCKETS)
+        self.queue_depth = Histogram(QUEUE_DEPTH_BUCKETS)
+        self.gc_pause = Histogram(FAST_LATENCY_BUCKETS)
+        self.connect_latency = Histogram(REQUEST_LATENCY_BUCKETS)
+        self.subscribe_latency = Histogram(REQUEST_LATENCY_BUCKETS)
+
+    def channel_lock(self, channel_name):
+        return self.channel_locks.for_name(channel_name)
+
+    def check_connection_quota(self, conn_id):
+        """
+        Raises QuotaExceeded if new connection would go over the quota,
+        reconnecting with existing id is always allowed
+        :param conn_id:
+        :return:
+        """
+        if (
+            self.max_connections
+            and conn_id not in self.connections
+            and len(self.connections) >= self.max_connections
+        ):
+            self.stats["rejected_connections"] += 1
+            raise QuotaExceeded(self.tenant_id, "connection")
 
+    def consume_message_quota(self, count):
+        """
+        Counts messages towards throughput, raises QuotaExceeded
+        if they would go over messages per second quota
+        :param count:
+        :return:
+        """
+        if not self.message_rate.add(count, limit=self.max_messages_per_second):
+            self.stats["rejected_messages"] += count
+            raise QuotaExceeded(self.tenant_id, "message")
 
-STATES = {"0": State()}
+    def get_tenant_info(self):
+        return {
+            "total_connections": len(self.connections),
+            "total_users": len(self.users),
+            "total_channels": len(self.channels),
+            "total_messages": self.stats["total_messages"],
+            "total_unique_messages": self.stats["total_unique_messages"],
+            "messages_per_second": self.message_rate.per_second(),
+            "rejected_connections": self.stats["rejected_connections"],
+            "rejected_messages": self.stats["rejected_messages"],
+            "saved_connections": len(self.saved_connections),
+            "max_connections": self.max_connections,
+            "max_messages_per_second": self.max_messages_per_second,
+            "reconnects_per_second": self.reconnect_rate.per_second(),
+            "reconnect_storm": time.time() < self.storm_until,
+            "reconnect_storms": self.stats["reconnect_storms"],
+            "deferred_catchups": self.stats["deferred_catchups"],
+            "queued_catchups": len(self.catchup_queue),
+            "suppressed_presence": self.stats["suppressed_presence"],
+        }
 
 
-def get_state(tenant_id="0"):
+STATES = {DEFAULT_TENANT: State(DEFAULT_TENANT)}
+
+
+def get_state(tenant_id=DEFAULT_TENANT):
     """
     Grabs right state for specific tenant
     :param tenant_id:
     :return:
     """
     return STATES[tenant_id]
+
+
+def configure_tenants(
+    tenant_ids,
+    max_connections=0,
+    max_messages_per_second=0,
+    storm_reconnects_per_second=0,
+    storm_grace=30,
+    storm_catchup_rate=200,
+):
+    """
+    Creates state for every tenant and sets its quotas
+
+    :param tenant_ids:
+    :param max_connections: per tenant, 0 means unlimited
+    :param max_messages_per_second: per tenant, 0 means unlimited
+    :param storm_reconnects_per_second: reconnects that start storm mode,
+        0 disables it
+    :param storm_grace: seconds storm mode lasts after reconnects calm down
+    :param storm_catchup_rate: catchups delivered per second during storm,
+        0 means unlimited
+    :return:
+    """
+    for tenant_id in tenant_ids:
+        if tenant_id not in STATES:
+            STATES[tenant_id] = State(tenant_id)
+        STATES[tenant_id].max_connections = max_connections
+        STATES[tenant_id].max_messages_per_second = max_messages_per_second
+        STATES[tenant_id].storm_reconnects_per_second = storm_reconnects_per_second
+        STATES[tenant_id].storm_grace = storm_grace
+        STATES[tenant_id].storm_catchup_rate = storm_catchup_rate
@@ -0,0 +1,258 @@
+"""
+Snapshots of users, channels and connections for warm restarts.
+
+Snapshot holds users (state and public keys), channels (config and
+history, unless history lives in the durable log) and connection ids with
+their channels of every tenant, pickled and zlib compressed. Snapshots are
+written by a forked child at intervals, so serving is not blocked, and by
+the server itself at shutdown.
+
+Loading is lazy - channels are recreated right away but users and
+connections stay plain tuples until they are used. A client that comes
+back with its connection id is reattached on `/ws` or `/listen` without
+a new `/connect`, connections that don't come back are forgotten after
+REATTACH_WINDOW seconds.
+"""
+import gc
+import logging
+import os
+import time
+import zlib
+
+import gevent
+import six
+from six.moves import cPickle as pickle
+
+from channelstream import storm
+from channelstream.channel import Channel
+from channelstream.server_state import STATES
+from channelstream.user import UserRegistry
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"CHSNAP02"
+REATTACH_WINDOW = 300
+
+
+def capture(server_state):
+    """
+    Collects snapshot data of tenant
+
+    :param server_state:
+    :return: dict with users, channels and connections tuples
+    """
+    # user state stays pickled until user is used after restart
+    users = [
+        (
+            user.username,
+            pickle.dumps((user.state, user.state_public_keys), pickle.HIGHEST_PROTOCOL),
+        )
+        for user in six.itervalues(server_state.users)
+    ]
+    saved_users = getattr(server_state.users, "saved", {})
+    users.extend(six.iteritems(saved_users))
+    channels = [
+        (
+            channel.name,
+            channel.long_name,
+            channel.settings,
+            # durable log keeps its own history
+            list(channel.history) if channel.log is None else None,
+            channel.seq,
+        )
+        for channel in six.itervalues(server_state.channels)
+    ]
+    connections = [
+        (conn.id.bytes, conn.username, tuple(sorted(conn.channel_names)))
+        for conn in six.itervalues(server_state.connections)
+    ]
+    connections.extend(
+        (conn_id, username, channel_names)
+        for conn_id, (username, channel_names) in six.iteritems(
+            server_state.saved_connections
+        )
+    )
+    return {"users": users, "channels": channels, "connections": connections}
+
+
+def write_snapshot(path):
+    """
+    Writes snapshot of every tenant, file is replaced atomically
+
+    :param path:
+    :return: size of snapshot in bytes
+    """
+    data = {
+        tenant_id: capture(server_state)
+        for tenant_id, server_state in list(six.iteritems(STATES))
+    }
+    return dump(data, path)
+
+
+def dump(data, path):
+    """
+    Writes snapshot data
+
+    :param data: {tenant_id: snapshot data}
+    :param path:
+    :return: size of snapshot in bytes
+    """
+    start = time.time()
+    payload = MAGIC + zlib.compress(pickle.dumps(data, pickle.HIGHEST_PROTOCOL), 1)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+    log.info(
+        "snapshot of {} bytes written in {:.2f}s".format(
+            len(payload), time.time() - start
+        )
+    )
+    return len(payload)
+
+
+def write_snapshot_in_background(path):
+    """
+    Writes snapshot from forked child, child sees a consistent copy
+    of the state while this process keeps serving
+    """
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            write_snapshot(path)
+        except Exception:
+            log.exception("snapshot failed")
+            code = 1
+        os._exit(code)
+    return pid
+
+
+def read_snapshot(path):
+    """
+    :param path:
+    :return: {tenant_id: snapshot data} or None if there is no usable snapshot
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        payload = f.read()
+    if not payload.startswith(MAGIC):
+        log.warning("{} is not a snapshot, ignoring it".format(path))
+        return None
+    return pickle.loads(zlib.decompress(payload[len(MAGIC) :]))
+
+
+def restore(server_state, saved):
+    """
+    Recreates channels and remembers saved users and connections of tenant,
+    channels restored from durable log are left alone, users restored from
+    it get their state back
+
+    :param server_state:
+    :param saved: snapshot data of tenant
+    :return:
+    """
+    tenant_id = server_state.tenant_id
+    for channel_name, long_name, settings, history, seq in saved["channels"]:
+        if channel_name in server_state.channels:
+            # keep numbering going if frames were restored from durable log
+            channel = server_state.channels[channel_name]
+            channel.seq = max(channel.seq, seq)
+            continue
+        channel = Channel(
+            channel_name,
+            long_name=long_name,
+            channel_config=settings,
+            tenant_id=tenant_id,
+        )
+        for message in history or []:
+            channel.history.append(message)
+        # clients resuming with old sequence numbers get only newer messages
+        channel.seq = seq
+        server_state.channels[channel_name] = channel
+    users = server_state.users
+    if not isinstance(users, UserRegistry):
+        users = server_state.users = UserRegistry(users, tenant_id=tenant_id)
+    for username, saved_user in saved["users"]:
+        if username in users:
+            # user with frames restored from durable log, log has no state
+            user = users[username]
+            user.state, user.state_public_keys = pickle.loads(saved_user)
+        else:
+            users.saved[username] = saved_user
+    for conn_id, username, channel_names in saved["connections"]:
+        server_state.saved_connections[conn_id] = (username, channel_names)
+    if server_state.storm_reconnects_per_second and saved["connections"]:
+        # clients are about to come back all at once, users who don't
+        # return within grace period are announced as parted
+        storm.begin_storm(server_state)
+        for conn_id, username, channel_names in saved["connections"]:
+            for channel_name in channel_names:
+                channel = server_state.channels.get(channel_name)
+                if (
+                    channel is not None
+                    and channel.notify_presence
+                    and username not in channel.parting
+                ):
+                    channel.defer_parted(username, server_state.storm_grace)
+
+
+def forget_saved_connections(server_state):
+    log.info(
+        "{} saved connections of tenant {} were not reattached".format(
+            len(server_state.saved_connections), server_state.tenant_id
+        )
+    )
+    server_state.saved_connections = {}
+
+
+def load_snapshot(path):
+    """
+    Restores every tenant from snapshot, tenants that are no longer
+    configured are skipped
+
+    :param path:
+    :return: True if snapshot was loaded
+    """
+    start = time.time()
+    # millions of small containers would trigger many useless collections
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        loaded = restore_tenants(read_snapshot(path))
+    finally:
+        if gc_enabled:
+            gc.enable()
+    if loaded:
+        log.info("snapshot loaded in {:.2f}s".format(time.time() - start))
+    return loaded
+
+
+def restore_tenants(data):
+    if data is None:
+        return False
+    for tenant_id, saved in six.iteritems(data):
+        server_state = STATES.get(tenant_id)
+        if server_state is None:
+            continue
+        restore(server_state, saved)
+        gevent.spawn_later(REATTACH_WINDOW, forget_saved_connections, server_state)
+        log.info(
+            "restored {} channels, {} users and {} connections of tenant {}".format(
+                len(saved["channels"]),
+                len(saved["users"]),
+                len(saved["connections"]),
+                tenant_id,
+            )
+        )
+    return True
+
+
+def snapshot_forever(path, interval):
+    try:
+        write_snapshot_in_background(path)
+    finally:
+        gevent.spawn_later(interval, snapshot_forever, path, interval)
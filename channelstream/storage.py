@@ -0,0 +1,642 @@
+"""
+Durable append-only log of channel history and catchup frames.
+
+Every tenant gets its own log made of numbered segment files, records are
+appended to the newest segment and read back through memory maps. Channels
+keep only uuids and record locations of their history in memory, frames
+stay in memory too and are written to the log so they survive a restart.
+
+Records are replayed on startup, the replay reads only record headers
+except for the frames that end up in memory. Once the log grows to twice
+its size after the last compaction, live records are rewritten into new
+segments and old segments are removed.
+"""
+import collections
+import logging
+import mmap
+import os
+import struct
+import uuid
+import zlib
+
+import gevent
+import six
+from six.moves import cPickle as pickle
+
+from channelstream.server_state import get_state
+from channelstream.utils import MessageBuffer
+
+log = logging.getLogger(__name__)
+
+# body size, crc32 of everything after it, op, flags, message uuid, name size
+RECORD = struct.Struct("!IIBB16sH")
+SEGMENT_SUFFIX = ".log"
+SEGMENT_SIZE = 64 * 1024 * 1024
+SYNC_INTERVAL = 1
+
+CHANNEL_CONFIG = 1
+CHANNEL_RESET = 2
+HISTORY_MESSAGE = 3
+HISTORY_EDIT = 4
+HISTORY_DELETE = 5
+CHANNEL_FRAME = 6
+CHANNEL_FRAME_EDIT = 7
+CHANNEL_FRAME_DELETE = 8
+USER_RESET = 9
+USER_FRAME = 10
+USER_FRAME_EDIT = 11
+USER_FRAME_DELETE = 12
+
+CHANNEL = "channel"
+USER = "user"
+# add, edit and delete operations of channel and user frames
+FRAME_OPS = {
+    CHANNEL: (CHANNEL_FRAME, CHANNEL_FRAME_EDIT, CHANNEL_FRAME_DELETE),
+    USER: (USER_FRAME, USER_FRAME_EDIT, USER_FRAME_DELETE),
+}
+
+# record holds a message of "message" type, only those can be edited
+FLAG_MESSAGE = 1
+
+NO_UUID = b"\0" * 16
+
+# tenant id -> TenantLog, tenants without a log keep everything in memory
+LOGS = {}
+
+Record = collections.namedtuple("Record", "op flags uuid name payload")
+
+
+def get_log(tenant_id):
+    return LOGS.get(tenant_id)
+
+
+def uuid_bytes(value):
+    if value is None:
+        return NO_UUID
+    if not isinstance(value, uuid.UUID):
+        value = uuid.UUID(str(value))
+    return value.bytes
+
+
+def message_flags(message):
+    return FLAG_MESSAGE if message.get("type") == "message" else 0
+
+
+class Segment(object):
+    """
+    Single log file, appended with plain writes and read through mmap
+    """
+
+    def __init__(self, path, segment_id):
+        """
+
+        :param path:
+        :param segment_id: position of segment in the log
+        """
+        self.path = path
+        self.segment_id = segment_id
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.size = os.fstat(self.fd).st_size
+        self.synced_size = self.size
+        self.map = None
+
+    def append(self, data):
+        """
+        Writes data at the end of segment
+        :param data:
+        :return: offset of data
+        """
+        offset = self.size
+        written = os.write(self.fd, data)
+        while written < len(data):
+            written += os.write(self.fd, data[written:])
+        self.size += len(data)
+        return offset
+
+    def view(self):
+        # remapped when records were appended since last read
+        if self.map is None or len(self.map) < self.size:
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.fd, self.size, access=mmap.ACCESS_READ)
+        return self.map
+
+    def read(self, offset, verify=True):
+        """
+        Reads record at offset
+
+        :param offset:
+        :param verify: check that record is complete and its checksum matches
+        :return: (Record, offset of next record) or None for a torn
+          or corrupted record
+        """
+        if offset + RECORD.size > self.size:
+            return None
+        data = self.view()
+        size, crc, op, flags, msg_uuid, name_size = RECORD.unpack_from(data, offset)
+        start = offset + RECORD.size
+        end = start + size
+        if verify:
+            if end > self.size or name_size > size:
+                return None
+            checksum = zlib.crc32(data[offset + 8 : start])
+            if zlib.crc32(data[start:end], checksum) & 0xFFFFFFFF != crc:
+                return None
+        name = data[start : start + name_size].decode("utf8")
+        record = Record(op, flags, msg_uuid, name, data[start + name_size : end])
+        return record, end
+
+    def truncate(self, size):
+        os.ftruncate(self.fd, size)
+        self.size = size
+        self.synced_size = min(self.synced_size, size)
+        self.close_map()
+
+    def sync(self):
+        size = self.size
+        if self.synced_size != size:
+            # fsync would block every greenlet
+            gevent.get_hub().threadpool.apply(os.fsync, (self.fd,))
+            self.synced_size = size
+
+    def close_map(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def close(self):
+        self.close_map()
+        os.close(self.fd)
+
+
+class SegmentLog(object):
+    """
+    Ordered segment files in a directory, records are addressed
+    by (segment_id, offset) locations
+    """
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE):
+        """
+
+        :param directory: created if it doesn't exist
+        :param segment_size: new segment is started once active one is bigger
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        segment_ids = sorted(
+            int(name[: -len(SEGMENT_SUFFIX)])
+            for name in os.listdir(directory)
+            if name.endswith(SEGMENT_SUFFIX) and name[: -len(SEGMENT_SUFFIX)].isdigit()
+        )
+        self.segments = collections.OrderedDict(
+            (segment_id, Segment(self.segment_path(segment_id), segment_id))
+            for segment_id in segment_ids
+        )
+        if not self.segments:
+            self.roll()
+
+    def segment_path(self, segment_id):
+        return os.path.join(
+            self.directory, "{:010d}{}".format(segment_id, SEGMENT_SUFFIX)
+        )
+
+    @property
+    def active(self):
+        return next(reversed(self.segments.values()))
+
+    def roll(self):
+        """
+        Starts a new segment, following appends go there
+        :return: id of new segment
+        """
+        segment_id = self.active.segment_id + 1 if self.segments else 1
+        self.segments[segment_id] = Segment(self.segment_path(segment_id), segment_id)
+        return segment_id
+
+    def append(self, op, flags, msg_uuid, name, payload):
+        """
+        Appends record
+
+        :param op:
+        :param flags:
+        :param msg_uuid: 16 bytes
+        :param name: channel name or username
+        :param payload: bytes
+        :return: location of record
+        """
+        if self.active.size >= self.segment_size:
+            self.roll()
+        name = name.encode("utf8")
+        body = name + payload
+        header = RECORD.pack(len(body), 0, op, flags, msg_uuid, len(name))
+        crc = zlib.crc32(body, zlib.crc32(header[8:])) & 0xFFFFFFFF
+        header = RECORD.pack(len(body), crc, op, flags, msg_uuid, len(name))
+        segment = self.active
+        return segment.segment_id, segment.append(header + body)
+
+    def read(self, location):
+        segment_id, offset = location
+        return self.segments[segment_id].read(offset, verify=False)[0]
+
+    def replay(self):
+        """
+        Yields (location, record) for every intact record in log order,
+        torn or corrupted tail of the active segment is truncated,
+        a corrupted sealed segment is skipped from the bad record on
+        """
+        for segment in list(self.segments.values()):
+            offset = 0
+            while offset < segment.size:
+                found = segment.read(offset)
+                if found is None:
+                    log.warning(
+                        "damaged record in {} at {}".format(segment.path, offset)
+                    )
+                    if segment is self.active:
+                        segment.truncate(offset)
+                    break
+                record, end = found
+                yield (segment.segment_id, offset), record
+                offset = end
+
+    def drop_before(self, segment_id):
+        """
+        Removes segments older than segment_id
+        """
+        for old_id in list(self.segments):
+            if old_id >= segment_id:
+                break
+            segment = self.segments.pop(old_id)
+            segment.close()
+            os.unlink(segment.path)
+
+    def size(self):
+        return sum(segment.size for segment in self.segments.values())
+
+    def sync(self):
+        for segment in list(self.segments.values()):
+            segment.sync()
+
+    def close(self):
+        for segment in self.segments.values():
+            segment.close()
+
+
+class LoggedHistory(object):
+    """
+    Channel history kept in the log, only message uuids and record
+    locations stay in memory - messages are read back when iterated.
+    Behaves like MessageBuffer.
+    """
+
+    def __init__(self, tenant_log, channel_name, maxlen, entries=()):
+        """
+
+        :param tenant_log:
+        :param channel_name:
+        :param maxlen:
+        :param entries: (uuid bytes, location) of stored messages
+        """
+        self.log = tenant_log
+        self.channel_name = channel_name
+        self.entries = collections.deque(entries, maxlen=maxlen)
+
+    @property
+    def maxlen(self):
+        return self.entries.maxlen
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        # messages are read right away, segments they live in can be
+        # dropped by compaction while caller is still iterating
+        return iter([self.log.read(location) for _, location in list(self.entries)])
+
+    def __getitem__(self, index):
+        return self.log.read(self.entries[index][1])
+
+    def append(self, message):
+        location = self.log.append(
+            HISTORY_MESSAGE, self.channel_name, message["uuid"], message, FLAG_MESSAGE
+        )
+        self.entries.append((uuid_bytes(message["uuid"]), location))
+
+    def resized(self, maxlen):
+        return LoggedHistory(self.log, self.channel_name, maxlen, self.entries)
+
+    def edit_message(self, msg_uuid, changes):
+        i = find_entry(self.entries, uuid_bytes(msg_uuid))
+        if i is None:
+            return None
+        msg = self.log.read(self.entries[i][1])
+        msg.update(changes)
+        location = self.log.append(
+            HISTORY_EDIT, self.channel_name, msg_uuid, msg, FLAG_MESSAGE
+        )
+        self.entries[i] = (uuid_bytes(msg["uuid"]), location)
+        return msg
+
+    def delete_message(self, msg_uuid):
+        i = find_entry(self.entries, uuid_bytes(msg_uuid))
+        if i is None:
+            return False
+        del self.entries[i]
+        self.log.append(HISTORY_DELETE, self.channel_name, msg_uuid)
+        return True
+
+
+def history_buffer(tenant_log, channel_name, maxlen):
+    """
+    Returns channel history buffer, kept in the log if tenant has one
+    """
+    if tenant_log is None:
+        return MessageBuffer(maxlen=maxlen)
+    return LoggedHistory(tenant_log, channel_name, maxlen)
+
+
+class Recovered(object):
+    """
+    Channel or user state rebuilt from the log
+    """
+
+    def __init__(self, history_size=None, frames_size=None):
+        self.long_name = None
+        self.settings = {}
+        # (uuid bytes, location)
+        self.history = collections.deque(maxlen=history_size)
+        # (uuid bytes, flags, location), replaced by frame tuples at the end
+        self.frames = collections.deque(maxlen=frames_size)
+
+    def configure(self, long_name, settings):
+        self.long_name = long_name
+        self.settings = settings
+        if settings.get("history_size") != self.history.maxlen:
+            self.history = collections.deque(
+                self.history, maxlen=settings.get("history_size")
+            )
+        if settings.get("frames_size") != self.frames.maxlen:
+            self.frames = collections.deque(
+                self.frames, maxlen=settings.get("frames_size")
+            )
+
+
+def find_entry(entries, msg_uuid, messages_only=False):
+    """
+    Index of first entry with uuid, `messages_only` skips frames
+    that are not of "message" type (edit and delete notifications)
+    """
+    for i, entry in enumerate(entries):
+        if entry[0] == msg_uuid and (not messages_only or entry[1] & FLAG_MESSAGE):
+            return i
+    return None
+
+
+def replace_entry(entries, msg_uuid, location, messages_only=False):
+    i = find_entry(entries, msg_uuid, messages_only)
+    if i is not None:
+        entries[i] = entries[i][:-1] + (location,)
+
+
+def remove_entry(entries, msg_uuid, messages_only=False):
+    i = find_entry(entries, msg_uuid, messages_only)
+    if i is not None:
+        del entries[i]
+
+
+class TenantLog(object):
+    """
+    Log of history, channel frames and user frames of one tenant
+    """
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE):
+        """
+
+        :param directory:
+        :param segment_size:
+        """
+        self.segments = SegmentLog(directory, segment_size)
+        self.compacted_size = self.segments.size()
+        self.compactions = 0
+        # max frames kept for user, set when log is recovered
+        self.user_frames_size = None
+
+    def append(self, op, name, msg_uuid=None, payload=None, flags=0):
+        return self.segments.append(
+            op,
+            flags,
+            uuid_bytes(msg_uuid),
+            name,
+            pickle.dumps(payload, pickle.HIGHEST_PROTOCOL),
+        )
+
+    def read(self, location):
+        return pickle.loads(self.segments.read(location).payload)
+
+    def channel_config(self, channel_name, long_name, settings):
+        self.append(CHANNEL_CONFIG, channel_name, payload=(long_name, settings))
+
+    def frame_record(self, op, name, frame):
+        t, message, envelope = frame
+        self.append(
+            op,
+            name,
+            message["uuid"],
+            (t, message, envelope.pm_users, envelope.exclude_users, envelope.seq),
+            message_flags(message),
+        )
+
+    def add_frame(self, kind, name, frame):
+        """
+        Stores catchup frame
+
+        :param kind: CHANNEL or USER
+        :param name: channel name or username
+        :param frame: (timestamp, message, envelope)
+        :return:
+        """
+        self.frame_record(FRAME_OPS[kind][0], name, frame)
+
+    def edit_frame(self, kind, name, frame):
+        self.frame_record(FRAME_OPS[kind][1], name, frame)
+
+    def delete_frame(self, kind, name, msg_uuid):
+        self.append(FRAME_OPS[kind][2], name, msg_uuid, flags=FLAG_MESSAGE)
+
+    def recover(self, user_frames_size=None, before=None, usernames=None):
+        """
+        Replays the log
+
+        :param user_frames_size: max frames kept for user
+        :param before: replays only segments older than this segment id
+        :param usernames: replays only records of these users
+        :return: ({channel_name: Recovered}, {username: Recovered}), frames
+          of recovered items are
+          (timestamp, message, pm_users, exclude_users, seq)
+        """
+        self.user_frames_size = user_frames_size
+        channels = {}
+        users = {}
+        for location, record in self.segments.replay():
+            op = record.op
+            if before is not None and location[0] >= before:
+                break
+            if usernames is not None and (
+                op <= CHANNEL_FRAME_DELETE or record.name not in usernames
+            ):
+                continue
+            if op <= CHANNEL_FRAME_DELETE:
+                found = channels.get(record.name)
+                if found is None:
+                    found = channels[record.name] = Recovered()
+            else:
+                found = users.get(record.name)
+                if found is None:
+                    found = users[record.name] = Recovered(frames_size=user_frames_size)
+            if op == CHANNEL_CONFIG:
+                found.configure(*pickle.loads(record.payload))
+            elif op in (CHANNEL_RESET, USER_RESET):
+                found.history.clear()
+                found.frames.clear()
+            elif op == HISTORY_MESSAGE:
+                found.history.append((record.uuid, location))
+            elif op == HISTORY_EDIT:
+                replace_entry(found.history, record.uuid, location)
+            elif op == HISTORY_DELETE:
+                remove_entry(found.history, record.uuid)
+            elif op in (CHANNEL_FRAME, USER_FRAME):
+                found.frames.append((record.uuid, record.flags, location))
+            elif op in (CHANNEL_FRAME_EDIT, USER_FRAME_EDIT):
+                replace_entry(found.frames, record.uuid, location, True)
+            elif op in (CHANNEL_FRAME_DELETE, USER_FRAME_DELETE):
+                remove_entry(found.frames, record.uuid, True)
+        for found in list(channels.values()) + list(users.values()):
+            found.frames = [self.read(location) for _, _, location in found.frames]
+        return channels, users
+
+    def needs_compaction(self):
+        size = self.segments.size()
+        return size > max(self.segments.segment_size, 2 * self.compacted_size)
+
+    def compact(self, server_state):
+        """
+        Rewrites live records of every channel and user into new segments
+        and removes the old ones. Channels are rewritten one at a time under
+        their lock, each starting with a reset record so messages appended
+        to channels that were not rewritten yet are not replayed twice.
+        Users restored from snapshot that were not used yet have no frames
+        in memory, their records are read back from the old segments.
+
+        :param server_state: state of tenant
+        :return:
+        """
+        boundary = self.segments.roll()
+        for channel_name in list(server_state.channels):
+            with server_state.channel_lock(channel_name):
+                channel = server_state.channels[channel_name]
+                if channel.log is self:
+                    self.rewrite_channel(channel)
+            gevent.sleep(0)
+        saved = getattr(server_state.users, "saved", {})
+        saved_users = {}
+        if saved:
+            _, saved_users = self.recover(
+                self.user_frames_size, before=boundary, usernames=set(saved)
+            )
+        with server_state.registry_lock:
+            for username, recovered in six.iteritems(saved_users):
+                # users loaded in the meantime are rewritten below
+                if username in saved:
+                    self.append(USER_RESET, username)
+                    for frame in recovered.frames:
+                        self.append(
+                            USER_FRAME,
+                            username,
+                            frame[1]["uuid"],
+                            frame,
+                            message_flags(frame[1]),
+                        )
+            for user in list(server_state.users.values()):
+                if user.log is self:
+                    self.append(USER_RESET, user.username)
+                    for frame in user.frames:
+                        self.add_frame(USER, user.username, frame)
+        self.segments.drop_before(boundary)
+        self.compacted_size = self.segments.size()
+        self.compactions += 1
+
+    def rewrite_channel(self, channel):
+        self.append(CHANNEL_RESET, channel.name)
+        self.channel_config(channel.name, channel.long_name, channel.settings)
+        history = channel.history
+        if isinstance(history, LoggedHistory):
+            entries = []
+            for msg_uuid, location in history.entries:
+                record = self.segments.read(location)
+                entries.append(
+                    (
+                        msg_uuid,
+                        self.segments.append(
+                            HISTORY_MESSAGE,
+                            record.flags,
+                            record.uuid,
+                            record.name,
+                            record.payload,
+                        ),
+                    )
+                )
+            history.entries = collections.deque(entries, maxlen=history.maxlen)
+        for frame in channel.frames:
+            self.add_frame(CHANNEL, channel.name, frame)
+
+    def sync(self):
+        self.segments.sync()
+
+    def close(self):
+        self.segments.close()
+
+    def get_info(self):
+        return {
+            "segments": len(self.segments.segments),
+            "size": self.segments.size(),
+            "compacted_size": self.compacted_size,
+            "compactions": self.compactions,
+        }
+
+
+def open_log(directory, tenant_id, segment_size=SEGMENT_SIZE, worker_id=None):
+    """
+    Opens log of tenant, every worker process keeps its own log
+
+    :param directory: base directory of logs
+    :param tenant_id:
+    :param segment_size:
+    :param worker_id:
+    :return: TenantLog
+    """
+    if worker_id is not None:
+        directory = os.path.join(directory, "worker_{}".format(worker_id))
+    return TenantLog(os.path.join(directory, tenant_id), segment_size)
+
+
+def maintain_logs():
+    """
+    Flushes logs to disk and compacts logs that doubled in size
+    """
+    for tenant_id, tenant_log in list(six.iteritems(LOGS)):
+        try:
+            tenant_log.sync()
+            if tenant_log.needs_compaction():
+                log.info("compacting log of tenant {}".format(tenant_id))
+                tenant_log.compact(get_state(tenant_id))
+        except Exception:
+            log.exception("log maintenance of tenant {} failed".format(tenant_id))
+
+
+def maintain_logs_forever():
+    try:
+        maintain_logs()
+    finally:
+        gevent.spawn_later(SYNC_INTERVAL, maintain_logs_forever)
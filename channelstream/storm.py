@@ -0,0 +1,125 @@
+"""
+Reconnect storm smoothing.
+
+When lots of connections come back at once (node restart, proxy reload)
+a tenant switches to storm mode for a grace period. While it lasts, users
+whose last connection leaves a channel are announced as parted only if
+they don't come back within the grace period, and catchup of reattached
+connections goes through a queue drained at a bounded rate.
+"""
+import logging
+import time
+
+import gevent
+
+from channelstream.connection import PollBuffer
+from channelstream.server_state import get_state, DEFAULT_TENANT
+
+log = logging.getLogger(__name__)
+
+# catchup queue is drained in this many slices per second
+CATCHUP_SLICES = 10
+
+
+def storm_active(server_state, now=None):
+    """
+    :param server_state:
+    :param now: timestamp, defaults to current time
+    :return: True if tenant is in storm mode
+    """
+    if not server_state.storm_reconnects_per_second:
+        return False
+    return (time.time() if now is None else now) < server_state.storm_until
+
+
+def begin_storm(server_state, now=None):
+    """
+    Starts storm mode or extends it by the grace period
+
+    :param server_state:
+    :param now: timestamp, defaults to current time
+    :return:
+    """
+    now = time.time() if now is None else now
+    if not storm_active(server_state, now):
+        server_state.stats["reconnect_storms"] += 1
+        log.info("reconnect storm in tenant {}".format(server_state.tenant_id))
+    server_state.storm_until = now + server_state.storm_grace
+
+
+def record_reconnect(tenant_id=DEFAULT_TENANT, now=None):
+    """
+    Counts client attaching its websocket, long poll or event stream,
+    storm mode starts once attachments per second reach the threshold
+
+    :param tenant_id:
+    :param now: timestamp, defaults to current time
+    :return: True if tenant is in storm mode
+    """
+    server_state = get_state(tenant_id)
+    threshold = server_state.storm_reconnects_per_second
+    if not threshold:
+        return False
+    now = time.time() if now is None else now
+    rate = server_state.reconnect_rate
+    rate.add(1, now=now)
+    if rate.current >= threshold or rate.last >= threshold:
+        begin_storm(server_state, now)
+    return storm_active(server_state, now)
+
+
+def deliver_catchup(connection, resume=None, resume_user=None):
+    """
+    Delivers catchup messages of attached connection, during storm
+    they are queued and delivered later at bounded rate. Queued catchup
+    only has messages sent before this call, newer ones go out live.
+
+    :param connection:
+    :param resume: {channel name: sequence number of last received message}
+    :param resume_user: sequence number of last received private message
+    :return: True if catchup was queued
+    """
+    server_state = get_state(connection.tenant_id)
+    if not server_state.storm_catchup_rate or not storm_active(server_state):
+        connection.deliver_catchup_messages(resume, resume_user)
+        return False
+    bounds = connection.catchup_bounds()
+    buffer = connection.queue
+    if isinstance(buffer, PollBuffer):
+        # polling client could acknowledge past catchup if it got newer
+        # live messages first
+        buffer.hold()
+    server_state.catchup_queue.append((connection, buffer, resume, resume_user, bounds))
+    server_state.stats["deferred_catchups"] += 1
+    if server_state.catchup_worker is None:
+        server_state.catchup_worker = gevent.spawn(drain_catchups, server_state)
+    return True
+
+
+def drain_catchups(server_state):
+    """
+    Delivers queued catchups, `storm_catchup_rate` per second
+    spread over CATCHUP_SLICES slices
+
+    :param server_state:
+    :return:
+    """
+    queue = server_state.catchup_queue
+    try:
+        while queue:
+            per_slice = max(server_state.storm_catchup_rate // CATCHUP_SLICES, 1)
+            for _ in range(min(per_slice, len(queue))):
+                connection, buffer, resume, resume_user, bounds = queue.popleft()
+                if connection.gc_deadline is None:
+                    # collected while waiting
+                    continue
+                if buffer is not connection.queue:
+                    # client moved on, new poll buffer got its own catchup
+                    continue
+                try:
+                    connection.deliver_catchup_messages(resume, resume_user, **bounds)
+                except Exception as exc:
+                    log.info(exc)
+            gevent.sleep(1.0 / CATCHUP_SLICES)
+    finally:
+        server_state.catchup_worker = None
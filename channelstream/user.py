@@ -1,12 +1,15 @@
-import copy
 import logging
 import uuid
 from datetime import datetime
 
 import six
+from six.moves import cPickle as pickle
 
-from channelstream.server_state import get_state
-from channelstream.utils import process_catchup
+from channelstream import storage
+from channelstream import patched_json as json
+from channelstream.envelope import Envelope
+from channelstream.server_state import get_state, DEFAULT_TENANT
+from channelstream.utils import frames_after_seq, frames_since, RingBuffer
 from channelstream.validation import MSG_EDITABLE_KEYS
 
 log = logging.getLogger(__name__)
@@ -15,15 +18,23 @@ log = logging.getLogger(__name__)
 class User(object):
     """ represents a unique user of the system """
 
-    def __init__(self, username):
+    frames_size = 50
+
+    def __init__(self, username, tenant_id=DEFAULT_TENANT):
         self.uuid = uuid.uuid4()
         self.username = username
+        self.tenant_id = tenant_id
         self.state = {}
-        self.state_public_keys = []
+        # bumped on every state change, part of /info ETags
+        self.state_version = 0
+        self._state_public_keys = []
         self.connections = []  # holds ids of connections
         # store frames for fetching when connection is established
         # those frames will store private messages
-        self.frames = []
+        self.frames = RingBuffer(maxlen=self.frames_size)
+        # sequence number of last message sent to the user
+        self.seq = 0
+        self.log = storage.get_log(tenant_id)
         self.last_active = None
         self.mark_activity()
 
@@ -33,12 +44,28 @@ class User(object):
     def __repr__(self):
         return "<User:%s, connections:%s>" % (self.username, len(self.connections))
 
-    def add_frame(self, frame):
-        self.frames.append((datetime.utcnow(), frame))
-        self.frames = self.frames[-50:]
+    def add_frame(self, frame, envelope=None):
+        if envelope is None:
+            envelope = Envelope(frame, seq=self.next_seq())
+        entry = (datetime.utcnow(), frame, envelope)
+        self.frames.append(entry)
+        if self.log:
+            self.log.add_frame(storage.USER, self.username, entry)
 
     def get_catchup_frames(self, newer_than):
-        return [process_catchup(f[1]) for f in self.frames if f[0] > newer_than]
+        return [f[2].catchup_payload for f in frames_since(self.frames, newer_than)]
+
+    def get_frames_after_seq(self, seq):
+        """
+        Catchup frames client is missing after message `seq`
+        """
+        if seq > self.seq:
+            seq = 0
+        return [f[2].catchup_payload for f in frames_after_seq(self.frames, seq)]
+
+    def next_seq(self):
+        self.seq += 1
+        return self.seq
 
     def add_connection(self, connection):
         """
@@ -54,16 +81,41 @@ class User(object):
         """
         Send a message to all connections of this user
         """
+        envelope = Envelope(message, seq=self.next_seq())
+        self.add_frame(message, envelope)
         # mark active
-        message = copy.deepcopy(message)
-        message.pop("no_history", None)
-        message.pop("pm_users", None)
-        message.pop("exclude_users", None)
-        self.add_frame(message)
         self.mark_activity()
-        for connection in self.connections:
-            connection.add_message(message)
-        return len(self.connections)
+        encoded = envelope.encode()
+        # other workers deliver to their own connections
+        attached = self.attached_connections
+        for connection in attached:
+            connection.add_message(envelope.payload, encoded=encoded)
+        return len(attached)
+
+    def add_messages(self, messages):
+        """
+        Sends a batch of messages to all connections of this user
+        as a single frame
+        """
+        if len(messages) == 1:
+            return self.add_message(messages[0])
+        envelopes = [Envelope(message, seq=self.next_seq()) for message in messages]
+        for message, envelope in zip(messages, envelopes):
+            self.add_frame(message, envelope)
+        self.mark_activity()
+        payloads = [envelope.payload for envelope in envelopes]
+        encoded = json.dumps(payloads)
+        attached = self.attached_connections
+        for connection in attached:
+            connection.add_messages(payloads, encoded=encoded)
+        return len(attached) * len(messages)
+
+    @property
+    def attached_connections(self):
+        """
+        Connections of the user attached to this worker
+        """
+        return [c for c in self.connections if c.attached_locally]
 
     def state_from_dict(self, state_dict):
         changed = []
@@ -72,8 +124,19 @@ class User(object):
                 if self.state.get(k) != v:
                     self.state[k] = v
                     changed.append({"key": k, "value": v})
+        if changed:
+            self.state_version += 1
         return changed
 
+    @property
+    def state_public_keys(self):
+        return self._state_public_keys
+
+    @state_public_keys.setter
+    def state_public_keys(self, value):
+        self._state_public_keys = value
+        self.state_version += 1
+
     @property
     def public_state(self):
         return {k: v for k, v in self.state.items() if k in self.state_public_keys}
@@ -85,22 +148,32 @@ class User(object):
         return info
 
     def get_channels(self):
-        server_state = get_state()
-        channels = []
-        for channel in six.itervalues(server_state.channels):
-            if channel.connections.get(self.username):
-                channels.append(channel)
-        return channels
+        """
+        Returns channels any of user connections is subscribed to
+        :return:
+        """
+        server_state = get_state(self.tenant_id)
+        channel_names = set()
+        for connection in self.connections:
+            channel_names.update(connection.channel_names)
+        return [
+            server_state.channels[name]
+            for name in sorted(channel_names)
+            if name in server_state.channels
+        ]
 
     def alter_message(self, to_edit):
         # normally tried to get channel and user from history
-        for f, msg in self.frames:
+        for i, (t, msg, envelope) in enumerate(self.frames):
             if msg["uuid"] == to_edit["uuid"] and msg["type"] == "message":
                 msg.update(
                     {k: v for k, v in six.iteritems(to_edit) if k in MSG_EDITABLE_KEYS}
                 )
+                self.frames[i] = (t, msg, Envelope(msg, seq=envelope.seq))
+                if self.log:
+                    self.log.edit_frame(storage.USER, self.username, self.frames[i])
                 break
-        altered = copy.deepcopy(to_edit)
+        altered = dict(to_edit)
         altered["type"] = "message:edit"
         self.add_message(altered)
 
@@ -109,12 +182,51 @@ class User(object):
         for i, frame in enumerate(self.frames):
             msg = frame[1]
             if msg["uuid"] == to_delete["uuid"] and msg["type"] == "message":
-                self.frames.pop(i)
+                del self.frames[i]
+                if self.log:
+                    self.log.delete_frame(storage.USER, self.username, msg["uuid"])
                 break
 
-        deleted = copy.deepcopy(to_delete)
+        deleted = dict(to_delete)
         deleted["type"] = "message:delete"
         self.add_message(deleted)
 
     def __json__(self, request=None):
         return self.get_info()
+
+
+class UserRegistry(dict):
+    """
+    Users of a tenant with users saved in a snapshot, saved users are
+    kept pickled and become User objects on first lookup
+    """
+
+    def __init__(self, users=None, tenant_id=DEFAULT_TENANT):
+        """
+
+        :param users: existing {username: User}
+        :param tenant_id:
+        """
+        super(UserRegistry, self).__init__(users or {})
+        self.tenant_id = tenant_id
+        # username -> pickled (state, state_public_keys)
+        self.saved = {}
+
+    def __missing__(self, username):
+        saved = self.saved.pop(username, None)
+        if saved is None:
+            raise KeyError(username)
+        user = User(username, tenant_id=self.tenant_id)
+        user.state, user.state_public_keys = pickle.loads(saved)
+        self[username] = user
+        return user
+
+    def __contains__(self, username):
+        return super(UserRegistry, self).__contains__(username) or (
+            username in self.saved
+        )
+
+    def get(self, username, default=None):
+        if username in self:
+            return self[username]
+        return default
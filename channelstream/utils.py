@@ -1,4 +1,5 @@
-import copy
+import bisect
+import collections
 import uuid
 
 import marshmallow
@@ -49,10 +50,205 @@ def uuid_from_string(str_uuid):
         raise marshmallow.ValidationError("Wrong UUID format")
 
 
-def process_catchup(m):
-    copied = copy.deepcopy(m)
-    copied["catchup"] = True
-    copied.pop("pm_users", None)
-    copied.pop("exclude_users", None)
-    copied.pop("no_history", None)
-    return copied
+def newer_frames(frames, is_newer):
+    """
+    Newest frames that pass `is_newer`, frames are walked from the newest
+    one and the walk stops at the first older frame - catchup costs as much
+    as frames it returns, deque indexing would be O(n) towards the middle
+
+    :param frames: ordered sequence of frames
+    :param is_newer: callable taking frame
+    :return: list of frames in original order
+    """
+    found = []
+    for frame in reversed(frames):
+        if not is_newer(frame):
+            break
+        found.append(frame)
+    found.reverse()
+    return found
+
+
+def frames_since(frames, newer_than):
+    """
+    Frames stored after `newer_than`
+
+    :param frames: time ordered sequence of tuples starting with timestamp
+    :param newer_than: datetime
+    :return: list of frames
+    """
+    return newer_frames(frames, lambda frame: frame[0] > newer_than)
+
+
+def first_newer_frame(frames, newer_than):
+    """
+    :return: index of first frame stored after `newer_than`,
+        len(frames) if there is none
+    """
+    return len(frames) - len(frames_since(frames, newer_than))
+
+
+def frames_after_seq(frames, seq):
+    """
+    Frames newer than sequence number `seq`
+
+    :param frames: sequence of (timestamp, message, envelope) tuples
+        ordered by sequence number
+    :param seq: sequence number client already has
+    :return: list of frames
+    """
+    return newer_frames(frames, lambda frame: frame[2].seq > seq)
+
+
+def first_frame_after_seq(frames, seq):
+    """
+    :return: index of first frame newer than `seq`, len(frames) if there
+        is none
+    """
+    return len(frames) - len(frames_after_seq(frames, seq))
+
+
+def parse_resume(value):
+    """
+    Parses `channel:seq,channel2:seq` resume positions
+
+    :param value:
+    :return: {channel name: seq}
+    """
+    positions = {}
+    for item in (value or "").split(","):
+        channel_name, _, seq = item.rpartition(":")
+        if channel_name and seq.isdigit():
+            positions[channel_name] = int(seq)
+    return positions
+
+
+def parse_cursor(value):
+    """
+    Parses poll cursor - resume positions of channels and position among
+    private messages of the user as `:seq`, e.g. `chat:41,news:7,:3`
+
+    :param value:
+    :return: {channel name or None for private messages: seq}
+    """
+    positions = {}
+    for item in (value or "").split(","):
+        channel_name, separator, seq = item.rpartition(":")
+        if separator and seq.isdigit():
+            positions[channel_name or None] = int(seq)
+    return positions
+
+
+def format_cursor(positions):
+    """
+    Serializes cursor positions parsed by parse_cursor()
+
+    :param positions: {channel name or None: seq}
+    :return:
+    """
+    return ",".join(
+        "{}:{}".format(name or "", seq)
+        for name, seq in sorted(positions.items(), key=lambda item: item[0] or "")
+    )
+
+
+def cursor_resume(positions):
+    """
+    :param positions: cursor positions
+    :return: (resume, resume_user) catchup arguments for cursor positions
+    """
+    resume = {name: seq for name, seq in positions.items() if name is not None}
+    return resume, positions.get(None)
+
+
+class RingBuffer(collections.deque):
+    """
+    Fixed capacity buffer, appending to a full buffer drops the oldest item
+    without copying the rest
+    """
+
+    def resized(self, maxlen):
+        """
+        Returns new buffer with different capacity keeping newest items
+        :param maxlen:
+        :return:
+        """
+        return type(self)(self, maxlen=maxlen)
+
+
+class MessageBuffer(RingBuffer):
+    """
+    Ring buffer of messages that can be edited and deleted by uuid
+    """
+
+    def edit_message(self, msg_uuid, changes):
+        """
+        Updates message in place
+        :return: edited message or None if it is not in buffer
+        """
+        for msg in self:
+            if msg["uuid"] == msg_uuid:
+                msg.update(changes)
+                return msg
+        return None
+
+    def delete_message(self, msg_uuid):
+        for i, msg in enumerate(self):
+            if msg["uuid"] == msg_uuid:
+                del self[i]
+                return True
+        return False
+
+
+def merge_frames(frames):
+    """
+    Joins encoded JSON array frames into a single array frame
+    without decoding them
+
+    :param frames: list of encoded JSON arrays
+    :return: encoded JSON array holding items of every frame in order
+    """
+    items = [frame[1:-1] for frame in frames if len(frame) > 2]
+    return "[" + ",".join(items) + "]"
+
+
+class Histogram(object):
+    """
+    Counts observed values in fixed buckets, reported bucket counts are
+    cumulative like Prometheus histograms - a value is counted by every
+    bucket whose upper bound is not lower than the value. Observing only
+    increments the first such bucket, cumulative counts are summed up
+    when they are read.
+    """
+
+    def __init__(self, buckets):
+        """
+        :param buckets: sorted upper bounds, +Inf bucket is implied
+        """
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        """
+        :return: [(upper bound, values not above it)] without +Inf bucket
+        """
+        result = []
+        total = 0
+        for bound, n in zip(self.bounds, self.counts):
+            total += n
+            result.append((bound, total))
+        return result
+
+    def get_info(self):
+        return {
+            "buckets": [[bound, n] for bound, n in self.cumulative_counts()],
+            "count": self.count,
+            "sum": self.sum,
+        }
@@ -6,13 +6,15 @@ from apispec.ext.marshmallow.openapi import OpenAPIConverter
 from marshmallow import fields, ValidationError
 from marshmallow.base import FieldABC
 
-from channelstream.server_state import get_state
+from channelstream.server_state import get_state, DEFAULT_TENANT
 
 converter = OpenAPIConverter("2.0.0")
 
 
 MSG_EDITABLE_KEYS = ("uuid", "timestamp", "user", "message", "edited")
 
+OVERFLOW_POLICIES = ("drop_oldest", "drop_newest", "disconnect")
+
 
 try:
     base_types = (unicode, basestring)
@@ -24,14 +26,14 @@ def gen_uuid():
     return uuid.uuid4()
 
 
-def validate_connection_id(conn_id):
-    server_state = get_state()
+def validate_connection_id(conn_id, tenant_id=DEFAULT_TENANT):
+    server_state = get_state(tenant_id)
     if conn_id not in server_state.connections:
         raise marshmallow.ValidationError("Unknown connection")
 
 
-def validate_username(username):
-    server_state = get_state()
+def validate_username(username, tenant_id=DEFAULT_TENANT):
+    server_state = get_state(tenant_id)
     if username not in server_state.users:
         raise marshmallow.ValidationError("Unknown user")
 
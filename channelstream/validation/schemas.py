@@ -7,6 +7,7 @@ from channelstream.validation import (
     BackportedDict,
     ChannelstreamSchema,
     gen_uuid,
+    OVERFLOW_POLICIES,
     validate_connection_id,
     validate_username,
     UserStateField,
@@ -35,6 +36,46 @@ class ChannelConfigSchema(ChannelstreamSchema):
     store_frames = fields.Boolean(
         missing=True, description="Should store catchup frames"
     )
+    frames_size = fields.Integer(
+        missing=100,
+        validate=[validate.Range(min=0, max=10000)],
+        description="How many catchup frames should be stored",
+    )
+    overflow_policy = fields.String(
+        missing="drop_oldest",
+        validate=validate.OneOf(OVERFLOW_POLICIES),
+        description="What happens when subscriber send queue is full: "
+        "drop_oldest, drop_newest or disconnect",
+    )
+    coalesce_ms = fields.Integer(
+        missing=0,
+        validate=[validate.Range(min=0, max=1000)],
+        description="Merge messages sent to a subscriber within this many "
+        "milliseconds into one frame, 0 disables coalescing",
+    )
+    coalesce_messages = fields.Integer(
+        missing=0,
+        validate=[validate.Range(min=0)],
+        description="Write coalesced frame early once it holds this many "
+        "messages, 0 means no limit",
+    )
+    presence_deltas = fields.Boolean(
+        missing=False,
+        description="Send presence as batched joined/parted deltas, "
+        "joining connections get the full user list",
+    )
+    presence_window_ms = fields.Integer(
+        missing=50,
+        validate=[validate.Range(min=0, max=10000)],
+        description="Merge presence changes within this many milliseconds "
+        "into one delta, 0 sends every change right away",
+    )
+    presence_snapshot_interval = fields.Integer(
+        missing=0,
+        validate=[validate.Range(min=0)],
+        description="Seconds between full user lists sent along with "
+        "presence deltas, 0 disables",
+    )
 
 
 class InfoResolutionSchema(ChannelstreamSchema):
@@ -48,8 +89,31 @@ class InfoResolutionSchema(ChannelstreamSchema):
     return_public_state = fields.Boolean(missing=False)
 
 
+class ChannelInfoResolutionSchema(InfoResolutionSchema):
+    prefix = fields.String(
+        validate=validate.Length(max=256),
+        description="Only channels with names starting with this prefix",
+    )
+    limit = fields.Integer(
+        missing=0,
+        validate=[validate.Range(min=0)],
+        description="Return at most this many channels ordered by name, "
+        "response has `next_cursor` to fetch next page with, 0 returns "
+        "every channel",
+    )
+    cursor = fields.String(
+        allow_none=True,
+        validate=validate.Length(max=256),
+        description="Return channels with names after this one",
+    )
+    stream = fields.Boolean(
+        missing=False,
+        description="Stream the response in chunks instead of building it " "at once",
+    )
+
+
 class ChannelInfoBodySchema(ChannelstreamSchema):
-    info = fields.Nested(InfoResolutionSchema, required=True)
+    info = fields.Nested(ChannelInfoResolutionSchema, required=True)
 
 
 class ConnectBodySchema(ChannelstreamSchema):
@@ -103,10 +167,22 @@ class ConnectBodySchema(ChannelstreamSchema):
         missing=lambda: {},
         description="Controls how much information should be returned in response",
     )
+    coalesce_ms = fields.Integer(
+        missing=0,
+        validate=[validate.Range(min=0, max=1000)],
+        description="Merge messages sent to this connection within this many "
+        "milliseconds into one frame, 0 disables coalescing",
+    )
+    coalesce_messages = fields.Integer(
+        missing=0,
+        validate=[validate.Range(min=0)],
+        description="Write coalesced frame early once it holds this many "
+        "messages, 0 means no limit",
+    )
 
 
 class SubscribeBodySchema(ChannelstreamSchema):
-    conn_id = fields.UUID(required=True, validate=[validate_connection_id])
+    conn_id = fields.UUID(required=True)
 
     channels = fields.List(
         fields.String(validate=validate.Length(min=1, max=256)),
@@ -129,15 +205,17 @@ class SubscribeBodySchema(ChannelstreamSchema):
         in_data.setdefault("conn_id", self.context["request"].GET.get("conn_id"))
         return in_data
 
+    @marshmallow.validates("conn_id")
+    def validate_conn_id(self, conn_id):
+        validate_connection_id(conn_id, tenant_id=self.context["request"].tenant_id)
+
 
 class UnsubscribeBodySchema(SubscribeBodySchema):
     pass
 
 
 class UserStateBodySchema(ChannelstreamSchema):
-    user = fields.String(
-        required=True, validate=[validate.Length(min=1, max=512), validate_username]
-    )
+    user = fields.String(required=True, validate=[validate.Length(min=1, max=512)])
 
     user_state = BackportedDict(
         missing=lambda: {},
@@ -153,6 +231,10 @@ class UserStateBodySchema(ChannelstreamSchema):
         description="What state keys should be visible/emitted to other users",
     )
 
+    @marshmallow.validates("user")
+    def validate_user(self, username):
+        validate_username(username, tenant_id=self.context["request"].tenant_id)
+
 
 class PayloadDeliveryInfo(ChannelstreamSchema):
     pm_users = fields.List(
@@ -1,8 +1,8 @@
 from six.moves.urllib.parse import parse_qs
 from ws4py.websocket import WebSocket
 
-from channelstream import utils
-from channelstream.server_state import get_state
+from channelstream import bus, operations, storm, utils
+from channelstream.server_state import get_state, DEFAULT_TENANT, STATES
 
 
 class ChatApplicationSocket(WebSocket):
@@ -10,22 +10,37 @@ class ChatApplicationSocket(WebSocket):
         super(ChatApplicationSocket, self).__init__(*args, **kwargs)
         self.qs = None
         self.conn_id = None
+        self.tenant_id = DEFAULT_TENANT
 
     def opened(self):
-        server_state = get_state()
         self.qs = parse_qs(self.environ["QUERY_STRING"])
+        tenant_id = self.qs.get("tenant", [DEFAULT_TENANT])[0]
+        if tenant_id not in STATES:
+            self.close()
+            return
+        self.tenant_id = tenant_id
         self.conn_id = utils.uuid_from_string(self.qs.get("conn_id")[0])
-        if self.conn_id not in server_state.connections:
+        connection = operations.find_connection(self.conn_id, self.tenant_id)
+        if connection is None:
             # close connection instantly if user played with id
             self.close()
         else:
+            # first socket after /connect is not a reconnect
+            reattaching = connection.reattaching
             # attach a socket to connection
-            connection = server_state.connections[self.conn_id]
-            connection.socket = self
-            connection.deliver_catchup_messages()
+            connection.attach_socket(self)
+            bus.publish("attach", connection.id, self.tenant_id)
+            if reattaching:
+                storm.record_reconnect(self.tenant_id)
+            resume_user = self.qs.get("resume_user", [""])[0]
+            storm.deliver_catchup(
+                connection,
+                resume=utils.parse_resume(self.qs.get("resume", [""])[0]),
+                resume_user=int(resume_user) if resume_user.isdigit() else None,
+            )
 
     def received_message(self, m):
-        server_state = get_state()
+        server_state = get_state(self.tenant_id)
         # this is to allow client heartbeats
         if self.conn_id in server_state.connections:
             connection = server_state.connections[self.conn_id]
@@ -35,7 +50,7 @@ class ChatApplicationSocket(WebSocket):
                 user.mark_activity()
 
     def closed(self, code, reason=""):
-        server_state = get_state()
+        server_state = get_state(self.tenant_id)
         self.environ.pop("ws4py.app")
         found_conn = self.conn_id in server_state.connections
         if hasattr(self, "conn_id") and found_conn:
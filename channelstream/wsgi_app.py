@@ -39,7 +39,9 @@ def make_app(server_config):
     config.set_authentication_policy(authn_policy)
     config.set_authorization_policy(authz_policy)
 
-    json_renderer = JSON(serializer=json.dumps, indent=4)
+    # keep responses compact unless we are debugging
+    serializer = json.dumps_pretty if server_config.get("debug") else json.dumps
+    json_renderer = JSON(serializer=serializer)
     json_renderer.add_adapter(datetime.datetime, datetime_adapter)
     json_renderer.add_adapter(uuid.UUID, uuid_adapter)
     config.add_renderer("json", json_renderer)
@@ -48,6 +50,11 @@ def make_app(server_config):
         "channelstream.subscribers.handle_new_request", "pyramid.events.NewRequest"
     )
     config.add_request_method("channelstream.utils.handle_cors", "handle_cors")
+    config.add_request_method(
+        "channelstream.wsgi_views.wsgi_security.request_tenant_id",
+        "tenant_id",
+        reify=True,
+    )
     config.include("channelstream.wsgi_views")
     config.scan("channelstream.wsgi_views.server")
     config.scan("channelstream.wsgi_views.error_handlers")
@@ -32,6 +32,11 @@ def includeme(config):
         "/admin/admin.json",
         factory="channelstream.wsgi_views." "wsgi_security:BasicAuthFactory",
     )
+    config.add_route(
+        "metrics",
+        "/metrics",
+        factory="channelstream.wsgi_views." "wsgi_security:BasicAuthFactory",
+    )
     # legacy API
     config.add_route("legacy_connect", "/connect")
     config.add_route("legacy_subscribe", "/subscribe")
@@ -44,6 +49,7 @@ def includeme(config):
     # listening API
     config.add_route("api_listen", "/listen")
     config.add_route("api_listen_ws", "/ws")
+    config.add_route("api_listen_sse", "/sse")
     config.add_route("api_disconnect", "/disconnect")
 
     # do not expose V1 API yet
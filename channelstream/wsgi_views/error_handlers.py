@@ -17,3 +17,12 @@ def itsdangerous_signer_error(context, request):
     request.response.status = 401
     log.error("Request had incorrect signature")
     return {"request": "Bad Signature"}
+
+
+@exception_view_config(
+    context="channelstream.server_state.QuotaExceeded", renderer="json"
+)
+def quota_exceeded(context, request):
+    request.response.status = 429
+    log.warning(str(context))
+    return {"quota": context.quota, "tenant": context.tenant_id}
@@ -1,27 +1,90 @@
+import hashlib
+import heapq
 import logging
+import time
 from datetime import datetime
 
 import gevent
 import six
 from apispec import APISpec
 from apispec.ext.marshmallow import MarshmallowPlugin
-from gevent.queue import Queue, Empty
-from pyramid.httpexceptions import HTTPUnauthorized
+from pyramid.httpexceptions import HTTPNotModified, HTTPUnauthorized
 from pyramid.security import forget, NO_PERMISSION_REQUIRED
 from pyramid.view import view_config, view_defaults
 from pyramid_apispec.helpers import add_pyramid_paths
+from webob.etag import ETagMatcher
 
-from channelstream import operations, utils, patched_json as json
-from channelstream.server_state import get_state, STATS
+from channelstream import bus, cluster, metrics, operations, storage, storm, utils
+from channelstream import patched_json as json
+from channelstream.server_state import get_state, STATES, STATS
 from channelstream.validation import schemas
 
 log = logging.getLogger(__name__)
 
+# how many already streamed messages are kept for clients resuming
+# server-sent events stream with Last-Event-ID
+SSE_RESUME_MESSAGES = 100
+
+# channels or users encoded between yields of streamed /info
+INFO_STREAM_CHUNK = 100
+
 
 class SharedUtils(object):
     def __init__(self, request):
         self.request = request
 
+    def select_channels(self, req_channels=None, exclude_channels=None):
+        """
+        Channels info is requested for
+
+        :param req_channels: channel names, None selects every channel
+        :param exclude_channels: channel names to leave out
+        :return: (local channel instances, names of channels that only
+            have subscribers on other cluster nodes)
+        """
+        tenant_id = self.request.tenant_id
+        server_state = get_state(tenant_id)
+        if not exclude_channels:
+            exclude_channels = []
+        # select everything for empty list
+        if req_channels is None:
+            channel_instances = six.itervalues(server_state.channels)
+        else:
+            channel_instances = [
+                server_state.channels[c]
+                for c in req_channels
+                if c in server_state.channels
+            ]
+        channel_instances = [
+            c for c in channel_instances if c.name not in exclude_channels
+        ]
+        remote_channels = cluster.remote_channel_names(tenant_id)
+        if req_channels is not None:
+            remote_channels.intersection_update(req_channels)
+        remote_channels = [
+            channel_name
+            for channel_name in sorted(remote_channels)
+            if channel_name not in server_state.channels
+            and channel_name not in exclude_channels
+        ]
+        return channel_instances, remote_channels
+
+    def get_users_info(self, usernames, return_public_state=False):
+        tenant_id = self.request.tenant_id
+        server_state = get_state(tenant_id)
+        users = []
+        for username in usernames:
+            user = server_state.users.get(username)
+            if user is None:
+                # only public state is known for users of other nodes
+                state = cluster.remote_user_state(tenant_id, username)
+            elif return_public_state:
+                state = user.public_state
+            else:
+                state = user.state
+            users.append({"user": username, "state": state})
+        return users
+
     def get_channel_info(
         self,
         req_channels=None,
@@ -42,48 +105,235 @@ class SharedUtils(object):
         :param: exclude_channels (bool) will exclude specific channels
                 from info list (handy to exclude global broadcast)
         """
-        server_state = get_state()
-        if not exclude_channels:
-            exclude_channels = []
+        tenant_id = self.request.tenant_id
         start_time = datetime.utcnow()
 
         json_data = {"channels": {}, "users": []}
 
         users_to_list = set()
-
-        # select everything for empty list
-        if req_channels is None:
-            channel_instances = six.itervalues(server_state.channels)
-        else:
-            channel_instances = [
-                server_state.channels[c]
-                for c in req_channels
-                if c in server_state.channels
-            ]
-
+        channel_instances, remote_channels = self.select_channels(
+            req_channels, exclude_channels
+        )
         for channel_inst in channel_instances:
-            if channel_inst.name in exclude_channels:
-                continue
-
             channel_info = channel_inst.get_info(
                 include_history=include_history, include_users=include_users
             )
             json_data["channels"][channel_inst.name] = channel_info
             users_to_list.update(channel_info["users"])
 
-        for username in users_to_list:
-            user = server_state.users[username]
-            json_data["users"].append(
-                {
-                    "user": username,
-                    "state": user.state
-                    if not return_public_state
-                    else user.public_state,
-                }
+        # channels that only have subscribers on other cluster nodes
+        for channel_name in remote_channels:
+            channel_info = cluster.remote_channel_info(
+                tenant_id, channel_name, include_users=include_users
             )
+            json_data["channels"][channel_name] = channel_info
+            users_to_list.update(channel_info["users"])
+
+        json_data["users"] = self.get_users_info(users_to_list, return_public_state)
         log.info("info time: %s" % (datetime.utcnow() - start_time))
         return json_data
 
+    def page_channels(
+        self, channel_instances, remote_channels, prefix=None, cursor=None, limit=0
+    ):
+        """
+        Narrows selected channels down to those matching prefix and,
+        with a limit, to one page of channels ordered by name
+
+        :param channel_instances: local channels from select_channels()
+        :param remote_channels: remote channel names from select_channels()
+        :param prefix: channel name prefix
+        :param cursor: only channels with names after this one
+        :param limit: page size, 0 means no paging
+        :return: (channel instances, remote channel names, name to pass
+            as cursor for next page or None if this is the last one)
+        """
+
+        def wanted(name):
+            if prefix and not name.startswith(prefix):
+                return False
+            return cursor is None or name > cursor
+
+        channel_instances = [c for c in channel_instances if wanted(c.name)]
+        remote_channels = [name for name in remote_channels if wanted(name)]
+        if not limit:
+            return channel_instances, remote_channels, None
+        names = heapq.nsmallest(
+            limit + 1, [c.name for c in channel_instances] + remote_channels
+        )
+        next_cursor = None
+        if len(names) > limit:
+            names = names[:limit]
+            next_cursor = names[-1]
+        page = set(names)
+        channel_instances = sorted(
+            (c for c in channel_instances if c.name in page), key=lambda c: c.name
+        )
+        remote_channels = [name for name in remote_channels if name in page]
+        return channel_instances, remote_channels, next_cursor
+
+    def get_info_etag(
+        self,
+        channel_instances,
+        remote_channels,
+        include_history=True,
+        include_users=False,
+        return_public_state=False,
+    ):
+        """
+        ETag of info about selected channels, derived from versions of
+        channels, listed users and cluster membership so it is known before
+        anything gets encoded
+        """
+        tenant_id = self.request.tenant_id
+        server_state = get_state(tenant_id)
+        tag = [
+            tenant_id,
+            bool(include_history),
+            bool(include_users),
+            bool(return_public_state),
+            cluster.remote_version(),
+        ]
+        for channel_inst in channel_instances:
+            users = channel_inst.cached_info(include_history, include_users)["users"]
+            # state versions only grow, so their sum changes with any of them
+            state_versions = 0
+            for username in users:
+                user = server_state.users.get(username)
+                if user is not None:
+                    state_versions += user.state_version
+            tag.append(
+                (
+                    channel_inst.name,
+                    channel_inst.uuid,
+                    channel_inst.info_version,
+                    channel_inst.last_active,
+                    state_versions,
+                )
+            )
+        tag.extend(remote_channels)
+        return hashlib.md5(repr(tag).encode("utf8")).hexdigest()
+
+    def iter_info_json(
+        self,
+        channel_instances,
+        remote_channels,
+        include_history=True,
+        include_users=False,
+        return_public_state=False,
+        next_cursor=False,
+        chunk_size=0,
+    ):
+        """
+        Encodes info about selected channels piece by piece, channel parts
+        are encoded once per channel info version
+
+        :param next_cursor: adds `next_cursor` key unless False
+        :param chunk_size: yield chunks of that many channels or users and
+            let other greenlets run in between, 0 yields separate pieces
+        :return: generator of JSON strings
+        """
+        tenant_id = self.request.tenant_id
+        server_state = get_state(tenant_id)
+        users_to_list = set()
+        pieces = []
+
+        def flush():
+            chunk = "".join(pieces)
+            del pieces[:]
+            return chunk
+
+        yield '{"channels":{'
+        separator = ""
+        for channel_inst in channel_instances:
+            # history is copied under the lock log compaction takes,
+            # encoded channel does not depend on the log anymore
+            with server_state.channel_lock(channel_inst.name):
+                info = channel_inst.cached_info(include_history, include_users)
+                encoded = channel_inst.get_info_json(include_history, include_users)
+            users_to_list.update(info["users"])
+            pieces.append(separator + json.dumps(channel_inst.name) + ":" + encoded)
+            separator = ","
+            if len(pieces) >= max(chunk_size, 1):
+                yield flush()
+                if chunk_size:
+                    gevent.sleep(0)
+        # channels that only have subscribers on other cluster nodes
+        for channel_name in remote_channels:
+            info = cluster.remote_channel_info(
+                tenant_id, channel_name, include_users=include_users
+            )
+            users_to_list.update(info["users"])
+            pieces.append(separator + json.dumps(channel_name) + ":" + json.dumps(info))
+            separator = ","
+        pieces.append('},"users":[')
+        separator = ""
+        for user_info in self.get_users_info(users_to_list, return_public_state):
+            pieces.append(separator + json.dumps(user_info))
+            separator = ","
+            if len(pieces) >= max(chunk_size, 1):
+                yield flush()
+                if chunk_size:
+                    gevent.sleep(0)
+        pieces.append("]")
+        if next_cursor is not False:
+            pieces.append(',"next_cursor":' + json.dumps(next_cursor))
+        pieces.append("}")
+        yield flush()
+
+    def get_channel_info_json(
+        self,
+        req_channels=None,
+        include_history=True,
+        include_users=False,
+        exclude_channels=None,
+        return_public_state=False,
+        if_none_match=None,
+        prefix=None,
+        cursor=None,
+        limit=0,
+        stream=False,
+    ):
+        """
+        Same as get_channel_info() encoded as JSON, optionally one page
+        of channels ordered by name or streamed in chunks
+
+        :param if_none_match: ETag matcher of the request
+        :param prefix: only channels with names starting with prefix
+        :param cursor: only channels with names after this one
+        :param limit: page size, response gets `next_cursor`, 0 means no paging
+        :param stream: return generator of chunks, streamed info has no ETag
+        :return: (etag, JSON string or generator of strings, or None
+            if `if_none_match` matched)
+        """
+        channel_instances, remote_channels = self.select_channels(
+            req_channels, exclude_channels
+        )
+        channel_instances, remote_channels, next_cursor = self.page_channels(
+            channel_instances, remote_channels, prefix, cursor, limit
+        )
+        encoded = self.iter_info_json(
+            channel_instances,
+            remote_channels,
+            include_history,
+            include_users,
+            return_public_state,
+            next_cursor=next_cursor if limit else False,
+            chunk_size=INFO_STREAM_CHUNK if stream else 0,
+        )
+        if stream:
+            return None, encoded
+        etag = self.get_info_etag(
+            channel_instances,
+            remote_channels,
+            include_history,
+            include_users,
+            return_public_state,
+        )
+        if if_none_match is not None and etag in if_none_match:
+            return etag, None
+        return etag, "".join(encoded)
+
     def get_common_info(self, channels, info_config):
         """
         Return channel information based on requirements
@@ -139,6 +389,7 @@ def connect(request):
           schema:
             $ref: '#/definitions/ConnectBody'
     """
+    started = time.time()
     shared_utils = SharedUtils(request)
     schema = schemas.ConnectBodySchema(context={"request": request})
     json_body = schema.load(request.json_body).data
@@ -151,10 +402,27 @@ def connect(request):
         conn_id=json_body["conn_id"],
         channels=channels,
         channel_configs=json_body["channel_configs"],
+        tenant_id=request.tenant_id,
+        coalesce_ms=json_body["coalesce_ms"],
+        coalesce_messages=json_body["coalesce_messages"],
+    )
+    bus.publish(
+        "connect",
+        username=json_body["username"],
+        fresh_user_state=json_body["fresh_user_state"],
+        state_public_keys=json_body["state_public_keys"],
+        update_user_state=json_body["user_state"],
+        conn_id=connection.id,
+        channels=channels,
+        channel_configs=json_body["channel_configs"],
+        tenant_id=request.tenant_id,
+        coalesce_ms=json_body["coalesce_ms"],
+        coalesce_messages=json_body["coalesce_messages"],
     )
 
     # get info config for channel information
     channels_info = shared_utils.get_common_info(channels, json_body["info"])
+    get_state(request.tenant_id).connect_latency.observe(time.time() - started)
 
     return {
         "conn_id": connection.id,
@@ -196,7 +464,8 @@ def subscribe(request):
         200:
           description: "Success"
     """
-    server_state = get_state()
+    started = time.time()
+    server_state = get_state(request.tenant_id)
     shared_utils = SharedUtils(request)
     schema = schemas.SubscribeBodySchema(context={"request": request})
     json_body = schema.load(request.json_body).data
@@ -206,10 +475,14 @@ def subscribe(request):
     subscribed_to = operations.subscribe(
         connection=connection, channels=channels, channel_configs=channel_configs
     )
+    bus.publish(
+        "subscribe", connection.id, channels, channel_configs, request.tenant_id
+    )
 
     # get info config for channel information
     current_channels = connection.channels
     channels_info = shared_utils.get_common_info(current_channels, json_body["info"])
+    server_state.subscribe_latency.observe(time.time() - started)
     return {
         "channels": current_channels,
         "channels_info": channels_info,
@@ -247,7 +520,7 @@ def unsubscribe(request):
         200:
           description: "Success"
     """
-    server_state = get_state()
+    server_state = get_state(request.tenant_id)
     shared_utils = SharedUtils(request)
     schema = schemas.UnsubscribeBodySchema(context={"request": request})
     json_body = schema.load(request.json_body).data
@@ -255,6 +528,7 @@ def unsubscribe(request):
     unsubscribed_from = operations.unsubscribe(
         connection=connection, unsubscribe_channels=json_body["channels"]
     )
+    bus.publish("unsubscribe", connection.id, json_body["channels"], request.tenant_id)
 
     # get info config for channel information
     current_channels = connection.channels
@@ -288,22 +562,30 @@ def listen(request):
         200:
           description: "Success"
     """
-    server_state = get_state()
+    if request.tenant_id not in STATES:
+        raise HTTPUnauthorized()
     config = request.registry.settings
     conn_id = utils.uuid_from_string(request.params.get("conn_id"))
-    connection = server_state.connections.get(conn_id)
+    cursor = request.params.get("cursor")
+    connection = operations.find_connection(conn_id, request.tenant_id)
     if not connection:
         raise HTTPUnauthorized()
-    # attach a queue to connection
-    connection.queue = Queue()
-    connection.deliver_catchup_messages()
-    request.response.app_iter = yield_response(request, connection, config)
+    if cursor is not None:
+        cursor = connection.valid_cursor(utils.parse_cursor(cursor))
+    # buffer keeps messages that arrive between polls
+    if connection.attach_poll_buffer():
+        storm.record_reconnect(request.tenant_id)
+        storm.deliver_catchup(connection, *utils.cursor_resume(cursor or {}))
+    bus.publish("attach", connection.id, request.tenant_id)
+    request.response.app_iter = yield_response(request, connection, config, cursor)
     return request.response
 
 
-def yield_response(request, connection, config):
-    messages = await_data(connection, config)
+def yield_response(request, connection, config, cursor=None):
+    messages, last = await_data(connection, config, cursor)
     connection.mark_activity()
+    if cursor is not None:
+        messages = {"cursor": utils.format_cursor(last), "messages": messages}
     cb = request.params.get("callback")
     if cb:
         resp = cb + "(" + json.dumps(messages) + ")"
@@ -315,20 +597,103 @@ def yield_response(request, connection, config):
         yield resp.encode("utf8")
 
 
-def await_data(connection, config):
-    messages = []
-    # block for first message - wake up after a while
-    try:
-        messages.extend(connection.queue.get(timeout=config["wake_connections_after"]))
-    except Empty:
-        pass
-    # get more messages if enqueued takes up total 0.25
-    while True:
-        try:
-            messages.extend(connection.queue.get(timeout=0.25))
-        except Empty:
-            break
-    return messages
+@view_config(
+    route_name="api_listen_sse", request_method="GET", permission=NO_PERMISSION_REQUIRED
+)
+def listen_sse(request):
+    """
+    Streams messages as server-sent events
+    ---
+    get:
+      tags:
+      - "Client API"
+      summary: "Streams messages as server-sent events"
+      description: "Event ids are cursors with message sequence numbers,
+      reconnecting client resumes after Last-Event-ID header
+      (or last_event_id param)"
+      operationId: "listen_sse"
+      produces:
+      - "text/event-stream"
+      responses:
+        200:
+          description: "Success"
+    """
+    if request.tenant_id not in STATES:
+        raise HTTPUnauthorized()
+    config = request.registry.settings
+    conn_id = utils.uuid_from_string(request.params.get("conn_id"))
+    cursor = request.headers.get("Last-Event-ID") or request.params.get("last_event_id")
+    connection = operations.find_connection(conn_id, request.tenant_id)
+    if not connection:
+        raise HTTPUnauthorized()
+    cursor = connection.valid_cursor(utils.parse_cursor(cursor))
+    attached = connection.attach_poll_buffer(transport="sse")
+    # stream that dropped and resumes after Last-Event-ID keeps its buffer
+    if attached or cursor:
+        storm.record_reconnect(request.tenant_id)
+    if attached:
+        storm.deliver_catchup(connection, *utils.cursor_resume(cursor))
+    bus.publish("attach", connection.id, request.tenant_id)
+    response = request.response
+    response.content_type = "text/event-stream"
+    response.headers["Cache-Control"] = "no-cache"
+    # ask proxies not to buffer the stream
+    response.headers["X-Accel-Buffering"] = "no"
+    response.app_iter = stream_events(request, connection, config, cursor)
+    return response
+
+
+def stream_events(request, connection, config, cursor):
+    """
+    Yields events until connection goes away, an empty comment is sent
+    when there is nothing to deliver to keep proxies from closing the stream.
+    Written frames can still get lost with a dropped stream, so last
+    SSE_RESUME_MESSAGES sent messages stay buffered for Last-Event-ID resume.
+    """
+    server_state = get_state(request.tenant_id)
+    buffer = connection.queue
+    buffer.acknowledge(cursor)
+    sent = cursor
+    while server_state.connections.get(connection.id) is connection:
+        buffer.wait(config["wake_connections_after"], sent)
+        messages, last = buffer.take(sent)
+        connection.mark_activity()
+        if messages:
+            event = "id: {}\ndata: {}\n\n".format(
+                utils.format_cursor(last), json.dumps(messages)
+            )
+        else:
+            event = ":\n\n"
+        if six.PY2:
+            yield event
+        else:
+            yield event.encode("utf8")
+        if messages:
+            buffer.acknowledge(last, keep=SSE_RESUME_MESSAGES)
+            sent = last
+
+
+def await_data(connection, config, cursor=None):
+    """
+    Waits for messages newer than cursor, returns as soon as there are some.
+    Without cursor messages are acknowledged right when they are returned.
+
+    :param connection:
+    :param config:
+    :param cursor: positions of last messages client received
+    :return: (messages, cursor after the last message)
+    """
+    buffer = connection.queue
+    buffer.acknowledge(cursor)
+    if buffer.wait(config["wake_connections_after"], cursor):
+        linger = config["long_poll_linger"]
+        if linger:
+            # let messages that are about to follow go out with this response
+            gevent.sleep(linger)
+    messages, last = buffer.take(cursor)
+    if cursor is None:
+        buffer.acknowledge(last)
+    return messages, last
 
 
 @view_config(route_name="legacy_user_state", request_method="POST", renderer="json")
@@ -361,7 +726,7 @@ def user_state(request):
         200:
           description: "Success"
     """
-    server_state = get_state()
+    server_state = get_state(request.tenant_id)
     schema = schemas.UserStateBodySchema(context={"request": request})
     data = schema.load(request.json_body).data
     user_inst = server_state.users[data["user"]]
@@ -371,6 +736,13 @@ def user_state(request):
     changed = operations.change_user_state(
         user_inst=user_inst, user_state=data["user_state"]
     )
+    bus.publish(
+        "user_state",
+        data["user"],
+        data["user_state"],
+        data["state_public_keys"],
+        request.tenant_id,
+    )
     return {
         "user_state": user_inst.state,
         "changed_state": changed,
@@ -379,12 +751,20 @@ def user_state(request):
 
 
 def shared_messages(request):
-    server_state = get_state()
+    server_state = get_state(request.tenant_id)
     schema = schemas.MessageBodySchema(context={"request": request}, many=True)
     data = schema.load(request.json_body).data
     data = [m for m in data if m.get("channel") or m.get("pm_users")]
-    for msg in data:
-        gevent.spawn(operations.pass_message, msg, server_state.stats)
+    server_state.consume_message_quota(len(data))
+    # whole request is delivered as one batch
+    gevent.spawn(operations.pass_messages, data, server_state.stats, request.tenant_id)
+    bus.publish("messages", data, request.tenant_id)
+    by_channel, by_user = operations.group_messages(data)
+    for channel_name, msgs in six.iteritems(by_channel):
+        cluster.relay("cluster_messages", request.tenant_id, channel_name, msgs)
+    pm_msgs = [msg for msg in data if not msg.get("channel")]
+    if pm_msgs:
+        cluster.relay("cluster_messages", request.tenant_id, None, pm_msgs)
     return list(data)
 
 
@@ -489,7 +869,9 @@ def messages_patch(request):
     schema = schemas.MessageEditBodySchema(context={"request": request}, many=True)
     data = schema.load(request.json_body).data
     for msg in data:
-        gevent.spawn(operations.edit_message, msg)
+        gevent.spawn(operations.edit_message, msg, request.tenant_id)
+        bus.publish("edit", msg, request.tenant_id)
+        cluster.relay("cluster_edit", request.tenant_id, msg.get("channel"), msg)
     return data
 
 
@@ -527,7 +909,9 @@ def messages_delete(request):
     schema = schemas.MessagesDeleteBodySchema(context={"request": request}, many=True)
     data = schema.load(request.json_body).data
     for msg in data:
-        gevent.spawn(operations.delete_message, msg)
+        gevent.spawn(operations.delete_message, msg, request.tenant_id)
+        bus.publish("delete", msg, request.tenant_id)
+        cluster.relay("cluster_delete", request.tenant_id, msg.get("channel"), msg)
     return data
 
 
@@ -588,7 +972,8 @@ def disconnect(request):
         json_body = request.json_body
         payload = {"conn_id": json_body.get("conn_id")}
     data = schema.load(payload).data
-    return operations.disconnect(conn_id=data["conn_id"])
+    bus.publish("disconnect", data["conn_id"], request.tenant_id)
+    return operations.disconnect(conn_id=data["conn_id"], tenant_id=request.tenant_id)
 
 
 @view_config(route_name="legacy_channel_config", request_method="POST", renderer="json")
@@ -628,7 +1013,10 @@ def channel_config(request):
     json_body = request.json_body
     for k in json_body.keys():
         deserialized[k] = schema.load(json_body[k]).data
-    operations.set_channel_config(channel_configs=deserialized)
+    operations.set_channel_config(
+        channel_configs=deserialized, tenant_id=request.tenant_id
+    )
+    bus.publish("channel_config", deserialized, request.tenant_id)
     channels_info = shared_utils.get_channel_info(
         deserialized.keys(), include_history=False, include_users=False
     )
@@ -658,16 +1046,22 @@ def info(request):
         description: "Request JSON body"
         schema:
           $ref: "#/definitions/ChannelInfoBody"
+      - in: "header"
+        name: "If-None-Match"
+        type: "string"
+        description: "ETag of previous response"
       responses:
+        304:
+          description: "Not Modified"
         422:
           description: "Unprocessable Entity"
         200:
           description: "Success"
     """
-    server_state = get_state()
+    server_state = get_state(request.tenant_id)
     shared_utils = SharedUtils(request)
     if not request.body:
-        req_channels = server_state.channels.keys()
+        req_channels = None
         info_config = {
             "include_history": True,
             "include_users": True,
@@ -683,8 +1077,37 @@ def info(request):
         info_config["include_connections"] = info_config.get(
             "include_connections", True
         )
-    channels_info = shared_utils.get_common_info(req_channels, info_config)
-    return channels_info
+    if_none_match = request.headers.get("If-None-Match")
+    etag, body = shared_utils.get_channel_info_json(
+        req_channels,
+        include_history=info_config.get("include_history", True),
+        include_users=info_config.get("include_users", True),
+        exclude_channels=info_config.get("exclude_channels", []),
+        return_public_state=info_config.get("return_public_state", False),
+        if_none_match=ETagMatcher.parse(if_none_match) if if_none_match else None,
+        prefix=info_config.get("prefix"),
+        cursor=info_config.get("cursor"),
+        limit=info_config.get("limit", 0),
+        stream=info_config.get("stream", False),
+    )
+    if body is None:
+        return HTTPNotModified(headers={"ETag": '"{}"'.format(etag)})
+    response = request.response
+    response.content_type = "application/json"
+    if etag is None:
+        response.app_iter = encode_chunks(body)
+    else:
+        response.etag = etag
+        response.text = body
+    return response
+
+
+def encode_chunks(chunks):
+    for chunk in chunks:
+        if six.PY2:
+            yield chunk
+        else:
+            yield chunk.encode("utf8")
 
 
 @view_defaults(route_name="action", renderer="json", permission="access")
@@ -754,7 +1177,8 @@ class ServerViews(object):
             200:
               description: "Success"
         """
-        server_state = get_state()
+        server_state = get_state(self.request.tenant_id)
+        tenant_log = storage.get_log(self.request.tenant_id)
         uptime = datetime.utcnow() - STATS["started_on"]
         uptime = str(uptime).split(".")[0]
         remembered_user_count = len(
@@ -765,6 +1189,16 @@ class ServerViews(object):
         ]
         unique_user_count = len(active_users)
         total_connections = sum([len(user.connections) for user in active_users])
+        slow_consumers = [
+            {
+                "id": conn.id,
+                "user": conn.username,
+                "queue_depth": len(conn.send_queue),
+                "dropped_frames": conn.dropped_frames,
+            }
+            for conn in six.itervalues(server_state.connections)
+            if conn.is_slow_consumer
+        ]
         channels_info = self.utils.get_common_info(
             None,
             {
@@ -781,11 +1215,49 @@ class ServerViews(object):
             "total_channels": len(server_state.channels.keys()),
             "total_messages": server_state.stats["total_messages"],
             "total_unique_messages": server_state.stats["total_unique_messages"],
+            "gc_conns_collected": server_state.stats["gc_conns_collected"],
+            "gc_conns_last_duration": server_state.stats["gc_conns_last_duration"],
+            "gc_conns_max_duration": server_state.stats["gc_conns_max_duration"],
+            "lock_wait": {
+                "registry": server_state.registry_lock.stats(),
+                "channels": server_state.channel_locks.stats(),
+            },
             "channels": channels_info["channels"],
             "users": [user.get_info(include_connections=True) for user in active_users],
+            "slow_consumers": slow_consumers,
+            "flush_latency": server_state.flush_latency.get_info(),
+            "worker": bus.worker_id(),
+            "log": tenant_log.get_info() if tenant_log else None,
+            "tenants": {
+                tenant_id: state.get_tenant_info()
+                for tenant_id, state in six.iteritems(STATES)
+            },
             "uptime": uptime,
         }
 
+    @view_config(route_name="metrics", request_method="GET", permission="access")
+    def metrics(self):
+        """
+        Server metrics in Prometheus text format
+        ---
+        get:
+          tags:
+          - "Legacy Admin API"
+          summary: "Return counters and histograms of every tenant in
+          Prometheus text exposition format"
+          description: ""
+          operationId: "metrics"
+          produces:
+          - "text/plain"
+          responses:
+            200:
+              description: "Success"
+        """
+        response = self.request.response
+        response.headers["Content-Type"] = metrics.CONTENT_TYPE
+        response.text = metrics.render()
+        return response
+
     @view_config(
         route_name="openapi_spec", permission=NO_PERMISSION_REQUIRED, renderer="json"
     )
@@ -851,6 +1323,7 @@ class ServerViews(object):
         # add_pyramid_paths(spec, "api_v1_messages", request=self.request)
 
         add_pyramid_paths(spec, "admin_json", request=self.request)
+        add_pyramid_paths(spec, "metrics", request=self.request)
         spec_dict = spec.to_dict()
         spec_dict["securityDefinitions"] = {
             "APIKeyHeader": {
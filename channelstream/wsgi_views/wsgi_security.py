@@ -3,6 +3,8 @@ import logging
 from itsdangerous import TimestampSigner
 from pyramid.security import Allow, Everyone, ALL_PERMISSIONS, authenticated_userid
 
+from channelstream.server_state import DEFAULT_TENANT
+
 log = logging.getLogger(__name__)
 
 
@@ -16,6 +18,28 @@ def is_allowed_ip(addr, config):
     return addr in config["allow_posting_from"]
 
 
+def request_tenant_id(request):
+    """
+    Tenant selected by request, used as reified `request.tenant_id`
+    :param request:
+    :return:
+    """
+    req_url_tenant = request.params.get("tenant", DEFAULT_TENANT)
+    return request.headers.get("x-channelstream-tenant", req_url_tenant)
+
+
+def tenant_secret(config, tenant_id):
+    """
+    Secret used to sign requests of a tenant, None for unknown tenants
+    :param config:
+    :param tenant_id:
+    :return:
+    """
+    if tenant_id == DEFAULT_TENANT:
+        return config["secret"]
+    return (config.get("tenants") or {}).get(tenant_id)
+
+
 class APIFactory(object):
     def __init__(self, request):
         self.__acl__ = []
@@ -28,9 +52,14 @@ class APIFactory(object):
             log.warning("IP: {} is not whitelisted".format(addr))
             return
 
+        secret = tenant_secret(config, request.tenant_id)
+        if secret is None:
+            log.warning("Tenant: {} is not configured".format(request.tenant_id))
+            return
+
         if req_secret:
             max_age = 60 if config["validate_requests"] else None
-            signer = TimestampSigner(config["secret"])
+            signer = TimestampSigner(secret)
             signer.unsign(req_secret, max_age=max_age)
         else:
             return
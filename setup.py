@@ -56,6 +56,7 @@ setup(
     extras_require={
         "dev": ["coverage", "pytest", "pyramid", "tox", "mock"],
         "lint": ["black"],
+        "orjson": ["orjson"],
     },
     entry_points={"console_scripts": ["channelstream = channelstream.cli:cli_start"]},
 )
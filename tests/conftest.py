@@ -2,12 +2,19 @@ from gevent import monkey
 
 monkey.patch_all()
 
+import collections
 import uuid
 import pytest
 import mock
 from datetime import datetime
 from pyramid import testing
-from channelstream.server_state import get_state
+from channelstream import cluster, storage
+from channelstream.locks import LockStripes, TimedRLock
+from channelstream.server_state import (
+    get_state,
+    MessageRate,
+    STATES,
+)
 
 
 @pytest.fixture
@@ -34,8 +41,36 @@ def cleanup_globals():
     server_state.stats = {
         "total_messages": 0,
         "total_unique_messages": 0,
+        "gc_conns_collected": 0,
+        "gc_conns_last_duration": 0.0,
+        "gc_conns_max_duration": 0.0,
+        "rejected_connections": 0,
+        "rejected_messages": 0,
+        "reconnect_storms": 0,
+        "deferred_catchups": 0,
+        "suppressed_presence": 0,
         "started_on": datetime.utcnow(),
     }
+    server_state.conn_deadlines = []
+    server_state.registry_lock = TimedRLock()
+    server_state.channel_locks = LockStripes()
+    server_state.max_connections = 0
+    server_state.max_messages_per_second = 0
+    server_state.message_rate = MessageRate()
+    server_state.saved_connections = {}
+    server_state.reset_histograms()
+    server_state.storm_reconnects_per_second = 0
+    server_state.storm_grace = 30
+    server_state.storm_catchup_rate = 200
+    server_state.reconnect_rate = MessageRate()
+    server_state.storm_until = 0
+    server_state.catchup_queue = collections.deque()
+    server_state.catchup_worker = None
+    for tenant_id in list(STATES):
+        if tenant_id != "0":
+            del STATES[tenant_id]
+    cluster.NODE = None
+    storage.LOGS.clear()
 
 
 @pytest.fixture
@@ -51,4 +86,5 @@ def pyramid_config():
 def dummy_request():
     app_request = testing.DummyRequest()
     app_request.handle_cors = mock.Mock()
+    app_request.tenant_id = "0"
     return app_request
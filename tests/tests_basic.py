@@ -2,14 +2,48 @@ from gevent import monkey
 
 monkey.patch_all()
 
+import collections
+import gevent
+import hashlib
+import hmac
+import marshmallow
+import os
 import pytest
+import time
+import uuid
 from datetime import datetime, timedelta
 from gevent.queue import Queue
-from channelstream.server_state import get_state
+from six.moves import cPickle as pickle
+from channelstream import patched_json as json
+from channelstream.server_state import get_state, MessageRate
 import channelstream.gc
+from channelstream import bus, cluster, metrics, snapshot, storage, storm
+import channelstream.operations
+from channelstream.heartbeat import HeartbeatWheel, WHEEL
 from channelstream.channel import Channel
-from channelstream.connection import Connection
-from channelstream.user import User
+from channelstream.connection import Connection, PollBuffer
+from channelstream.envelope import Envelope
+from channelstream.locks import LockStripes, TimedRLock
+from channelstream.user import User, UserRegistry
+from channelstream.utils import (
+    first_frame_after_seq,
+    first_newer_frame,
+    frames_after_seq,
+    Histogram,
+    merge_frames,
+    parse_resume,
+    RingBuffer,
+)
+
+
+class DummySocket(object):
+    terminated = False
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, payload):
+        self.sent.append(payload)
 
 
 @pytest.mark.usefixtures("cleanup_globals", "test_uuids")
@@ -24,7 +58,7 @@ class TestChannel(object):
         assert channel.salvageable is False
         assert channel.store_history is False
         assert channel.history_size == 10
-        assert channel.history == []
+        assert list(channel.history) == []
 
     def test_repr(self):
         channel = Channel("test", long_name="long name")
@@ -137,6 +171,125 @@ class TestChannel(object):
             {"state": {}, "user": "test_user2"},
         ]
 
+    def _presence_connection(self, username, conn_id):
+        user = User(username)
+        user.state_from_dict({"key": username})
+        user.state_public_keys = ["key"]
+        get_state().users[username] = user
+        connection = Connection(username, conn_id=conn_id)
+        connection.attach_queue(Queue())
+        user.add_connection(connection)
+        return connection
+
+    def test_presence_deltas(self, test_uuids):
+        config = {
+            "notify_presence": True,
+            "presence_deltas": True,
+            "presence_window_ms": 0,
+        }
+        channel = Channel("test", channel_config=config)
+        connection = self._presence_connection("test_user", test_uuids[1])
+        channel.add_connection(connection)
+        snapshot = connection.queue.get_nowait()
+        assert snapshot[0]["message"] == {"action": "snapshot"}
+        assert snapshot[0]["users"] == [
+            {"user": "test_user", "state": {"key": "test_user"}}
+        ]
+        # joining user does not get own delta
+        assert connection.queue.empty()
+        connection2 = self._presence_connection("test_user2", test_uuids[2])
+        channel.add_connection(connection2)
+        delta = connection.queue.get_nowait()[0]
+        assert delta["message"] == {
+            "action": "delta",
+            "joined": [{"user": "test_user2", "state": {"key": "test_user2"}}],
+            "parted": [],
+        }
+        assert delta["users"] == []
+        assert len(connection2.queue.get_nowait()[0]["users"]) == 2
+        channel.remove_connection(connection2)
+        delta = connection.queue.get_nowait()[0]
+        assert delta["message"]["joined"] == []
+        assert delta["message"]["parted"] == ["test_user2"]
+
+    def test_presence_deltas_coalesced(self, test_uuids):
+        config = {
+            "notify_presence": True,
+            "presence_deltas": True,
+            "presence_window_ms": 20,
+        }
+        channel = Channel("test", channel_config=config)
+        connection = self._presence_connection("test_user", test_uuids[1])
+        channel.add_connection(connection)
+        gevent.sleep(0.03)
+        assert connection.queue.get_nowait()[0]["message"]["action"] == "snapshot"
+        connections = [
+            self._presence_connection("user_{}".format(i), uuid.uuid4())
+            for i in range(3)
+        ]
+        for c in connections:
+            channel.add_connection(c)
+        # joins and parts within a window cancel out
+        channel.remove_connection(connections[2])
+        assert connection.queue.empty()
+        gevent.sleep(0.03)
+        messages = connection.queue.get_nowait()
+        assert len(messages) == 1
+        assert messages[0]["message"]["joined"] == [
+            {"user": "user_0", "state": {"key": "user_0"}},
+            {"user": "user_1", "state": {"key": "user_1"}},
+        ]
+        assert messages[0]["message"]["parted"] == []
+        assert connection.queue.empty()
+        users = connections[0].queue.get_nowait()[0]["users"]
+        assert sorted(u["user"] for u in users) == ["test_user", "user_0", "user_1"]
+        assert connections[2].queue.empty()
+
+    def test_presence_deltas_periodic_snapshot(self, test_uuids):
+        config = {
+            "notify_presence": True,
+            "presence_deltas": True,
+            "presence_window_ms": 0,
+            "presence_snapshot_interval": 60,
+        }
+        channel = Channel("test", channel_config=config)
+        connection = self._presence_connection("test_user", test_uuids[1])
+        channel.add_connection(connection)
+        connection.queue.get_nowait()
+        channel.add_connection(self._presence_connection("test_user2", test_uuids[2]))
+        assert connection.queue.get_nowait()[0]["users"] == []
+        channel.presence_snapshot_at -= 60
+        channel.add_connection(self._presence_connection("test_user3", test_uuids[3]))
+        delta = connection.queue.get_nowait()[0]
+        assert delta["message"]["action"] == "delta"
+        assert len(delta["users"]) == 3
+
+    def test_info_cached_per_version(self, test_uuids):
+        server_state = get_state()
+        user = User("test_user")
+        server_state.users[user.username] = user
+        channel = Channel("test", channel_config={"store_history": True})
+        channel.add_connection(Connection("test_user", conn_id=test_uuids[1]))
+        info = channel.get_info(include_users=True)
+        assert info["users"] == ["test_user"]
+        assert channel.get_info(include_users=True)["users"] is info["users"]
+        assert json.loads(channel.get_info_json(include_users=True)) == json.loads(
+            json.dumps(info)
+        )
+        version = channel.info_version
+        channel.add_message(log_message("hello"))
+        assert channel.info_version > version
+        info = channel.get_info(include_users=True)
+        assert [m["message"] for m in info["history"]] == ["hello"]
+        encoded = json.loads(channel.get_info_json(include_users=True))
+        assert encoded["last_active"] == channel.last_active.isoformat()
+        assert [m["message"] for m in encoded["history"]] == ["hello"]
+        # activity alone does not invalidate cached info
+        version = channel.info_version
+        channel.mark_activity()
+        assert channel.info_version == version
+        assert channel.get_info()["last_active"] == channel.last_active
+
     def test_history(self):
         config = {"store_history": True, "history_size": 3}
         channel = Channel("test", long_name="long name", channel_config=config)
@@ -192,7 +345,7 @@ class TestChannel(object):
         )
 
         assert len(channel.history) == 3
-        assert channel.history == [
+        assert list(channel.history) == [
             {
                 "channel": "test",
                 "message": "test2",
@@ -219,6 +372,120 @@ class TestChannel(object):
             },
         ]
 
+    def test_add_message_encodes_once(self, test_uuids):
+        server_state = get_state()
+        channel = Channel("test")
+        sockets = []
+        for i, username in enumerate(["test_user", "test_user2"]):
+            server_state.users[username] = User(username)
+            connection = Connection(username, conn_id=test_uuids[i])
+            connection.attach_socket(DummySocket())
+            sockets.append(connection.socket)
+            channel.add_connection(connection)
+        sent = channel.add_message(
+            {
+                "channel": "test",
+                "message": "test1",
+                "type": "message",
+                "no_history": False,
+                "pm_users": [],
+                "exclude_users": [],
+            }
+        )
+        assert sent == 2
+        gevent.sleep(0)
+        assert sockets[0].sent[0] is sockets[1].sent[0]
+        assert json.loads(sockets[0].sent[0]) == [
+            {"channel": "test", "message": "test1", "type": "message", "seq": 1}
+        ]
+
+    def test_add_messages_one_frame_per_connection(self, test_uuids):
+        server_state = get_state()
+        channel = Channel("test")
+        sockets = {}
+        for i, username in enumerate(["alice", "bob", "carol"]):
+            server_state.users[username] = User(username)
+            connection = Connection(username, conn_id=test_uuids[i])
+            connection.attach_socket(DummySocket())
+            sockets[username] = connection.socket
+            channel.add_connection(connection)
+        sent = channel.add_messages(
+            [
+                log_message("test1"),
+                log_message("test2", pm_users=["alice"]),
+                log_message("test3", exclude_users=["bob"]),
+            ]
+        )
+        assert sent == 6
+        gevent.sleep(0)
+        assert all(len(socket.sent) == 1 for socket in sockets.values())
+        received = {
+            username: [m["message"] for m in json.loads(socket.sent[0])]
+            for username, socket in sockets.items()
+        }
+        assert received == {
+            "alice": ["test1", "test2", "test3"],
+            "bob": ["test1"],
+            "carol": ["test1", "test3"],
+        }
+
+    def test_frames_after_seq(self):
+        channel = Channel("test")
+        for i in range(5):
+            channel.add_message(log_message("test{}".format(i)))
+        channel.add_message(log_message("pm", pm_users=["test_user2"]))
+        assert channel.seq == 6
+        found = channel.get_frames_after_seq(3, "test_user")
+        assert [(m["seq"], m["message"]) for m in found] == [
+            (4, "test3"),
+            (5, "test4"),
+        ]
+        assert all(m["catchup"] for m in found)
+        assert channel.get_frames_after_seq(6, "test_user") == []
+        # channel was recreated since client got its sequence number
+        assert len(channel.get_frames_after_seq(100, "test_user")) == 5
+
+    def test_resume_catchup(self, test_uuids):
+        server_state = get_state()
+        user = User("test")
+        server_state.users[user.username] = user
+        connection = Connection("test", test_uuids[1])
+        user.add_connection(connection)
+        for name in ["a", "b"]:
+            channel = Channel(name)
+            server_state.channels[name] = channel
+            channel.add_connection(connection)
+            for i in range(3):
+                channel.add_message(log_message("{}{}".format(name, i)))
+        user.add_message(log_message("pm1", channel=None))
+        user.add_message(log_message("pm2", channel=None))
+        # heartbeat moved last activity past every frame
+        connection.mark_activity()
+        assert connection.get_catchup_messages() == []
+        messages = connection.get_catchup_messages(resume={"a": 1}, resume_user=1)
+        assert [m["message"] for m in messages] == ["a1", "a2", "pm2"]
+
+    def test_resize_history(self):
+        config = {"store_history": True, "history_size": 3, "frames_size": 2}
+        channel = Channel("test", channel_config=config)
+        for i in range(5):
+            channel.add_message(
+                {
+                    "channel": "test",
+                    "message": "test{}".format(i),
+                    "type": "message",
+                    "no_history": False,
+                    "pm_users": [],
+                    "exclude_users": [],
+                }
+            )
+        assert [m["message"] for m in channel.history] == ["test2", "test3", "test4"]
+        assert [f[1]["message"] for f in channel.frames] == ["test3", "test4"]
+        channel.reconfigure_from_dict({"history_size": 2})
+        assert channel.history_size == 2
+        assert [m["message"] for m in channel.history] == ["test3", "test4"]
+        assert channel.get_info()["history"] == list(channel.history)
+
     def test_user_state(self, test_uuids):
         user = User("test_user")
         changed = user.state_from_dict({"key": "1", "key2": "2"})
@@ -286,6 +553,144 @@ class TestConnection(object):
         connection.add_message({"message": "test"})
         assert connection.queue.get() == [{"message": "test"}]
 
+    def test_channels_index(self, test_uuids):
+        server_state = get_state()
+        connection = Connection("test", test_uuids[1])
+        server_state.connections[connection.id] = connection
+        for name in ["b", "a", "c"]:
+            server_state.channels[name] = Channel(name)
+            server_state.channels[name].add_connection(connection)
+        assert connection.channels == ["a", "b", "c"]
+        server_state.channels["b"].remove_connection(connection)
+        assert connection.channels == ["a", "c"]
+        connection.mark_for_gc()
+        channelstream.gc.gc_conns()
+        assert connection.channels == []
+
+    def test_writer(self, test_uuids):
+        server_state = get_state()
+        server_state.users["test"] = User("test")
+        connection = Connection("test", test_uuids[1])
+        connection.attach_socket(DummySocket())
+        connection.add_message({"message": "test"})
+        connection.add_message({"message": "test2"})
+        assert len(connection.send_queue) == 2
+        gevent.sleep(0)
+        assert connection.send_queue == collections.deque()
+        assert [json.loads(f) for f in connection.socket.sent] == [
+            [{"message": "test"}],
+            [{"message": "test2"}],
+        ]
+
+    @pytest.mark.parametrize(
+        "policy, expected", [("drop_oldest", ["2", "3"]), ("drop_newest", ["1", "2"])],
+    )
+    def test_send_queue_overflow(self, test_uuids, policy, expected):
+        connection = Connection("test", test_uuids[1])
+        connection.max_send_queue = 2
+        # no writer attached so frames stay queued
+        connection.socket = DummySocket()
+        for frame in ["1", "2", "3"]:
+            connection.add_message(encoded=frame, overflow_policy=policy)
+        assert list(connection.send_queue) == expected
+        assert connection.dropped_frames == 1
+        assert connection.is_slow_consumer
+
+    def test_send_queue_overflow_disconnect(self, test_uuids):
+        connection = Connection("test", test_uuids[1])
+        connection.max_send_queue = 2
+        connection.socket = DummySocket()
+        for frame in ["1", "2", "3"]:
+            connection.add_message(encoded=frame, overflow_policy="disconnect")
+        assert len(connection.send_queue) == 0
+        assert connection.last_active < datetime.utcnow() - timedelta(days=50)
+
+    def test_coalesced_frames(self, test_uuids):
+        connection = Connection("test", test_uuids[1], coalesce_ms=20)
+        connection.attach_socket(DummySocket())
+        connection.add_message({"message": "test"})
+        connection.add_message({"message": "test2"})
+        gevent.sleep(0.005)
+        assert connection.socket.sent == []
+        gevent.sleep(0.03)
+        assert [json.loads(f) for f in connection.socket.sent] == [
+            [{"message": "test"}, {"message": "test2"}]
+        ]
+        flush_latency = get_state().flush_latency
+        assert flush_latency.count == 1
+        assert 0.02 <= flush_latency.sum < 0.1
+
+    def test_coalesced_frames_message_limit(self, test_uuids):
+        connection = Connection("test", test_uuids[1])
+        connection.attach_socket(DummySocket())
+        for i in range(5):
+            connection.add_message(
+                {"message": i}, coalesce_ms=1000, coalesce_messages=3
+            )
+            # writer gets to run between messages
+            gevent.sleep(0)
+        assert [json.loads(f) for f in connection.socket.sent] == [
+            [{"message": 0}, {"message": 1}, {"message": 2}]
+        ]
+        # message without coalescing flushes the open window with it
+        connection.add_message({"message": 5})
+        gevent.sleep(0)
+        assert json.loads(connection.socket.sent[1]) == [
+            {"message": 3},
+            {"message": 4},
+            {"message": 5},
+        ]
+
+    def test_channel_coalescing(self, test_uuids):
+        channel = Channel("test", channel_config={"coalesce_ms": 10})
+        connection = Connection("test", test_uuids[1])
+        connection.attach_socket(DummySocket())
+        channel.add_connection(connection)
+        for i in range(3):
+            channel.add_message(log_message("test{}".format(i)))
+        gevent.sleep(0.02)
+        assert len(connection.socket.sent) == 1
+        assert [m["message"] for m in json.loads(connection.socket.sent[0])] == [
+            "test0",
+            "test1",
+            "test2",
+        ]
+
+    def test_catchup_batched(self, test_uuids):
+        server_state = get_state()
+        user = User("test")
+        server_state.users[user.username] = user
+        connection = Connection("test", test_uuids[1])
+        user.add_connection(connection)
+        channel = Channel("test")
+        server_state.channels[channel.name] = channel
+        channel.add_connection(connection)
+        connection.last_active = datetime.utcnow()
+        for i in range(3):
+            channel.add_message(
+                {
+                    "channel": "test",
+                    "message": "test{}".format(i),
+                    "type": "message",
+                    "no_history": False,
+                    "pm_users": [],
+                    "exclude_users": ["test"] if i == 1 else [],
+                }
+            )
+        user.add_message({"type": "message", "message": "pm", "pm_users": ["test"]})
+        first = connection.get_catchup_messages()
+        # prepared catchup frames are reused between connections
+        assert [id(m) for m in first] == [
+            id(m) for m in connection.get_catchup_messages()
+        ]
+        connection.queue = Queue()
+        connection.deliver_catchup_messages()
+        frame = connection.queue.get_nowait()
+        assert [m["message"] for m in frame] == ["test0", "test2", "pm"]
+        assert all(m["catchup"] for m in frame)
+        assert "pm_users" not in frame[2]
+        assert connection.queue.empty()
+
     def test_heartbeat(self, test_uuids):
         connection = Connection("test", test_uuids[1])
         connection.queue = Queue()
@@ -293,6 +698,59 @@ class TestConnection(object):
         assert connection.queue.get() == []
 
 
+class TestPollBuffer(object):
+    def test_cursor(self):
+        buffer = PollBuffer()
+        buffer.put(
+            [{"channel": "a", "seq": 1}, {"seq": 1}, {"channel": "b", "seq": 4}]
+        )
+        assert buffer.take({}) == (
+            [{"channel": "a", "seq": 1}, {"seq": 1}, {"channel": "b", "seq": 4}],
+            {"a": 1, None: 1, "b": 4},
+        )
+        buffer.put([{"channel": "a", "seq": 2}])
+        buffer.acknowledge({"a": 1, "b": 4})
+        assert buffer.take({"a": 1, "b": 4}) == (
+            [{"seq": 1}, {"channel": "a", "seq": 2}],
+            {"a": 2, None: 1, "b": 4},
+        )
+        buffer.acknowledge({"a": 2, None: 1})
+        assert buffer.take({"a": 2, None: 1}) == ([], {"a": 2, None: 1})
+        assert list(buffer.messages) == []
+
+    def test_acknowledge_keeps_newest(self):
+        buffer = PollBuffer()
+        buffer.put([{"channel": "a", "seq": seq} for seq in range(1, 5)])
+        buffer.acknowledge({"a": 3}, keep=2)
+        assert [seq for _, seq, _ in buffer.messages] == [2, 3, 4]
+
+    def test_overflow(self):
+        buffer = PollBuffer(maxlen=2)
+        buffer.put([{"channel": "a", "seq": seq} for seq in range(1, 4)])
+        assert buffer.take({}) == (
+            [{"channel": "a", "seq": 2}, {"channel": "a", "seq": 3}],
+            {"a": 3},
+        )
+        assert buffer.dropped == 1
+
+    def test_hold(self):
+        buffer = PollBuffer()
+        buffer.hold()
+        buffer.put([{"channel": "a", "seq": 3}])
+        assert buffer.take({}) == ([], {})
+        buffer.release([{"channel": "a", "seq": 2, "catchup": True}])
+        assert buffer.take({}) == (
+            [{"channel": "a", "seq": 2, "catchup": True}, {"channel": "a", "seq": 3}],
+            {"a": 3},
+        )
+
+    def test_wait(self):
+        buffer = PollBuffer()
+        assert buffer.wait(0.01) is False
+        gevent.spawn_later(0.01, buffer.put, [{"channel": "a", "seq": 1}])
+        assert buffer.wait(5) is True
+
+
 class TestUser(object):
     def test_create_defaults(self):
         user = User("test_user")
@@ -322,6 +780,38 @@ class TestUser(object):
         assert len(user.connections[0].queue.get()) == 1
         assert len(user.connections[1].queue.get()) == 1
 
+    def test_add_messages(self, test_uuids):
+        user = User("test_user")
+        connection = Connection("test_user", conn_id=test_uuids[1])
+        connection.queue = Queue()
+        user.add_connection(connection)
+        sent = user.add_messages([log_message("test1"), log_message("test2")])
+        assert sent == 2
+        assert [m["message"] for m in connection.queue.get()] == ["test1", "test2"]
+        assert connection.queue.empty()
+
+    def test_pass_messages_groups_by_channel(self, test_uuids):
+        server_state = get_state()
+        stats = collections.Counter()
+        channel = Channel("test")
+        server_state.channels["test"] = channel
+        server_state.users["alice"] = User("alice")
+        connection = Connection("alice", conn_id=test_uuids[1])
+        connection.queue = Queue()
+        server_state.users["alice"].add_connection(connection)
+        channel.add_connection(connection)
+        messages = [
+            log_message("test1"),
+            log_message("test2", channel="other"),
+            log_message("test3"),
+            log_message("test4", channel=None, pm_users=["alice"]),
+        ]
+        channelstream.operations.pass_messages(messages, stats)
+        assert [m["message"] for m in connection.queue.get()] == ["test1", "test3"]
+        assert [m["message"] for m in connection.queue.get()] == ["test4"]
+        assert stats["total_unique_messages"] == 4
+        assert stats["total_messages"] == 3
+
 
 @pytest.mark.usefixtures("cleanup_globals")
 class TestGC(object):
@@ -408,6 +898,38 @@ class TestGC(object):
         assert len(server_state.channels["test"].connections.items()) == 0
         assert len(server_state.channels["test2"].connections.items()) == 0
 
+    def test_gc_connections_deadlines(self, test_uuids):
+        server_state = get_state()
+        connection = Connection("test_user", test_uuids[1])
+        server_state.connections[connection.id] = connection
+        connection2 = Connection("test_user", test_uuids[2])
+        server_state.connections[connection2.id] = connection2
+        assert len(server_state.conn_deadlines) == 2
+        assert channelstream.gc.gc_conns() == []
+        # nothing expired yet so heap stays intact
+        assert len(server_state.conn_deadlines) == 2
+        connection.mark_for_gc()
+        connection.mark_for_gc()
+        assert len(server_state.conn_deadlines) == 3
+        assert channelstream.gc.gc_conns() == [connection]
+        assert list(server_state.connections.keys()) == [connection2.id]
+        assert server_state.stats["gc_conns_collected"] == 1
+        # collected connections are not scheduled again
+        connection.mark_for_gc()
+        assert len(server_state.conn_deadlines) == 2
+
+    def test_gc_connections_rescheduled(self, test_uuids):
+        server_state = get_state()
+        connection = Connection("test_user", test_uuids[1])
+        server_state.connections[connection.id] = connection
+        # pretend deadline passed but connection was active meanwhile
+        channelstream.gc.schedule_conn_gc(
+            connection, datetime.utcnow() - timedelta(seconds=1)
+        )
+        assert channelstream.gc.gc_conns() == []
+        assert connection.gc_deadline > datetime.utcnow()
+        assert connection.id in server_state.connections
+
     def test_users_active(self):
         server_state = get_state()
         user = User("test_user")
@@ -419,3 +941,901 @@ class TestGC(object):
         user.last_active -= timedelta(days=2)
         channelstream.gc.gc_users()
         assert len(server_state.users.items()) == 1
+
+
+class TestHistogram(object):
+    def test_observe(self):
+        histogram = Histogram((0.01, 0.1, 1))
+        for value in (0.005, 0.01, 0.05, 2):
+            histogram.observe(value)
+        info = histogram.get_info()
+        assert info["buckets"] == [[0.01, 2], [0.1, 3], [1, 3]]
+        assert info["count"] == 4
+        assert info["sum"] == pytest.approx(2.065)
+
+    def test_merge_frames(self):
+        frames = [json.dumps([{"a": 1}]), "[]", json.dumps([{"b": [2]}, "c"])]
+        assert json.loads(merge_frames(frames)) == [{"a": 1}, {"b": [2]}, "c"]
+
+
+class TestJSON(object):
+    def test_compact_dumps(self, test_uuids):
+        payload = [{"uuid": test_uuids[0], "timestamp": datetime(2018, 1, 1)}]
+        assert json.dumps(payload) == (
+            '[{"uuid":"12345678-1234-5678-1234-567812345678",'
+            '"timestamp":"2018-01-01T00:00:00"}]'
+        )
+
+    def test_pretty_dumps(self):
+        assert json.dumps_pretty({"a": 1}) == '{\n    "a": 1\n}'
+
+    def test_unknown_backend(self):
+        with pytest.raises(ValueError):
+            json.set_backend("foo")
+
+    @pytest.mark.skipif(json.orjson_dumps is None, reason="orjson not installed")
+    def test_orjson_parity(self, test_uuids):
+        payload = [
+            {
+                "uuid": test_uuids[0],
+                "timestamp": datetime(2018, 1, 1, 1, 1, 1, 5),
+                "set": {1},
+                1: 2 ** 70,
+            }
+        ]
+        try:
+            assert json.set_backend("orjson") == "orjson"
+            assert json.dumps(payload) == json.json_dumps(payload)
+        finally:
+            json.set_backend("json")
+
+
+class TestHeartbeatWheel(object):
+    def test_spread_over_slots(self, test_uuids):
+        wheel = HeartbeatWheel(interval=5, slots=10)
+        connections = []
+        for conn_id in test_uuids:
+            connection = Connection("test", conn_id)
+            connection.queue = Queue()
+            connections.append(connection)
+            wheel.add(connection)
+            wheel.add(connection)
+        assert len(wheel) == len(test_uuids)
+        assert wheel.tick_interval == 0.5
+        beats = sum(wheel.tick() for _ in range(10))
+        assert beats == len(test_uuids)
+        for connection in connections:
+            assert connection.queue.get_nowait() == []
+
+    def test_remove(self, test_uuids):
+        wheel = HeartbeatWheel(interval=5, slots=10)
+        connection = Connection("test", test_uuids[1])
+        connection.queue = Queue()
+        wheel.add(connection)
+        wheel.remove(connection)
+        wheel.remove(connection)
+        assert len(wheel) == 0
+        assert sum(wheel.tick() for _ in range(10)) == 0
+        assert connection.queue.empty()
+
+    @pytest.mark.usefixtures("cleanup_globals")
+    def test_collected_connection_removed(self, test_uuids):
+        server_state = get_state()
+        connection = Connection("test", test_uuids[1])
+        server_state.connections[connection.id] = connection
+        assert connection in WHEEL.positions
+        connection.mark_for_gc()
+        channelstream.gc.gc_conns()
+        assert connection not in WHEEL.positions
+
+
+class TestRingBuffer(object):
+    def test_capacity(self):
+        buf = RingBuffer(maxlen=2)
+        for i in range(4):
+            buf.append(i)
+        assert list(buf) == [2, 3]
+        assert list(buf.resized(1)) == [3]
+        assert buf.resized(5).maxlen == 5
+
+    def test_first_newer_frame(self):
+        now = datetime.utcnow()
+        frames = RingBuffer(maxlen=10)
+        for i in range(10):
+            frames.append((now + timedelta(seconds=i), i))
+        assert first_newer_frame(frames, now - timedelta(seconds=1)) == 0
+        assert first_newer_frame(frames, now) == 1
+        assert first_newer_frame(frames, now + timedelta(seconds=4.5)) == 5
+        assert first_newer_frame(frames, now + timedelta(seconds=9)) == 10
+        assert first_newer_frame(RingBuffer(), now) == 0
+
+    def test_first_frame_after_seq(self):
+        frames = RingBuffer(maxlen=5)
+        for i in range(1, 9):
+            frames.append((None, i, Envelope({}, seq=i)))
+        assert first_frame_after_seq(frames, 0) == 0
+        assert first_frame_after_seq(frames, 5) == 2
+        assert first_frame_after_seq(frames, 8) == 5
+        assert [f[1] for f in frames_after_seq(frames, 6)] == [7, 8]
+
+    def test_frames_after_seq_of_deque(self):
+        frames = RingBuffer(maxlen=1000)
+        for i in range(1, 1001):
+            frames.append((None, i, Envelope({}, seq=i)))
+        assert [f[1] for f in frames_after_seq(frames, 997)] == [998, 999, 1000]
+        assert frames_after_seq(frames, 1000) == []
+
+    def test_frames_size_limited(self):
+        from channelstream.validation.schemas import ChannelConfigSchema
+
+        with pytest.raises(marshmallow.exceptions.ValidationError) as excinfo:
+            ChannelConfigSchema().load({"frames_size": 10001})
+        assert "frames_size" in excinfo.value.messages
+        assert ChannelConfigSchema().load({"frames_size": 10000}).data["frames_size"]
+
+    def test_parse_resume(self):
+        assert parse_resume("a:1,b:c:20,bad,d:x,") == {"a": 1, "b:c": 20}
+        assert parse_resume(None) == {}
+
+
+class TestEnvelope(object):
+    def test_delivery_metadata_stripped(self):
+        envelope = Envelope(
+            {"message": "x", "no_history": True, "pm_users": ["a", "b"]},
+            exclude_users=["b"],
+        )
+        assert envelope.payload == {"message": "x"}
+        assert envelope.delivers_to("a") is True
+        assert envelope.delivers_to("b") is False
+        assert envelope.delivers_to("c") is False
+        assert json.loads(envelope.encode()) == [{"message": "x"}]
+
+    def test_catchup_payload_shared(self):
+        envelope = Envelope({"message": "x", "catchup": False})
+        assert envelope.catchup_payload == {"message": "x", "catchup": True}
+        assert envelope.catchup_payload is envelope.catchup_payload
+        assert envelope.payload["catchup"] is False
+
+
+class TestLocks(object):
+    def test_wait_time_recorded(self):
+        lock = TimedRLock()
+
+        def hold():
+            with lock:
+                gevent.sleep(0.05)
+
+        holder = gevent.spawn(hold)
+        gevent.sleep(0)
+        with lock:
+            # reentrant for the same greenlet
+            with lock:
+                pass
+        holder.join()
+        stats = lock.stats()
+        assert stats["acquired"] == 3
+        assert stats["contended"] == 1
+        assert stats["wait_max"] >= 0.04
+        assert stats["wait_total"] == stats["wait_max"]
+
+    def test_stripes(self):
+        stripes = LockStripes(4)
+        assert stripes.for_name("chan") is stripes.for_name("chan")
+        with stripes.for_name("a"):
+            with stripes.for_name("b"):
+                pass
+        assert stripes.stats()["acquired"] == 2
+        assert stripes.stats()["contended"] == 0
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestChannelLocking(object):
+    def test_gc_does_not_block_other_channels(self, test_uuids):
+        server_state = get_state()
+        connection, user = channelstream.operations.connect(
+            username="test", conn_id=test_uuids[1], channels=["a"], channel_configs={},
+        )
+        entered = []
+
+        def subscribe():
+            channelstream.operations.subscribe(
+                connection=connection, channels=["b"], channel_configs={}
+            )
+            entered.append(True)
+
+        # registry lock is only needed to pick expired connections
+        with server_state.registry_lock:
+            gevent.spawn(subscribe).join()
+        assert entered == [True]
+        assert connection.channels == ["a", "b"]
+
+    def test_user_state_waits_for_channel_lock(self, test_uuids):
+        server_state = get_state()
+        connection, user = channelstream.operations.connect(
+            username="test",
+            conn_id=test_uuids[1],
+            channels=["a"],
+            channel_configs={"a": {"notify_state": True}},
+        )
+        connection.attach_queue(Queue())
+        with server_state.channel_lock("a"):
+            changing = gevent.spawn(
+                channelstream.operations.change_user_state,
+                user_inst=user,
+                user_state={"color": "red"},
+            )
+            gevent.sleep(0.01)
+            assert connection.queue.empty()
+        changing.join()
+        message = connection.queue.get_nowait()[0]
+        assert message["type"] == "user_state_change"
+
+
+class TestMessageRate(object):
+    def test_windows(self):
+        rate = MessageRate()
+        assert rate.add(2, limit=3, now=100.1) is True
+        assert rate.add(2, limit=3, now=100.5) is False
+        assert rate.add(1, limit=3, now=100.9) is True
+        assert rate.per_second(now=101.2) == 3
+        assert rate.add(5, now=101.3) is True
+        # a gap resets throughput
+        assert rate.per_second(now=105) == 0
+
+
+class TestBus(object):
+    def test_publish_to_peer(self):
+        received = []
+        bus.register("test_op", lambda *args, **kwargs: received.append((args, kwargs)))
+        mesh = bus.make_mesh(2)
+        buses = [bus.WorkerBus(i, peers) for i, peers in enumerate(mesh)]
+        for worker_bus in buses:
+            worker_bus.start()
+        buses[0].publish("test_op", (1, "a"), {"tenant_id": "0"})
+        buses[0].publish("test_op", ({"x": datetime(2020, 1, 1)},), {})
+        gevent.sleep(0.1)
+        assert received == [
+            ((1, "a"), {"tenant_id": "0"}),
+            (({"x": datetime(2020, 1, 1)},), {}),
+        ]
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestReplication(object):
+    def test_remote_connection_not_collected(self, test_uuids):
+        server_state = get_state()
+        connection, user = channelstream.operations.connect(
+            username="test", conn_id=test_uuids[1], channels=["a"], channel_configs={}
+        )
+        channelstream.operations.attached_remotely(test_uuids[1])
+        connection.last_active -= timedelta(minutes=5)
+        channelstream.gc.schedule_conn_gc(connection)
+        assert channelstream.gc.gc_conns() == []
+        assert test_uuids[1] in server_state.connections
+        # worker holding the socket collected it
+        channelstream.gc.collect_remote(test_uuids[1])
+        assert test_uuids[1] not in server_state.connections
+        assert server_state.channels["a"].connections == {}
+
+    def test_fanout_to_locally_attached(self, test_uuids):
+        server_state = get_state()
+        local, _ = channelstream.operations.connect(
+            username="test", conn_id=test_uuids[1], channels=["a"], channel_configs={}
+        )
+        remote, _ = channelstream.operations.connect(
+            username="test2", conn_id=test_uuids[2], channels=["a"], channel_configs={}
+        )
+        channelstream.operations.connect(
+            username="test3", conn_id=test_uuids[3], channels=["a"], channel_configs={}
+        )
+        channel = server_state.channels["a"]
+        assert channel.attached == {}
+        local.attach_socket(DummySocket())
+        remote.attach_poll_buffer()
+        assert channel.attached == {"test": [local], "test2": [remote]}
+        channelstream.operations.attached_remotely(test_uuids[2])
+        assert channel.attached == {"test": [local]}
+        message = {
+            "type": "message",
+            "user": "system",
+            "channel": "a",
+            "message": {"text": "test"},
+            "no_history": True,
+            "pm_users": [],
+            "exclude_users": [],
+        }
+        assert channel.add_message(message) == 1
+        # websocket that moved away isn't written to by user messages either
+        remote.socket = DummySocket()
+        assert server_state.users["test2"].add_message(dict(message)) == 0
+        assert list(remote.send_queue) == []
+        remote.socket = None
+        remote.attach_poll_buffer()
+        assert channel.attached == {"test": [local], "test2": [remote]}
+        channelstream.operations.unsubscribe(local, ["a"])
+        assert channel.attached == {"test2": [remote]}
+
+    def test_replicated_connect_skips_quota(self, test_uuids):
+        server_state = get_state()
+        server_state.max_connections = 1
+        bus.HANDLERS["connect"](
+            username="a", conn_id=test_uuids[1], channels=[], channel_configs={}
+        )
+        bus.HANDLERS["connect"](
+            username="b", conn_id=test_uuids[2], channels=[], channel_configs={}
+        )
+        assert len(server_state.connections) == 2
+
+
+class TestInterestTable(object):
+    def test_members_aggregated_over_nodes(self):
+        table = cluster.InterestTable()
+        table.set_member("n1", "0", "a", "alice", 2, {"x": 1})
+        table.set_member("n2", "0", "a", "alice", 1, {"x": 1})
+        table.set_member("n2", "0", "a", "bob", 1, {})
+        table.set_member("n2", "1", "b", "carol", 1, {})
+        assert table.nodes_for("0", "a") == {"n1", "n2"}
+        assert table.members("0", "a") == {"alice": (3, {"x": 1}), "bob": (1, {})}
+        assert table.channel_names("0") == {"a"}
+        table.set_member("n1", "0", "a", "alice", 0, {})
+        assert table.nodes_for("0", "a") == {"n2"}
+        table.drop_node("n2")
+        assert table.channels == {}
+
+    def test_replace_node(self):
+        table = cluster.InterestTable()
+        table.set_member("n1", "0", "a", "alice", 1, {})
+        table.replace_node("n1", [("0", "b", "bob", 1, {})])
+        assert table.channel_names("0") == {"b"}
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestCluster(object):
+    def test_relay_to_interested_nodes(self):
+        received = []
+        handlers = {"test_op": lambda *args: received.append(args)}
+        addresses = ["127.0.0.1:19311", "127.0.0.1:19312"]
+        nodes = [
+            cluster.ClusterNode(address, addresses, "secret", handlers=handlers)
+            for address in addresses
+        ]
+        for node in nodes:
+            node.start()
+        try:
+            gevent.sleep(0.2)
+            nodes[1].send(None, "cluster_member", addresses[1], "0", "a", "bob", 1, {})
+            gevent.sleep(0.1)
+            assert nodes[0].interest.members("0", "a") == {"bob": (1, {})}
+            cluster.NODE = nodes[0]
+            cluster.relay("test_op", "0", "a", "hi")
+            # no node has members in channel b
+            cluster.relay("test_op", "0", "b", "skipped")
+            cluster.relay("test_op", "0", None, "private")
+            gevent.sleep(0.1)
+            assert received == [("0", "hi"), ("0", "private")]
+        finally:
+            for node in nodes:
+                node.stop()
+
+    def test_bad_signature_dropped(self):
+        received = []
+        node = cluster.ClusterNode(
+            "127.0.0.1:19313", [], "secret", handlers={"test_op": received.append}
+        )
+        node.start()
+        try:
+            sock = gevent.socket.create_connection(("127.0.0.1", 19313))
+            sock.sendall(bus.pack("test_op", (1,), {}, secret=b"other"))
+            gevent.sleep(0.1)
+            assert received == []
+            sock.close()
+        finally:
+            node.stop()
+
+    def test_signed_frames_are_json(self, test_uuids):
+        peer = bus.Peer("n2", None, secret=b"secret")
+        message = {
+            "uuid": test_uuids[1],
+            "timestamp": datetime(2020, 1, 1, 12, 30, 1, 5),
+            "message": {"__uuid__": "not a uuid"},
+        }
+        frame = bus.pack("test_op", ("0", [message]), {}, secret=b"secret")
+        payload = frame[bus.HEADER.size + bus.DIGEST_SIZE :]
+        assert json.loads(payload.decode("utf8"))[0] == "test_op"
+        assert peer.unpack(frame[bus.HEADER.size :]) == (
+            "test_op",
+            ["0", [message]],
+            {},
+        )
+        forged = b"cos\nsystem\n(S'true'\ntR."
+        digest = hmac.new(b"secret", forged, hashlib.sha256).digest()
+        assert peer.unpack(digest + forged) is None
+
+    def test_remote_member_presence_not_repeated(self, test_uuids):
+        node = cluster.ClusterNode("127.0.0.1:19314", [], "secret")
+        node.interest.set_member("n2", "0", "a", "alice", 1, {})
+        cluster.NODE = node
+        connection, user = channelstream.operations.connect(
+            username="bob", conn_id=test_uuids[2], channels=["a"], channel_configs={}
+        )
+        channel = get_state().channels["a"]
+        channel.notify_presence = True
+        connection.attach_queue(Queue())
+        channelstream.operations.connect(
+            username="alice", conn_id=test_uuids[1], channels=["a"], channel_configs={}
+        )
+        # alice already joined on other node
+        assert connection.queue.qsize() == 0
+        assert channel.get_info(include_users=True)["users"] == ["alice", "bob"]
+
+
+def log_message(text, **kwargs):
+    message = {
+        "uuid": uuid.uuid4(),
+        "channel": "test",
+        "message": text,
+        "type": "message",
+        "no_history": False,
+        "pm_users": [],
+        "exclude_users": [],
+    }
+    message.update(kwargs)
+    return message
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestStorage(object):
+    def test_segments_roll_and_replay(self, tmpdir):
+        segments = storage.SegmentLog(str(tmpdir), segment_size=100)
+        locations = [
+            segments.append(
+                storage.HISTORY_MESSAGE, 0, storage.NO_UUID, "a", b"x" * 100
+            )
+            for _ in range(3)
+        ]
+        assert len(segments.segments) == 3
+        assert segments.read(locations[1]).payload == b"x" * 100
+        segments.close()
+        reopened = storage.SegmentLog(str(tmpdir), segment_size=100)
+        assert [location for location, _ in reopened.replay()] == locations
+
+    def test_torn_tail_truncated(self, tmpdir):
+        segments = storage.SegmentLog(str(tmpdir))
+        segments.append(storage.HISTORY_MESSAGE, 0, storage.NO_UUID, "a", b"ok")
+        size = segments.size()
+        segments.close()
+        with open(os.path.join(str(tmpdir), "0000000001.log"), "ab") as f:
+            f.write(b"\0\0\0\x30garbage")
+        reopened = storage.SegmentLog(str(tmpdir))
+        assert [record.payload for _, record in reopened.replay()] == [b"ok"]
+        assert reopened.size() == size
+
+    def test_history_kept_in_log(self, tmpdir):
+        storage.LOGS["0"] = storage.TenantLog(str(tmpdir))
+        channel = Channel(
+            "test", channel_config={"store_history": True, "history_size": 3}
+        )
+        messages = [log_message("test{}".format(i)) for i in range(4)]
+        for message in messages:
+            channel.add_message(message)
+        assert isinstance(channel.history, storage.LoggedHistory)
+        assert [m["message"] for m in channel.history] == ["test1", "test2", "test3"]
+        channel.alter_message(
+            dict(messages[2], message="edited", edited=datetime.utcnow())
+        )
+        channel.delete_message(messages[1])
+        assert [m["message"] for m in channel.history] == ["edited", "test3"]
+        assert channel.history[0]["uuid"] == messages[2]["uuid"]
+
+    def test_restore_from_log(self, tmpdir, test_uuids):
+        server_state = get_state()
+        storage.LOGS["0"] = storage.TenantLog(str(tmpdir))
+        channel = Channel(
+            "test",
+            channel_config={"store_history": True, "history_size": 5, "frames_size": 3},
+        )
+        server_state.channels["test"] = channel
+        messages = [log_message("test{}".format(i)) for i in range(4)]
+        for message in messages:
+            channel.add_message(message)
+        channel.alter_message(dict(messages[3], message="edited"))
+        channel.delete_message(messages[0])
+        user = User("test_user")
+        server_state.users["test_user"] = user
+        user.add_message(log_message("pm", channel=None, pm_users=["test_user"]))
+        history = list(channel.history)
+        frames = [(t, f) for t, f, _ in channel.frames]
+        storage.LOGS["0"].close()
+
+        server_state.channels = {}
+        server_state.users = {}
+        storage.LOGS.clear()
+        channelstream.operations.restore_from_log(storage.TenantLog(str(tmpdir)))
+        restored = server_state.channels["test"]
+        assert restored.history_size == 5
+        assert restored.frames_size == 3
+        assert list(restored.history) == history
+        assert [(t, f) for t, f, _ in restored.frames] == frames
+        assert [f[1]["type"] for f in restored.frames] == [
+            "message",
+            "message:edit",
+            "message:delete",
+        ]
+        assert restored.frames[0][2].payload["message"] == "edited"
+        assert [f[2].seq for f in restored.frames] == [4, 5, 6]
+        assert restored.seq == 6
+        assert [f[1]["message"] for f in server_state.users["test_user"].frames] == [
+            "pm"
+        ]
+        # restored channel keeps writing to the log
+        restored.add_message(log_message("after"))
+        assert restored.history[-1]["message"] == "after"
+
+    def test_compaction(self, tmpdir):
+        server_state = get_state()
+        tenant_log = storage.TenantLog(str(tmpdir), segment_size=1024)
+        storage.LOGS["0"] = tenant_log
+        channel = Channel(
+            "test", channel_config={"store_history": True, "history_size": 2}
+        )
+        server_state.channels["test"] = channel
+        for i in range(50):
+            channel.add_message(log_message("test{}".format(i)))
+        assert tenant_log.needs_compaction()
+        size = tenant_log.segments.size()
+        tenant_log.compact(server_state)
+        assert tenant_log.segments.size() < size
+        assert not tenant_log.needs_compaction()
+        assert [m["message"] for m in channel.history] == ["test48", "test49"]
+        channel.add_message(log_message("test50"))
+        tenant_log.close()
+
+        server_state.channels = {}
+        storage.LOGS.clear()
+        channelstream.operations.restore_from_log(storage.TenantLog(str(tmpdir)))
+        restored = server_state.channels["test"]
+        assert [m["message"] for m in restored.history] == ["test49", "test50"]
+        assert len(restored.frames) == 51
+
+    def test_no_frames_with_log(self, tmpdir):
+        storage.LOGS["0"] = storage.TenantLog(str(tmpdir))
+        channel = Channel("test", channel_config={"frames_size": 0})
+        assert channel.add_message(log_message("test")) == 0
+        assert list(channel.frames) == []
+        assert channel.seq == 1
+
+    def test_compaction_keeps_saved_users(self, tmpdir):
+        server_state = get_state()
+        tenant_log = storage.TenantLog(str(tmpdir), segment_size=1024)
+        storage.LOGS["0"] = tenant_log
+        channel = Channel(
+            "test", channel_config={"store_history": True, "history_size": 2}
+        )
+        server_state.channels["test"] = channel
+        user = User("test_user")
+        for i in range(3):
+            user.add_message(
+                log_message("pm{}".format(i), channel=None, pm_users=["test_user"])
+            )
+        # user restored from snapshot and not used since
+        server_state.users = UserRegistry(tenant_id="0")
+        server_state.users.saved["test_user"] = pickle.dumps(({}, []))
+        for i in range(50):
+            channel.add_message(log_message("test{}".format(i)))
+        history = iter(channel.history)
+        tenant_log.compact(server_state)
+        assert [m["message"] for m in history] == ["test48", "test49"]
+        tenant_log.close()
+
+        server_state.channels = {}
+        server_state.users = {}
+        storage.LOGS.clear()
+        channelstream.operations.restore_from_log(storage.TenantLog(str(tmpdir)))
+        frames = server_state.users["test_user"].frames
+        assert [f[1]["message"] for f in frames] == ["pm0", "pm1", "pm2"]
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestSnapshot(object):
+    def test_warm_restart(self, tmpdir, test_uuids):
+        server_state = get_state()
+        path = str(tmpdir.join("snapshot"))
+        connection, user = channelstream.operations.connect(
+            username="test",
+            fresh_user_state={"color": "red", "secret": 1},
+            state_public_keys=["color"],
+            conn_id=test_uuids[1],
+            channels=["a"],
+            channel_configs={"a": {"store_history": True, "history_size": 3}},
+        )
+        server_state.channels["a"].add_message(log_message("hello", channel="a"))
+        snapshot.write_snapshot(path)
+
+        server_state.channels = {}
+        server_state.users = {}
+        server_state.connections = {}
+        assert snapshot.load_snapshot(path)
+        channel = server_state.channels["a"]
+        assert channel.history_size == 3
+        assert [m["message"] for m in channel.history] == ["hello"]
+        assert channel.seq == 1
+        assert channel.connections == {}
+        # users and connections are restored on first use
+        assert "test" in server_state.users
+        assert len(server_state.users) == 0
+        connection = channelstream.operations.find_connection(test_uuids[1])
+        assert connection.username == "test"
+        assert connection.channel_names == {"a"}
+        assert server_state.users["test"].public_state == {"color": "red"}
+        assert server_state.saved_connections == {}
+        assert channelstream.operations.find_connection(test_uuids[2]) is None
+
+    def test_saved_user_keeps_state_on_connect(self, tmpdir, test_uuids):
+        server_state = get_state()
+        path = str(tmpdir.join("snapshot"))
+        channelstream.operations.connect(
+            username="test",
+            fresh_user_state={"color": "red"},
+            conn_id=test_uuids[1],
+            channels=[],
+            channel_configs={},
+        )
+        snapshot.write_snapshot(path)
+        server_state.users = {}
+        server_state.connections = {}
+        snapshot.load_snapshot(path)
+        connection, user = channelstream.operations.connect(
+            username="test",
+            fresh_user_state={"color": "blue"},
+            conn_id=test_uuids[2],
+            channels=[],
+            channel_configs={},
+        )
+        assert user.state == {"color": "red"}
+        assert server_state.users.saved == {}
+
+    def test_warm_restart_with_log(self, tmpdir, test_uuids):
+        server_state = get_state()
+        path = str(tmpdir.join("snapshot"))
+        log_dir = str(tmpdir.join("log"))
+        storage.LOGS["0"] = storage.TenantLog(log_dir)
+        connection, user = channelstream.operations.connect(
+            username="test",
+            fresh_user_state={"color": "red"},
+            state_public_keys=["color"],
+            conn_id=test_uuids[1],
+            channels=[],
+            channel_configs={},
+        )
+        user.add_message(log_message("pm", channel=None, pm_users=["test"]))
+        snapshot.write_snapshot(path)
+        storage.LOGS["0"].close()
+
+        server_state.users = {}
+        server_state.connections = {}
+        storage.LOGS.clear()
+        # server restores from log first
+        channelstream.operations.restore_from_log(storage.TenantLog(log_dir))
+        snapshot.load_snapshot(path)
+        user = server_state.users["test"]
+        assert user.state == {"color": "red"}
+        assert user.state_public_keys == ["color"]
+        assert [f[1]["message"] for f in user.frames] == ["pm"]
+        assert server_state.users.saved == {}
+
+    def test_not_a_snapshot(self, tmpdir):
+        path = tmpdir.join("snapshot")
+        path.write("junk")
+        assert not snapshot.load_snapshot(str(path))
+        assert not snapshot.load_snapshot(str(tmpdir.join("missing")))
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestStorm(object):
+    def _connect(self, username, conn_id):
+        connection, user = channelstream.operations.connect(
+            username=username,
+            conn_id=conn_id,
+            channels=["a"],
+            channel_configs={"a": {"notify_presence": True}},
+        )
+        connection.attach_queue(Queue())
+        return connection
+
+    def test_detects_mass_reconnect(self):
+        server_state = get_state()
+        assert not storm.record_reconnect(now=100)
+        server_state.storm_reconnects_per_second = 3
+        server_state.storm_grace = 10
+        assert not storm.record_reconnect(now=100.1)
+        assert not storm.record_reconnect(now=100.2)
+        assert storm.record_reconnect(now=100.3)
+        assert storm.storm_active(server_state, now=110)
+        assert not storm.storm_active(server_state, now=111)
+        # rate of previous second keeps storm going
+        assert storm.record_reconnect(now=101.5)
+        assert storm.storm_active(server_state, now=111)
+        assert server_state.stats["reconnect_storms"] == 1
+
+    def test_part_join_pair_suppressed(self, test_uuids):
+        server_state = get_state()
+        server_state.storm_reconnects_per_second = 1
+        storm.begin_storm(server_state)
+        connection = self._connect("test", test_uuids[1])
+        connection2 = self._connect("test2", test_uuids[2])
+        assert connection.queue.get_nowait()[0]["message"] == {"action": "joined"}
+        channel = server_state.channels["a"]
+        channel.remove_connection(connection2)
+        connection3 = self._connect("test2", test_uuids[3])
+        assert connection.queue.empty()
+        assert server_state.stats["suppressed_presence"] == 2
+        channel.remove_connection(connection3)
+        assert list(channel.parting) == ["test2"]
+        assert channel.expire_parting() == []
+        assert channel.expire_parting(now=time.time() + 31) == ["test2"]
+        messages = connection.queue.get_nowait()
+        assert messages[0]["message"] == {"action": "parted"}
+        assert messages[0]["user"] == "test2"
+        assert channel.parting == {}
+
+    def test_deferred_catchup_skips_live_messages(self, test_uuids):
+        server_state = get_state()
+        server_state.storm_reconnects_per_second = 1
+        storm.begin_storm(server_state)
+        connection, _ = channelstream.operations.connect(
+            username="test", conn_id=test_uuids[1], channels=["a"], channel_configs={}
+        )
+        channel = server_state.channels["a"]
+        channel.add_message(log_message("missed", channel="a"))
+        connection.attach_queue(Queue())
+        assert storm.deliver_catchup(connection)
+        channel.add_message(log_message("live", channel="a"))
+        assert [m["message"] for m in connection.queue.get_nowait()] == ["live"]
+        gevent.sleep(0.15)
+        catchup = connection.queue.get_nowait()
+        assert [m["message"] for m in catchup] == ["missed"]
+        assert connection.queue.empty()
+        assert server_state.catchup_worker is None
+        assert server_state.stats["deferred_catchups"] == 1
+
+    def test_deferred_catchup_goes_ahead_in_poll_buffer(self, test_uuids):
+        server_state = get_state()
+        server_state.storm_reconnects_per_second = 1
+        storm.begin_storm(server_state)
+        connection, _ = channelstream.operations.connect(
+            username="test", conn_id=test_uuids[1], channels=["a"], channel_configs={}
+        )
+        channel = server_state.channels["a"]
+        channel.add_message(log_message("missed", channel="a"))
+        connection.attach_poll_buffer()
+        assert storm.deliver_catchup(connection, resume={"a": 0})
+        channel.add_message(log_message("live", channel="a"))
+        # cursor after the live message would skip the catchup
+        assert connection.queue.take({}) == ([], {})
+        gevent.sleep(0.15)
+        messages, cursor = connection.queue.take({})
+        assert [m["message"] for m in messages] == ["missed", "live"]
+        assert cursor == {"a": 2}
+
+    def test_deferred_catchup_of_replaced_buffer_skipped(self, test_uuids):
+        server_state = get_state()
+        server_state.storm_reconnects_per_second = 1
+        storm.begin_storm(server_state)
+        connection, _ = channelstream.operations.connect(
+            username="test", conn_id=test_uuids[1], channels=["a"], channel_configs={}
+        )
+        server_state.channels["a"].add_message(log_message("missed", channel="a"))
+        connection.attach_poll_buffer()
+        assert storm.deliver_catchup(connection, resume={"a": 0})
+        # client went to another worker and came back meanwhile
+        channelstream.operations.attached_remotely(test_uuids[1])
+        connection.attach_poll_buffer()
+        gevent.sleep(0.15)
+        assert list(connection.queue.messages) == []
+
+    def test_catchup_right_away_without_storm(self, test_uuids):
+        server_state = get_state()
+        connection, _ = channelstream.operations.connect(
+            username="test", conn_id=test_uuids[1], channels=["a"], channel_configs={}
+        )
+        server_state.channels["a"].add_message(log_message("missed", channel="a"))
+        connection.attach_queue(Queue())
+        assert not storm.deliver_catchup(connection)
+        assert [m["message"] for m in connection.queue.get_nowait()] == ["missed"]
+
+    def test_first_websocket_is_not_reconnect(self, tmpdir, test_uuids, monkeypatch):
+        from channelstream.ws_app import ChatApplicationSocket
+
+        server_state = get_state()
+        recorded = []
+        monkeypatch.setattr(storm, "record_reconnect", recorded.append)
+
+        def open_socket(conn_id):
+            socket = ChatApplicationSocket.__new__(ChatApplicationSocket)
+            socket.client_terminated = socket.server_terminated = False
+            socket.environ = {"QUERY_STRING": "conn_id={}".format(conn_id)}
+            socket.opened()
+            return socket
+
+        channelstream.operations.connect(
+            username="test", conn_id=test_uuids[1], channels=["a"], channel_configs={}
+        )
+        open_socket(test_uuids[1])
+        assert recorded == []
+        open_socket(test_uuids[1])
+        assert recorded == ["0"]
+        # connection restored after restart was attached before
+        path = str(tmpdir.join("snapshot"))
+        snapshot.write_snapshot(path)
+        server_state.users = {}
+        server_state.connections = {}
+        snapshot.load_snapshot(path)
+        open_socket(test_uuids[1])
+        assert recorded == ["0", "0"]
+
+    def test_snapshot_restore_starts_storm(self, tmpdir, test_uuids):
+        server_state = get_state()
+        server_state.storm_reconnects_per_second = 100
+        path = str(tmpdir.join("snapshot"))
+        self._connect("test", test_uuids[1])
+        snapshot.write_snapshot(path)
+        server_state.channels = {}
+        server_state.users = {}
+        server_state.connections = {}
+        snapshot.load_snapshot(path)
+        assert storm.storm_active(server_state)
+        channel = server_state.channels["a"]
+        assert list(channel.parting) == ["test"]
+        # user coming back is not announced
+        self._connect("test", test_uuids[2])
+        assert channel.parting == {}
+        assert server_state.stats["suppressed_presence"] == 2
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestMetrics(object):
+    def _connect(self, username, conn_id):
+        connection, _ = channelstream.operations.connect(
+            username=username, conn_id=conn_id, channels=["a"], channel_configs={}
+        )
+        return connection
+
+    def test_render(self, test_uuids):
+        server_state = get_state()
+        self._connect("test", test_uuids[1]).attach_socket(DummySocket())
+        self._connect("test2", test_uuids[2]).attach_poll_buffer(transport="sse")
+        self._connect("test3", test_uuids[3])
+        channelstream.operations.pass_message(
+            {
+                "uuid": test_uuids[4],
+                "type": "message",
+                "user": "system",
+                "channel": "a",
+                "message": {"text": "test"},
+                "no_history": True,
+                "pm_users": [],
+                "exclude_users": [],
+            },
+            server_state.stats,
+        )
+        gevent.sleep(0)
+        lines = metrics.render().splitlines()
+        assert "# TYPE channelstream_fanout_seconds histogram" in lines
+        for line in [
+            'channelstream_connections{tenant="0",transport="websocket"} 1',
+            'channelstream_connections{tenant="0",transport="sse"} 1',
+            'channelstream_connections{tenant="0",transport="detached"} 1',
+            'channelstream_messages_total{tenant="0"} 2',
+            'channelstream_fanout_subscribers_bucket{tenant="0",le="1"} 0',
+            'channelstream_fanout_subscribers_bucket{tenant="0",le="10"} 1',
+            'channelstream_fanout_subscribers_bucket{tenant="0",le="+Inf"} 1',
+            'channelstream_fanout_subscribers_sum{tenant="0"} 2.0',
+            'channelstream_websocket_send_seconds_count{tenant="0"} 1',
+            'channelstream_send_queue_depth_count{tenant="0"} 1',
+        ]:
+            assert line in lines
+
+    def test_escapes_labels(self):
+        assert metrics.format_labels([("tenant", 'a"b\\c\nd')]) == (
+            '{tenant="a\\"b\\\\c\\nd"}'
+        )
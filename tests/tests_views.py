@@ -2,10 +2,13 @@ from gevent import monkey
 
 monkey.patch_all()
 
+import copy
 import pytest
 import gevent
 import marshmallow
-from channelstream.server_state import get_state
+from collections import deque
+from channelstream import patched_json as json
+from channelstream.server_state import configure_tenants, get_state, QuotaExceeded
 from channelstream.channel import Channel
 
 
@@ -238,10 +241,23 @@ class TestInfoView(object):
         from channelstream.wsgi_views.server import info
 
         dummy_request.json_body = {}
-        result = info(dummy_request)
+        result = json.loads(info(dummy_request).text)
         assert result["channels"] == {}
         assert result["users"] == []
 
+    def test_no_body_lists_remote_channels(self, dummy_request):
+        from channelstream import cluster
+        from channelstream.wsgi_views.server import info
+
+        node = cluster.ClusterNode("127.0.0.1:19315", [], "cluster_secret")
+        node.interest.set_member("n2", "0", "remote", "alice", 1, {})
+        cluster.NODE = node
+        get_state().channels["local"] = Channel("local")
+        dummy_request.body = b""
+        result = json.loads(info(dummy_request).text)
+        assert sorted(result["channels"]) == ["local", "remote"]
+        assert result["channels"]["remote"]["users"] == ["alice"]
+
     def test_subscribed_json(self, dummy_request, test_uuids):
         from channelstream.wsgi_views.server import connect, info
 
@@ -266,7 +282,7 @@ class TestInfoView(object):
         }
         connect(dummy_request)
         dummy_request.json_body = {}
-        result = info(dummy_request)
+        result = json.loads(info(dummy_request).text)
         assert sorted(("a", "aB", "c")) == sorted(result["channels"].keys())
         assert result["users"]
         comp_a = sorted(result["channels"]["a"]["users"])
@@ -289,7 +305,7 @@ class TestInfoView(object):
         assert comp_a == comp_b
         dummy_request.body = "NOTEMPTY"
         dummy_request.json_body = {"info": {"channels": ["a"]}}
-        result = info(dummy_request)
+        result = json.loads(info(dummy_request).text)
         assert "a" in result["channels"]
         assert "aB" not in result["channels"]
 
@@ -326,11 +342,113 @@ class TestInfoView(object):
                 "include_connections": True,
             }
         }
-        result = info(dummy_request)
+        result = json.loads(info(dummy_request).text)
         assert sorted(result["channels"].keys()) == sorted(["a", "aB", "D"])
         assert "private" not in result["users"][0]["state"]
         assert len(result["channels"]["a"]["history"]) == 0
 
+    def test_etag(self, dummy_request, test_uuids):
+        from channelstream.wsgi_views.server import connect, info, user_state
+
+        dummy_request.json_body = {
+            "username": "test1",
+            "conn_id": str(test_uuids[1]),
+            "user_state": {"bar": "baz"},
+            "channels": ["a"],
+            "channel_configs": {},
+        }
+        connect(dummy_request)
+        dummy_request.json_body = {}
+        response = info(dummy_request)
+        etag = response.etag
+        assert etag
+        assert info(dummy_request).etag == etag
+        dummy_request.headers["If-None-Match"] = '"{}"'.format(etag)
+        not_modified = info(dummy_request)
+        assert not_modified.status_code == 304
+        assert not_modified.headers["ETag"] == '"{}"'.format(etag)
+        # user state is part of info
+        dummy_request.json_body = {"user": "test1", "user_state": {"bar": "qux"}}
+        user_state(dummy_request)
+        dummy_request.json_body = {}
+        response = info(dummy_request)
+        assert response.status_code == 200
+        assert response.etag != etag
+        assert json.loads(response.text)["users"][0]["state"] == {"bar": "qux"}
+        # and membership
+        etag = response.etag
+        dummy_request.headers["If-None-Match"] = '"{}"'.format(etag)
+        dummy_request.json_body = {
+            "username": "test2",
+            "conn_id": str(test_uuids[2]),
+            "channels": ["a"],
+            "channel_configs": {},
+        }
+        connect(dummy_request)
+        dummy_request.json_body = {}
+        response = info(dummy_request)
+        assert response.etag != etag
+        assert json.loads(response.text)["channels"]["a"]["users"] == [
+            "test1",
+            "test2",
+        ]
+
+    def _connect_channels(self, dummy_request, test_uuids):
+        from channelstream.wsgi_views.server import connect
+
+        dummy_request.json_body = {
+            "username": "test1",
+            "conn_id": str(test_uuids[1]),
+            "user_state": {"bar": "baz"},
+            "channels": ["room_1", "room_2", "room_3", "other", "room_4"],
+            "channel_configs": {},
+        }
+        connect(dummy_request)
+        dummy_request.body = "NOTEMPTY"
+
+    def test_pagination(self, dummy_request, test_uuids):
+        from channelstream.wsgi_views.server import info
+
+        self._connect_channels(dummy_request, test_uuids)
+        pages = []
+        cursor = None
+        while True:
+            dummy_request.json_body = {
+                "info": {"prefix": "room_", "limit": 3, "cursor": cursor}
+            }
+            result = json.loads(info(dummy_request).text)
+            pages.append(sorted(result["channels"]))
+            assert result["users"][0]["user"] == "test1"
+            cursor = result["next_cursor"]
+            if cursor is None:
+                break
+        assert pages == [["room_1", "room_2", "room_3"], ["room_4"]]
+
+    def test_exact_page_has_no_next_cursor(self, dummy_request, test_uuids):
+        from channelstream.wsgi_views.server import info
+
+        self._connect_channels(dummy_request, test_uuids)
+        dummy_request.json_body = {"info": {"prefix": "room_", "limit": 4}}
+        result = json.loads(info(dummy_request).text)
+        assert len(result["channels"]) == 4
+        assert result["next_cursor"] is None
+
+    def test_stream(self, dummy_request, test_uuids):
+        from channelstream.wsgi_views.server import info
+
+        self._connect_channels(dummy_request, test_uuids)
+        dummy_request.json_body = {"info": {"stream": True}}
+        response = info(dummy_request)
+        assert response.etag is None
+        body = b"".join(response.app_iter).decode("utf8")
+        dummy_request.json_body = {"info": {}}
+        expected = json.loads(info(dummy_request).text)
+        assert json.loads(body) == expected
+        assert "next_cursor" not in expected
+        dummy_request.json_body = {"info": {"stream": True, "limit": 2}}
+        body = b"".join(info(dummy_request).app_iter).decode("utf8")
+        assert json.loads(body)["next_cursor"] == "room_1"
+
 
 @pytest.mark.usefixtures("cleanup_globals", "pyramid_config")
 class TestMessageViews(object):
@@ -421,6 +539,214 @@ class TestMessageViews(object):
         assert messages[1]["message"]["text"] == "test2"
 
 
+@pytest.mark.usefixtures("cleanup_globals")
+class TestListenView(object):
+    def _poll(self, dummy_request, conn_id, cursor=None):
+        from channelstream.wsgi_views.server import listen
+
+        dummy_request.params = {"conn_id": str(conn_id)}
+        if cursor is not None:
+            dummy_request.params["cursor"] = str(cursor)
+        response = listen(dummy_request)
+        return json.loads(b"".join(response.app_iter).decode("utf8"))
+
+    def _publish(self, dummy_request, text):
+        from channelstream.wsgi_views.server import message
+
+        dummy_request.json_body = [
+            {
+                "type": "message",
+                "user": "system",
+                "channel": "test",
+                "message": {"text": text},
+            }
+        ]
+        message(dummy_request)
+        gevent.sleep(0)
+
+    def test_cursor_resume(self, dummy_request, pyramid_config, test_uuids):
+        from channelstream.wsgi_views.server import connect
+
+        _, settings = pyramid_config
+        settings.update({"wake_connections_after": 0.05, "long_poll_linger": 0})
+        dummy_request.json_body = {
+            "username": "test1",
+            "conn_id": str(test_uuids[1]),
+            "channels": ["test"],
+        }
+        connect(dummy_request)
+        assert self._poll(dummy_request, test_uuids[1], "") == {
+            "cursor": "",
+            "messages": [],
+        }
+        # messages sent between polls wait in the buffer
+        self._publish(dummy_request, "test1")
+        self._publish(dummy_request, "test2")
+        result = self._poll(dummy_request, test_uuids[1], "")
+        assert result["cursor"] == "test:2"
+        assert [m["message"]["text"] for m in result["messages"]] == ["test1", "test2"]
+        # response got lost, client polls with the old cursor again
+        self._publish(dummy_request, "test3")
+        result = self._poll(dummy_request, test_uuids[1], "")
+        assert [m["message"]["text"] for m in result["messages"]] == [
+            "test1",
+            "test2",
+            "test3",
+        ]
+        result = self._poll(dummy_request, test_uuids[1], "test:3")
+        assert result == {"cursor": "test:3", "messages": []}
+
+    def test_moves_between_workers(
+        self, dummy_request, pyramid_config, test_uuids, monkeypatch
+    ):
+        from channelstream import bus, operations
+        from channelstream.wsgi_views.server import connect, message
+
+        _, settings = pyramid_config
+        settings.update({"wake_connections_after": 0.01, "long_poll_linger": 0})
+        # tenants stand in for replicas of the same state on two workers
+        configure_tenants(["worker_a", "worker_b"])
+        monkeypatch.setattr(bus, "publish", lambda *args, **kwargs: None)
+        conn_id = test_uuids[1]
+
+        def replicate(view, body):
+            for worker in ("worker_a", "worker_b"):
+                dummy_request.tenant_id = worker
+                dummy_request.json_body = copy.deepcopy(body)
+                view(dummy_request)
+            gevent.sleep(0)
+
+        def publish(text, private=False):
+            msg = {"type": "message", "user": "system", "message": {"text": text}}
+            if private:
+                msg["pm_users"] = ["test1"]
+            else:
+                msg["channel"] = "test"
+            replicate(message, [msg])
+
+        def poll(worker, cursor):
+            dummy_request.tenant_id = worker
+            result = self._poll(dummy_request, conn_id, cursor)
+            # other worker learns about it over the bus
+            other = "worker_b" if worker == "worker_a" else "worker_a"
+            operations.attached_remotely(conn_id, other)
+            received.extend(m["message"]["text"] for m in result["messages"])
+            return result["cursor"]
+
+        received = []
+        replicate(
+            connect,
+            {"username": "test1", "conn_id": str(conn_id), "channels": ["test"]},
+        )
+        cursor = poll("worker_a", "")
+        publish("1")
+        publish("2", private=True)
+        cursor = poll("worker_a", cursor)
+        assert cursor == ":1,test:1"
+        publish("3")
+        cursor = poll("worker_b", cursor)
+        # stale buffer of worker_a is gone and it doesn't deliver anymore
+        assert get_state("worker_a").connections[conn_id].queue is None
+        publish("4")
+        publish("5", private=True)
+        # response got lost, client retries from the same cursor
+        poll("worker_b", cursor)
+        received = received[:-2]
+        publish("6")
+        cursor = poll("worker_a", cursor)
+        assert get_state("worker_b").connections[conn_id].queue is None
+        publish("7", private=True)
+        cursor = poll("worker_a", cursor)
+        # catchup sends channel messages before private ones
+        assert sorted(received) == ["1", "2", "3", "4", "5", "6", "7"]
+        assert cursor == ":3,test:4"
+
+    def test_returns_when_data_arrives(self, dummy_request, pyramid_config, test_uuids):
+        from channelstream.wsgi_views.server import connect
+
+        _, settings = pyramid_config
+        settings.update({"wake_connections_after": 5, "long_poll_linger": 0})
+        dummy_request.json_body = {
+            "username": "test1",
+            "conn_id": str(test_uuids[1]),
+            "channels": ["test"],
+        }
+        connect(dummy_request)
+        # registry is thread local, poll runs in its own greenlet
+        dummy_request.registry = dummy_request.registry
+        poll = gevent.spawn(self._poll, dummy_request, test_uuids[1])
+        gevent.sleep(0.01)
+        self._publish(dummy_request, "test1")
+        result = poll.get(timeout=1)
+        assert [m["message"]["text"] for m in result] == ["test1"]
+        # without cursor returned messages are acknowledged right away
+        assert get_state().connections[test_uuids[1]].queue.messages == deque()
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestSSEView(object):
+    def test_stream(self, dummy_request, pyramid_config, test_uuids):
+        from channelstream.wsgi_views.server import connect, listen_sse, message
+
+        _, settings = pyramid_config
+        settings.update({"wake_connections_after": 0.05})
+        dummy_request.json_body = {
+            "username": "test1",
+            "conn_id": str(test_uuids[1]),
+            "channels": ["test"],
+        }
+        connect(dummy_request)
+        for text in ["test1", "test2", "test3"]:
+            dummy_request.json_body = [
+                {
+                    "type": "message",
+                    "user": "system",
+                    "channel": "test",
+                    "message": {"text": text},
+                }
+            ]
+            message(dummy_request)
+            gevent.sleep(0)
+        # client has seen first event already
+        dummy_request.params = {"conn_id": str(test_uuids[1])}
+        dummy_request.headers["Last-Event-ID"] = "test:1"
+        response = listen_sse(dummy_request)
+        assert response.content_type == "text/event-stream"
+        events = iter(response.app_iter)
+        event = next(events).decode("utf8")
+        assert event.startswith("id: test:3\ndata: ")
+        data = json.loads(event.split("data: ", 1)[1])
+        assert [m["message"]["text"] for m in data] == ["test2", "test3"]
+        # nothing to send, keep-alive comment
+        assert next(events) == b":\n\n"
+        get_state().connections.pop(test_uuids[1])
+        assert list(events) == []
+
+    def test_reconnect_recorded_once(
+        self, dummy_request, pyramid_config, test_uuids, monkeypatch
+    ):
+        from channelstream import storm
+        from channelstream.wsgi_views.server import connect, listen_sse
+
+        recorded = []
+        monkeypatch.setattr(storm, "record_reconnect", recorded.append)
+        dummy_request.json_body = {
+            "username": "test1",
+            "conn_id": str(test_uuids[1]),
+            "channels": ["test"],
+        }
+        connect(dummy_request)
+        dummy_request.params = {"conn_id": str(test_uuids[1])}
+        listen_sse(dummy_request)
+        # stream is already attached
+        listen_sse(dummy_request)
+        assert len(recorded) == 1
+        # dropped stream resumes
+        dummy_request.headers["Last-Event-ID"] = "test:1"
+        listen_sse(dummy_request)
+        assert len(recorded) == 2
+
+
 @pytest.mark.usefixtures("cleanup_globals", "pyramid_config")
 class TestMessageEditViews(object):
     def test_empty_json(self, dummy_request):
@@ -530,3 +856,85 @@ class TestChannelConfigView(object):
         assert channel_settings["broadcast_presence_with_user_lists"] is True
         assert channel_settings["notify_state"] is True
         assert channel_settings["store_frames"] is False
+
+
+@pytest.mark.usefixtures("cleanup_globals", "pyramid_config")
+class TestTenants(object):
+    def _connect(self, dummy_request, conn_id, tenant_id):
+        from channelstream.wsgi_views.server import connect
+
+        dummy_request.tenant_id = tenant_id
+        dummy_request.json_body = {
+            "username": "test",
+            "conn_id": str(conn_id),
+            "channels": ["a"],
+        }
+        return connect(dummy_request)
+
+    def test_isolated_state(self, dummy_request, test_uuids):
+        from channelstream.wsgi_views.server import message
+
+        configure_tenants(["acme"])
+        self._connect(dummy_request, test_uuids[1], "acme")
+        assert test_uuids[1] in get_state("acme").connections
+        assert get_state().connections == {}
+        assert get_state().channels == {}
+
+        dummy_request.json_body = [
+            {"type": "message", "user": "system", "channel": "a", "message": {}}
+        ]
+        message(dummy_request)
+        gevent.sleep(0)
+        assert get_state("acme").stats["total_unique_messages"] == 1
+        assert get_state().stats["total_unique_messages"] == 0
+
+    def test_connection_quota(self, dummy_request, test_uuids):
+        configure_tenants(["acme"], max_connections=1)
+        self._connect(dummy_request, test_uuids[1], "acme")
+        # reconnecting with existing id is fine
+        self._connect(dummy_request, test_uuids[1], "acme")
+        with pytest.raises(QuotaExceeded):
+            self._connect(dummy_request, test_uuids[2], "acme")
+        assert get_state("acme").stats["rejected_connections"] == 1
+        # other tenants are not affected
+        self._connect(dummy_request, test_uuids[2], "0")
+
+    def test_message_quota(self, dummy_request):
+        from channelstream.wsgi_views.server import message
+
+        configure_tenants(["acme"], max_messages_per_second=2)
+        dummy_request.tenant_id = "acme"
+        dummy_request.json_body = [
+            {"type": "message", "user": "system", "channel": "a", "message": {}}
+        ] * 3
+        with pytest.raises(QuotaExceeded):
+            message(dummy_request)
+        assert get_state("acme").stats["rejected_messages"] == 3
+
+    def test_tenant_secret(self):
+        from channelstream.wsgi_views.wsgi_security import tenant_secret
+
+        config = {"secret": "default", "tenants": {"acme": "acme_secret"}}
+        assert tenant_secret(config, "0") == "default"
+        assert tenant_secret(config, "acme") == "acme_secret"
+        assert tenant_secret(config, "unknown") is None
+
+
+@pytest.mark.usefixtures("cleanup_globals", "pyramid_config")
+class TestMetricsView(object):
+    def test_metrics(self, dummy_request, test_uuids):
+        from channelstream.wsgi_views.server import connect, ServerViews
+
+        dummy_request.json_body = {
+            "username": "test",
+            "conn_id": str(test_uuids[1]),
+            "channels": ["a"],
+        }
+        connect(dummy_request)
+        response = ServerViews(dummy_request).metrics()
+        assert response.content_type == "text/plain"
+        assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+        lines = response.text.splitlines()
+        assert 'channelstream_connect_seconds_count{tenant="0"} 1' in lines
+        assert 'channelstream_subscribe_seconds_count{tenant="0"} 0' in lines
+        assert 'channelstream_connections{tenant="0",transport="detached"} 1' in lines